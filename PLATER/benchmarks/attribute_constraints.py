@@ -0,0 +1,90 @@
+"""
+Benchmarks checking attribute constraints on many edges, with a pydantic Attribute per attribute and a scan of the
+attributes per constraint (a frozen copy of how constraints used to be checked), against constraints compiled once
+per request.
+
+    python -m PLATER.benchmarks.attribute_constraints
+"""
+import re
+import timeit
+from collections.abc import Iterable
+
+from reasoner_pydantic.qgraph import AttributeConstraint, Operator as OperatorModel
+from reasoner_pydantic.shared import Attribute, HashableSequence
+from PLATER.services.util.constraints import compile_attribute_constraints, operator_map, MatchesOperator
+
+EDGE_COUNT = 100000
+
+
+def make_edges():
+    return [[
+        {'attribute_type_id': 'biolink:p_value', 'value': (index % 100) / 1000, 'original_attribute_name': 'p_value'},
+        {'attribute_type_id': 'biolink:publications', 'value': [f'PMID:{index}', f'PMID:{index + 1}'],
+         'original_attribute_name': 'publications'},
+        {'attribute_type_id': 'biolink:description', 'value': f'edge {index}',
+         'original_attribute_name': 'description'},
+        {'attribute_type_id': 'biolink:Attribute', 'value': index, 'original_attribute_name': 'weight'},
+    ] for index in range(EDGE_COUNT)]
+
+
+CONSTRAINTS = [
+    AttributeConstraint(**{'id': 'biolink:p_value', 'operator': '>', 'value': 0.05, 'name': 'p value'}),
+    AttributeConstraint(**{'id': 'biolink:description', 'operator': 'matches', 'value': 'edge 1.*',
+                           'name': 'description'}),
+]
+
+
+class OriginalMatchesOperator(MatchesOperator):
+    # the matches operator before regexes were cached, compiling the constraint's regex for every value
+    def __call__(self, a, b):
+        if not self.is_same_data_type(a, b):
+            return False
+        if isinstance(a, str):
+            return bool(re.compile(a).match(b))
+        if isinstance(a, Iterable):
+            return any(x in a for x in b)
+        return a == b
+
+
+original_operator_map = {**operator_map, OperatorModel.matches: OriginalMatchesOperator()}
+
+
+def original_check_attribute_constraint(attribute_constraint: AttributeConstraint, db_value):
+    # frozen copy of check_attribute_constraint before constraints were compiled
+    op = original_operator_map[attribute_constraint.operator]
+    constraint_val = attribute_constraint.value.__root__ if isinstance(attribute_constraint.value, HashableSequence) \
+        else attribute_constraint.value
+    result = op(constraint_val, db_value)
+    return result if not attribute_constraint.negated else not result
+
+
+def original_check_attributes(attribute_constraints, db_attributes):
+    # frozen copy of check_attributes before constraints were compiled
+    for constraint in attribute_constraints:
+        constraint_is_applied = False
+        for db_attribute in db_attributes:
+            if db_attribute.attribute_type_id == constraint.id:
+                constraint_is_applied = True
+                if not original_check_attribute_constraint(constraint, db_attribute.value):
+                    return False
+        if not constraint_is_applied:
+            return False
+    return True
+
+
+def uncompiled(edges):
+    return sum(original_check_attributes(CONSTRAINTS, [Attribute(**attribute) for attribute in attributes])
+               for attributes in edges)
+
+
+def compiled(edges):
+    check = compile_attribute_constraints(CONSTRAINTS)
+    return sum(check(attributes) for attributes in edges)
+
+
+if __name__ == '__main__':
+    edges = make_edges()
+    assert uncompiled(edges) == compiled(edges)
+    for benchmark in (uncompiled, compiled):
+        seconds = min(timeit.repeat(lambda: benchmark(edges), number=1, repeat=3))
+        print(f'{benchmark.__name__}: {seconds:.3f}s for {EDGE_COUNT} edges')
@@ -0,0 +1,72 @@
+"""
+Benchmarks formatting the attributes of many edges, with the biolink model toolkit and the skip list consulted for
+every attribute (how attributes used to be formatted), against the per-name classification table.
+
+    python -m PLATER.benchmarks.format_attributes
+"""
+import copy
+import timeit
+
+from PLATER.services.util.attribute_mapping import skip_list, get_attribute_info
+from PLATER.services.util.bl_helper import BIOLINK_MODEL_TOOLKIT as bmt
+from PLATER.services.util.question import Question
+
+EDGE_COUNT = 100000
+
+
+def make_edges():
+    return {f'edge_{index}': {
+        'subject': f'CURIE:{index}',
+        'object': f'CURIE:{index + 1}',
+        'predicate': 'biolink:affects',
+        'attributes': [
+            {'original_attribute_name': 'object_aspect_qualifier', 'value': 'activity'},
+            {'original_attribute_name': 'object_direction_qualifier', 'value': 'increased'},
+            {'original_attribute_name': 'publications', 'value': [f'PMID:{index}']},
+            {'original_attribute_name': 'p_value', 'value': 0.01},
+            {'original_attribute_name': 'knowledge_level', 'value': 'knowledge_assertion'},
+            {'original_attribute_name': 'provided_by', 'value': 'somebody'},
+        ],
+        'sources': [{'resource_role': 'primary_knowledge_source', 'resource_id': 'infores:primary'}]
+    } for index in range(EDGE_COUNT)}
+
+
+def per_attribute_lookups(question, edges):
+    for props in edges.values():
+        attributes = props.get('attributes', [])
+        qualifiers = [attribute for attribute in attributes if bmt.is_qualifier(attribute['original_attribute_name'])]
+        if qualifiers:
+            props['qualifiers'] = [
+                {"qualifier_type_id": f"biolink:{qualifier['original_attribute_name']}"
+                    if not qualifier['original_attribute_name'].startswith("biolink:")
+                    else qualifier['original_attribute_name'],
+                 "qualifier_value": qualifier['value']}
+                for qualifier in qualifiers
+            ]
+        props['sources'] = question._construct_sources_tree(props.get('sources', []))
+        other_attributes = [attribute for attribute in attributes
+                            if attribute['original_attribute_name'] not in props
+                            and not bmt.is_qualifier(attribute['original_attribute_name'])
+                            and attribute['original_attribute_name'] not in skip_list]
+        for attr in other_attributes:
+            attr['original_attribute_name'] = attr['original_attribute_name'] or ''
+            attribute_data = get_attribute_info(attr["original_attribute_name"], attr.get("attribute_type_id", None))
+            if attribute_data:
+                attr.update(attribute_data)
+        props['attributes'] = other_attributes
+    return edges
+
+
+def classification_table(question, edges):
+    return question.format_attribute_trapi(edges)
+
+
+if __name__ == '__main__':
+    question = Question({})
+    edges = make_edges()
+    assert per_attribute_lookups(question, copy.deepcopy(edges)) == classification_table(question,
+                                                                                         copy.deepcopy(edges))
+    for benchmark in (per_attribute_lookups, classification_table):
+        runs = [copy.deepcopy(edges) for _ in range(3)]
+        seconds = min(timeit.repeat(lambda: benchmark(question, runs.pop()), number=1, repeat=3))
+        print(f'{benchmark.__name__}: {seconds:.3f}s for {EDGE_COUNT} edges')
@@ -0,0 +1,58 @@
+"""
+Measures the memory held by a formatted knowledge graph per 100k edges, with and without interning the vocabulary
+strings (categories, predicates, attribute names and types, qualifiers) repeated across nodes and edges.
+
+    python -m PLATER.benchmarks.response_memory
+"""
+import gc
+import tracemalloc
+
+import orjson
+
+from PLATER.services.util.question import Question
+
+EDGE_COUNT = 100000
+CATEGORIES = ["biolink:Gene", "biolink:GeneOrGeneProduct", "biolink:BiologicalEntity", "biolink:NamedThing"]
+
+
+def neo4j_row() -> bytes:
+    # serialized like neo4j returns it, so every string is a separate object once it's parsed
+    nodes = {f"NCBIGene:{index}": {"name": f"gene {index}", "categories": CATEGORIES,
+                                   "attributes": [{"original_attribute_name": "taxon", "value": "NCBITaxon:9606"}]}
+             for index in range(EDGE_COUNT + 1)}
+    edges = {f"edge_{index}": {
+        "subject": f"NCBIGene:{index}",
+        "object": f"NCBIGene:{index + 1}",
+        "predicate": "biolink:affects",
+        "attributes": [
+            {"original_attribute_name": "object_aspect_qualifier", "value": "activity"},
+            {"original_attribute_name": "publications", "value": [f"PMID:{index}"]},
+            {"original_attribute_name": "knowledge_level", "value": "knowledge_assertion"},
+            {"original_attribute_name": "agent_type", "value": "manual_agent"},
+        ],
+        "sources": [{"resource_role": "primary_knowledge_source", "resource_id": "infores:primary"}]
+    } for index in range(EDGE_COUNT)}
+    return orjson.dumps({"knowledge_graph": {"nodes": nodes, "edges": edges}, "results": []})
+
+
+def measure(raw: bytes, intern_strings: bool):
+    gc.collect()
+    tracemalloc.start()
+    question = Question({})
+    question.intern_strings = intern_strings
+    message = question.transform_attributes(orjson.loads(raw))
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del message
+    return retained, peak
+
+
+if __name__ == '__main__':
+    raw = neo4j_row()
+    # classify the attribute names up front, the table is shared by every response
+    measure(raw, intern_strings=True)
+    for intern_strings in (False, True):
+        retained, peak = measure(raw, intern_strings)
+        print(f'intern_strings={intern_strings}: {retained / 2 ** 20:.1f} MiB held, {peak / 2 ** 20:.1f} MiB peak '
+              f'per {EDGE_COUNT} edges')
@@ -1,25 +1,32 @@
 """FastAPI app."""
+import asyncio
+import time
+
 from fastapi import Body, Depends, FastAPI, Response, Request
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import ORJSONResponse, RedirectResponse
 from typing import Any, Dict, List
 from pydantic import ValidationError
 
-from reasoner_transpiler.exceptions import (
-    InvalidPredicateError, InvalidQualifierError, InvalidQualifierValueError, UnsupportedError
-)
 from PLATER.models.models_trapi_1_0 import (
     Message, ReasonerRequest, CypherRequest, SimpleSpecResponse, SimpleSpecElement, CypherResponse
 )
 from PLATER.models.shared import MetaKnowledgeGraph, SRITestData
+from PLATER.services.util.admission_control import Neo4jOverloadedError, Neo4jUnavailableError
+from PLATER.services.util.batch_query import BatchQuestion
 from PLATER.services.util.api_utils import (
-    get_graph_interface, get_example, CustomORJSONResponse
+    get_graph_interface, get_example, CustomORJSONResponse, StreamingTRAPIResponse, cancel_on_disconnect,
+    ClientDisconnectedError
 )
+from PLATER.services.util.attribute_mapping import prime_attribute_classifications
 from PLATER.services.util.bl_helper import BLHelper, get_bl_helper
 from PLATER.services.util.graph_adapter import GraphInterface
 from PLATER.services.util.metadata import get_graph_metadata, GraphMetadata
 from PLATER.services.util.overlay import Overlay
-from PLATER.services.util.question import Question
+from PLATER.services.util.paging import encode_page_token, decode_page_token, InvalidPageTokenError
+from PLATER.services.util.post_processing import run_post_processing, message_size, shutdown_post_processing
+from PLATER.services.util.question import Question, TRANSPILER_ERRORS
+from PLATER.services.util.response_cache import CanonicalQueryGraph, ResponseCache, get_response_cache
 from PLATER.services.config import config
 from PLATER.services.util.logutil import LoggingUtil
 
@@ -84,6 +91,7 @@ APP.add_api_route(
 
 
 async def reasoner_api(
+        http_request: Request,
         request: ReasonerRequest = Body(
             ...,
             example=TRAPI_QUERY_EXAMPLE,
@@ -92,7 +100,12 @@ async def reasoner_api(
         # it's here so that it's documented in the open api spec, and it's used by pyinstrument in profile_request
         profile: bool = False,
         validate: bool = False,
+        stream: bool = False,
+        timeout: float = None,
+        page_size: int = None,
+        page_token: str = None,
         graph_interface: GraphInterface = Depends(get_graph_interface),
+        response_cache: ResponseCache = Depends(get_response_cache),
 ) -> CustomORJSONResponse:
 
     """Handle /query TRAPI request."""
@@ -101,33 +114,100 @@ async def reasoner_api(
     workflow = request_json.get('workflow') or [{"id": "lookup"}]
     workflows = {wkfl['id']: wkfl for wkfl in workflow}
 
-    if 'lookup' in workflows:
-        question = Question(request_json["message"])
-        try:
-            response_message = await question.answer(graph_interface)
+    # neo4j work for the request is cancelled when the deadline passes or the client disconnects
+    query_timeout = graph_interface.query_timeout
+    deadline = time.time() + (min(timeout, query_timeout) if timeout else query_timeout)
+    try:
+        if 'lookup' in workflows:
+            question = Question(request_json["message"])
+            paged = bool(page_size or page_token)
+            # identical lookups are answered from the cache, however their nodes and edges are named,
+            # and pages are tied to the same canonical query graph
+            canonical_query_graph = CanonicalQueryGraph.create(request_json["message"]["query_graph"],
+                                                               results_limit=question.results_limit,
+                                                               subclass_depth=question.subclass_depth) \
+                if paged or response_cache.enabled else None
+            if paged:
+                # a page token continues the same query on the same graph, where the previous page ended
+                if canonical_query_graph is None:
+                    return CustomORJSONResponse(status_code=400,
+                                                content={"description": "Paging isn't supported for this query graph."},
+                                                media_type="application/json")
+                page_query_key = canonical_query_graph.key
+                graph_version = response_cache.get_graph_version()
+                try:
+                    page_offset, page_size = decode_page_token(page_token, page_query_key, graph_version) \
+                        if page_token else (0, page_size)
+                except InvalidPageTokenError as e:
+                    return CustomORJSONResponse(status_code=400, content={"description": str(e)},
+                                                media_type="application/json")
+                if page_size <= 0:
+                    return CustomORJSONResponse(status_code=400,
+                                                content={"description": "page_size must be positive."},
+                                                media_type="application/json")
+                question.set_page(page_size, page_offset)
+                # pages aren't cached
+                canonical_query_graph = None
+            cached_message = response_cache.get(canonical_query_graph) if canonical_query_graph else None
+            try:
+                if cached_message is not None:
+                    response_message = {**request_json["message"], **cached_message}
+                else:
+                    response_message = await cancel_on_disconnect(http_request,
+                                                                  question.answer(graph_interface, deadline=deadline),
+                                                                  deadline)
+                    # a truncated answer depends on the budget at the time, it isn't worth reusing
+                    if canonical_query_graph and not question.truncated:
+                        response_cache.put(canonical_query_graph, response_message)
+                request_json.update({'message': response_message, 'workflow': workflow})
+                if question.logs:
+                    request_json['logs'] = (request_json.get('logs') or []) + question.logs
+                if paged:
+                    request_json['next_page_token'] = encode_page_token(page_query_key,
+                                                                        question.page_offset + question.page_size,
+                                                                        question.page_size,
+                                                                        graph_version) \
+                        if question.has_next_page else None
+            except TRANSPILER_ERRORS as e:
+                return CustomORJSONResponse(status_code=400, content={"description": str(e)},
+                                            media_type="application/json")
+        elif 'overlay_connect_knodes' in workflows:
+            overlay = Overlay(graph_interface=graph_interface)
+            response_message = await cancel_on_disconnect(http_request,
+                                                          overlay.connect_k_nodes(request_json['message']),
+                                                          deadline)
             request_json.update({'message': response_message, 'workflow': workflow})
-        except (InvalidPredicateError, InvalidQualifierError, InvalidQualifierValueError, UnsupportedError) as e:
-            return CustomORJSONResponse(status_code=400, content={"description": str(e)}, media_type="application/json")
-    elif 'overlay_connect_knodes' in workflows:
-        overlay = Overlay(graph_interface=graph_interface)
-        response_message = await overlay.connect_k_nodes(request_json['message'])
-        request_json.update({'message': response_message, 'workflow': workflow})
-    elif 'annotate_nodes' in workflows:
-        overlay = Overlay(graph_interface=graph_interface)
-        response_message = await overlay.annotate_node(request_json['message'])
-        request_json.update({'message': response_message, 'workflow': workflow})
+        elif 'annotate_nodes' in workflows:
+            overlay = Overlay(graph_interface=graph_interface)
+            response_message = await cancel_on_disconnect(http_request,
+                                                          overlay.annotate_node(request_json['message']),
+                                                          deadline)
+            request_json.update({'message': response_message, 'workflow': workflow})
+    except asyncio.TimeoutError:
+        return CustomORJSONResponse(status_code=504,
+                                    content={"description": "Query did not complete within the time limit."},
+                                    media_type="application/json")
+    except ClientDisconnectedError:
+        logger.info('Client disconnected, cancelled the query.')
+        # nobody is listening anymore, 499 is the de facto status code for it
+        return Response(status_code=499)
 
     if validate:
         try:
             # Attempt to parse the request_json using the pydantic model, if it fails it will throw a ValidationError.
             # Don't save the pydantic object created, we're returning a CustomORJSONResponse instead.
-            ReasonerRequest.parse_obj(request_json)
+            await run_post_processing(ReasonerRequest.parse_obj, request_json,
+                                      size=message_size(request_json.get('message') or {}))
         except ValidationError as e:
             json_response = CustomORJSONResponse(content={"description": f"Validation Errors Occurred: {e.errors()}"},
                                                  media_type="application/json",
                                                  status_code=500)
             return json_response
 
+    if stream:
+        # write the knowledge graph and results as they are serialized, instead of building the whole json first
+        return StreamingTRAPIResponse(content=request_json)
+
     # we are intentionally returning a CustomORJSONResponse and not a pydantic model for performance reasons
     json_response = CustomORJSONResponse(content=request_json, media_type="application/json")
     return json_response
@@ -137,13 +217,80 @@ APP.add_api_route(
     reasoner_api,
     methods=["POST"],
     response_model=None,
-    responses={400: {"model": Dict}, 200: {"model": ReasonerRequest}},
+    responses={400: {"model": Dict}, 200: {"model": ReasonerRequest}, 504: {"model": Dict}},
     summary="Accepts TRAPI Queries.",
     description="Accepts a TRAPI Query and returns a TRAPI Response. (https://github.com/NCATSTranslator/ReasonerAPI/)",
     tags=["trapi"]
 )
 
 
+async def batch_reasoner_api(
+        http_request: Request,
+        requests: List[Dict[str, Any]] = Body(
+            ...,
+            example=[TRAPI_QUERY_EXAMPLE],
+        ),
+        timeout: float = None,
+        graph_interface: GraphInterface = Depends(get_graph_interface),
+) -> CustomORJSONResponse:
+
+    """Handle /query_batch TRAPI requests."""
+    # requests are validated one by one, so an invalid request is reported as an error for that request only
+    request_jsons = [None] * len(requests)
+    responses = [None] * len(requests)
+    lookups = []
+    for index, request in enumerate(requests):
+        try:
+            request_json = request_jsons[index] = ReasonerRequest.parse_obj(request).dict(by_alias=True)
+        except ValidationError as e:
+            responses[index] = {"status": 400, "description": f"Validation Errors Occurred: {e.errors()}"}
+            continue
+        # only lookups are batched, anything else is reported as an error for that request
+        workflow = request_json.get('workflow') or [{"id": "lookup"}]
+        if [wkfl['id'] for wkfl in workflow] != ['lookup']:
+            responses[index] = {"status": 400, "description": "Only the lookup workflow can be batched."}
+            continue
+        request_json['workflow'] = workflow
+        lookups.append(index)
+
+    query_timeout = graph_interface.query_timeout
+    deadline = time.time() + (min(timeout, query_timeout) if timeout else query_timeout)
+    batch_question = BatchQuestion([request_jsons[index]['message'] for index in lookups])
+    try:
+        outcomes = await cancel_on_disconnect(http_request,
+                                              batch_question.answer(graph_interface, deadline=deadline),
+                                              deadline)
+    except asyncio.TimeoutError:
+        return CustomORJSONResponse(status_code=504,
+                                    content={"description": "Query did not complete within the time limit."},
+                                    media_type="application/json")
+    except ClientDisconnectedError:
+        logger.info('Client disconnected, cancelled the batch query.')
+        return Response(status_code=499)
+
+    for index, question, outcome in zip(lookups, batch_question.questions, outcomes):
+        if outcome[0] == 'answer':
+            request_jsons[index]['message'] = outcome[1]
+            if question.logs:
+                request_jsons[index]['logs'] = (request_jsons[index].get('logs') or []) + question.logs
+            responses[index] = {"status": 200, "response": request_jsons[index]}
+        else:
+            responses[index] = {"status": outcome[1], "description": outcome[2]}
+    return CustomORJSONResponse(content=responses, media_type="application/json")
+
+APP.add_api_route(
+    "/query_batch",
+    batch_reasoner_api,
+    methods=["POST"],
+    response_model=None,
+    responses={200: {"model": List[Dict]}, 504: {"model": Dict}},
+    summary="Accepts a list of TRAPI lookup queries.",
+    description="Accepts a list of TRAPI Queries and returns a list with the status and TRAPI Response of each. "
+                "Queries differing only in their curies are answered with a single query to the graph.",
+    tags=["trapi"]
+)
+
+
 ###########################################
 # The following endpoints all come from the old app_common.py file, which was previously a different sub-application.
 ###########################################
@@ -294,6 +441,58 @@ APP.add_api_route(
 )
 
 
+async def neo4j_pool_stats(graph_interface: GraphInterface = Depends(get_graph_interface)) -> Dict:
+    """Handle /neo4j_pool_stats."""
+    return graph_interface.get_pool_stats()
+
+APP.add_api_route(
+    "/neo4j_pool_stats",
+    neo4j_pool_stats,
+    methods=["GET"],
+    response_model=Dict,
+    summary="Neo4j connection pool statistics.",
+    description="Returns the limits and current usage of this worker's connection pool to Neo4j.",
+)
+
+
+@APP.exception_handler(Neo4jOverloadedError)
+async def neo4j_overloaded_handler(request: Request, exc: Neo4jOverloadedError):
+    # shed load when too much work is already queued for neo4j
+    return CustomORJSONResponse(status_code=429,
+                                content={"description": str(exc)},
+                                headers={"Retry-After": str(exc.retry_after)},
+                                media_type="application/json")
+
+
+@APP.exception_handler(Neo4jUnavailableError)
+async def neo4j_unavailable_handler(request: Request, exc: Neo4jUnavailableError):
+    # fail fast while the circuit breaker considers neo4j unhealthy
+    return CustomORJSONResponse(status_code=503,
+                                content={"description": str(exc)},
+                                headers={"Retry-After": str(exc.retry_after)},
+                                media_type="application/json")
+
+
+@APP.on_event("startup")
+async def open_graph_interface():
+    # build the graph interface (and its neo4j driver) once per worker, and check that neo4j can be reached,
+    # before serving requests
+    await get_graph_interface().initialize()
+
+
+@APP.on_event("startup")
+async def classify_graph_attributes():
+    # formatting responses looks up how each attribute is formatted, do it up front for the attributes of the graph
+    prime_attribute_classifications(get_graph_metadata().get_meta_kg() or {})
+
+
+@APP.on_event("shutdown")
+async def close_graph_interface():
+    if GraphInterface.instance:
+        await GraphInterface.instance.close()
+    shutdown_post_processing()
+
+
 async def redirect_to_docs():
     return RedirectResponse(url="/docs")
 
@@ -0,0 +1,260 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+
+from PLATER.services.config import config
+from PLATER.services.util.logutil import LoggingUtil
+
+logger = LoggingUtil.init_logging(__name__,
+                                  config.get('logging_level'),
+                                  config.get('logging_format')
+                                  )
+
+
+class Neo4jOverloadedError(Exception):
+    """
+    Raised when a query can't be admitted because too much work is already in flight to neo4j.
+    """
+    def __init__(self, message, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Neo4jUnavailableError(Exception):
+    """
+    Raised without contacting neo4j while the circuit breaker considers it unhealthy.
+    """
+    def __init__(self, message, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of queries in flight to neo4j, adapting the limit with AIMD.
+    The limit grows additively while query latencies stay close to their long term average and is cut
+    multiplicatively when latencies climb well above it, or a query fails. Queries over the limit wait in a bounded
+    queue for a bounded time, after that they are rejected.
+    """
+    def __init__(self,
+                 initial_limit: int = 20,
+                 min_limit: int = 1,
+                 max_limit: int = 100,
+                 max_queue: int = 100,
+                 queue_timeout: float = 30,
+                 latency_tolerance: float = 2.0,
+                 backoff_ratio: float = 0.9,
+                 baseline_decay: float = 0.05):
+        """
+        :param initial_limit: starting number of concurrent queries
+        :param min_limit: the limit never goes below this
+        :param max_limit: the limit never goes above this
+        :param max_queue: max number of queries waiting for a slot
+        :param queue_timeout: seconds a query waits for a slot before it's rejected
+        :param latency_tolerance: latencies above baseline * latency_tolerance count as congestion
+        :param backoff_ratio: the limit is multiplied by this on congestion
+        :param baseline_decay: weight of each new latency sample in the baseline moving average
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        self.baseline_decay = baseline_decay
+        self.latency_baseline = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            if not self._has_capacity():
+                if self.waiting >= self.max_queue:
+                    self.rejected += 1
+                    raise Neo4jOverloadedError('Too many queries are waiting for neo4j, try again later.',
+                                               retry_after=int(self.queue_timeout))
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(condition.wait_for(self._has_capacity), timeout=self.queue_timeout)
+                except asyncio.TimeoutError:
+                    self.rejected += 1
+                    raise Neo4jOverloadedError(f'Waited {self.queue_timeout} seconds for neo4j capacity, '
+                                               f'try again later.', retry_after=int(self.queue_timeout))
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+
+    async def release(self, latency: float, success: bool, adjust: bool = True):
+        """
+        :param latency: seconds the query took
+        :param success: whether neo4j handled the query, failures cut the limit
+        :param adjust: whether the query says anything about neo4j's capacity, cancelled queries and queries with
+            errors don't, they leave the limit and the latency baseline alone
+        """
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            if adjust:
+                self._adjust_limit(latency, success)
+            condition.notify_all()
+
+    def _adjust_limit(self, latency: float, success: bool):
+        congested = not success or (self.latency_baseline is not None and
+                                    latency > self.latency_baseline * self.latency_tolerance)
+        if congested:
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+        else:
+            # grows by about one per limit's worth of completed queries
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        if success:
+            self.latency_baseline = latency if self.latency_baseline is None else \
+                self.baseline_decay * latency + (1 - self.baseline_decay) * self.latency_baseline
+
+    def get_stats(self) -> dict:
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+            'latency_baseline': self.latency_baseline
+        }
+
+
+class CircuitBreaker:
+    """
+    Fails fast while neo4j is unhealthy.
+    After failure_threshold consecutive failures the breaker opens and rejects queries for reset_timeout seconds.
+    Then a single trial query is let through, closing the breaker if it succeeds and opening it again if it fails.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def check(self):
+        """
+        Raises Neo4jUnavailableError if a query shouldn't be sent to neo4j right now.
+        """
+        if self.state == CircuitBreaker.CLOSED:
+            return
+        if self.state == CircuitBreaker.OPEN:
+            remaining = self.reset_timeout - (time.time() - self.opened_at)
+            if remaining > 0:
+                raise Neo4jUnavailableError('Neo4j is currently unavailable, try again later.',
+                                            retry_after=max(1, int(remaining)))
+            # let one trial query through
+            self.state = CircuitBreaker.HALF_OPEN
+            return
+        # a trial query is already running
+        raise Neo4jUnavailableError('Neo4j is currently unavailable, try again later.',
+                                    retry_after=max(1, int(self.reset_timeout)))
+
+    def record_success(self):
+        if self.state != CircuitBreaker.CLOSED:
+            logger.info('Neo4j is responding again, closing circuit breaker.')
+        self.state = CircuitBreaker.CLOSED
+        self.consecutive_failures = 0
+
+    def record_abandoned(self):
+        """
+        The trial query ended without saying anything about neo4j, e.g. it was cancelled, the next query is the trial.
+        """
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self.state = CircuitBreaker.OPEN
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == CircuitBreaker.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != CircuitBreaker.OPEN:
+                logger.error(f'Neo4j failed {self.consecutive_failures} times in a row, opening circuit breaker.')
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = time.time()
+
+    def get_stats(self) -> dict:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures
+        }
+
+
+class AdmissionController:
+    """
+    Admission control for queries to neo4j, combining the adaptive concurrency limiter and the circuit breaker.
+    """
+    # failures that say something about the health of neo4j, as opposed to an error in a query
+    health_errors = (httpx.TransportError, RuntimeError)
+
+    def __init__(self, limiter: AdaptiveConcurrencyLimiter, circuit_breaker: CircuitBreaker, health_errors=None):
+        """
+        :param limiter: limits the number of queries in flight
+        :param circuit_breaker: rejects queries while neo4j is unhealthy
+        :param health_errors: tuple of exceptions counted as neo4j failures by the circuit breaker
+        """
+        self.limiter = limiter
+        self.circuit_breaker = circuit_breaker
+        if health_errors is not None:
+            self.health_errors = health_errors
+
+    @asynccontextmanager
+    async def admit(self):
+        """
+        Waits for capacity to run a query, raising Neo4jOverloadedError or Neo4jUnavailableError if it can't be run.
+        """
+        self.circuit_breaker.check()
+        # the query that moved the breaker to half open is its trial, it has to settle the breaker however it ends
+        trial = self.circuit_breaker.state == CircuitBreaker.HALF_OPEN
+        acquired = False
+        start_time = None
+        # 'success', 'failure' of neo4j, 'error' in the query, or None if the query didn't complete
+        outcome = None
+        try:
+            await self.limiter.acquire()
+            acquired = True
+            start_time = time.time()
+            yield
+            outcome = 'success'
+        except self.health_errors:
+            if acquired:
+                outcome = 'failure'
+            raise
+        except Exception:
+            # neo4j answered, the query itself was at fault
+            if acquired:
+                outcome = 'error'
+            raise
+        finally:
+            if outcome == 'failure':
+                self.circuit_breaker.record_failure()
+            elif outcome is not None:
+                self.circuit_breaker.record_success()
+            elif trial:
+                self.circuit_breaker.record_abandoned()
+            if acquired:
+                await self.limiter.release(time.time() - start_time, success=outcome != 'failure',
+                                           adjust=outcome in ('success', 'failure'))
+
+    def get_stats(self) -> dict:
+        return {
+            'concurrency': self.limiter.get_stats(),
+            'circuit_breaker': self.circuit_breaker.get_stats()
+        }
@@ -1,9 +1,12 @@
+import asyncio
+import time
 import yaml
 import json
 import os
 import orjson
 
-from fastapi import Response
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.openapi.utils import get_openapi
 
 from PLATER.services.util.graph_adapter import GraphInterface
@@ -12,15 +15,36 @@ from PLATER.services.config import config
 
 def get_graph_interface():
     """Get graph interface."""
+    protocol = config.get('NEO4J_PROTOCOL', 'http')
     return GraphInterface(
         host=config.get('NEO4J_HOST'),
-        port=config.get('NEO4J_HTTP_PORT'),
+        port=config.get('NEO4J_BOLT_PORT', 7687) if protocol == 'bolt' else config.get('NEO4J_HTTP_PORT'),
         auth=(
             config.get('NEO4J_USERNAME'),
             config.get('NEO4J_PASSWORD')
         ),
         query_timeout=int(config.get('NEO4J_QUERY_TIMEOUT')),
-        bl_version=config.get('BL_VERSION')
+        bl_version=config.get('BL_VERSION'),
+        driver_settings={
+            'max_connections': int(config.get('NEO4J_MAX_CONNECTIONS', 100)),
+            'max_keepalive_connections': int(config.get('NEO4J_MAX_KEEPALIVE_CONNECTIONS', 20)),
+            'keepalive_expiry': float(config.get('NEO4J_KEEPALIVE_EXPIRY', 30)),
+            'http2': config.get('NEO4J_HTTP2', 'false') not in ('false', 'False'),
+            'compression': config.get('NEO4J_COMPRESSION', 'true') not in ('false', 'False'),
+            'replica_probe_interval': float(config.get('NEO4J_REPLICA_PROBE_INTERVAL', 10))
+        },
+        protocol=protocol,
+        stream_responses=config.get('NEO4J_STREAM_RESPONSES', 'false') not in ('false', 'False'),
+        admission_settings={
+            'initial_limit': int(config.get('NEO4J_INITIAL_CONCURRENCY', 20)),
+            'min_limit': int(config.get('NEO4J_MIN_CONCURRENCY', 1)),
+            'max_limit': int(config.get('NEO4J_MAX_CONCURRENCY', config.get('NEO4J_MAX_CONNECTIONS', 100))),
+            'max_queue': int(config.get('NEO4J_MAX_QUEUED_QUERIES', 100)),
+            'queue_timeout': float(config.get('NEO4J_QUEUE_TIMEOUT', 30)),
+            'failure_threshold': int(config.get('NEO4J_CIRCUIT_BREAKER_FAILURES', 5)),
+            'reset_timeout': float(config.get('NEO4J_CIRCUIT_BREAKER_RESET', 30))
+        },
+        cancellable_transactions=config.get('NEO4J_CANCELLABLE_TRANSACTIONS', 'false') not in ('false', 'False')
     )
 
 
@@ -113,3 +137,106 @@ class CustomORJSONResponse(Response):
     def render(self, content: dict) -> bytes:
         return orjson.dumps(content,
                             default=orjson_default)
+
+
+def _consume_items(mapping: dict):
+    # hands out the items of a dict, removing them so they can be freed once they're written
+    for key in list(mapping.keys()):
+        yield key, mapping.pop(key)
+
+
+def iter_trapi_json(content: dict, buffer_size: int = 65536):
+    """
+    Serializes a TRAPI response to json piece by piece. The knowledge graph nodes and edges and the results are
+    written one at a time and removed from the content, so the complete json is never held in memory.
+    :param content: TRAPI response, it's emptied while it's written
+    :param buffer_size: bytes collected before a piece is yielded
+    :return: generator of json bytes
+    """
+    buffer = bytearray()
+
+    def write_dict(mapping: dict, streamed_keys: dict):
+        buffer.extend(b'{')
+        for index, (key, value) in enumerate(_consume_items(mapping)):
+            if index:
+                buffer.extend(b',')
+            buffer.extend(orjson.dumps(key))
+            buffer.extend(b':')
+            if key in streamed_keys and isinstance(value, (dict, list)):
+                yield from streamed_keys[key](value)
+            else:
+                buffer.extend(orjson.dumps(value, default=orjson_default))
+            if len(buffer) >= buffer_size:
+                yield bytes(buffer)
+                buffer.clear()
+        buffer.extend(b'}')
+
+    def write_list(items: list):
+        buffer.extend(b'[')
+        for index in range(len(items)):
+            if index:
+                buffer.extend(b',')
+            buffer.extend(orjson.dumps(items[index], default=orjson_default))
+            items[index] = None
+            if len(buffer) >= buffer_size:
+                yield bytes(buffer)
+                buffer.clear()
+        buffer.extend(b']')
+
+    def write_entries(mapping: dict):
+        return write_dict(mapping, {})
+
+    def write_knowledge_graph(knowledge_graph: dict):
+        return write_dict(knowledge_graph, {'nodes': write_entries, 'edges': write_entries})
+
+    def write_message(message: dict):
+        return write_dict(message, {'knowledge_graph': write_knowledge_graph, 'results': write_list})
+
+    yield from write_dict(content, {'message': write_message})
+    yield bytes(buffer)
+
+
+class StreamingTRAPIResponse(StreamingResponse):
+    """
+    Response writing a TRAPI response as chunked json while it is serialized.
+    """
+    def __init__(self, content: dict, **kwargs):
+        kwargs.setdefault('media_type', 'application/json')
+        super().__init__(iter_trapi_json(content), **kwargs)
+
+
+class ClientDisconnectedError(Exception):
+    pass
+
+
+async def cancel_on_disconnect(http_request: Request, coroutine, deadline: float, poll_interval: float = 1):
+    """
+    Runs a coroutine, cancelling it when the client disconnects or the deadline passes before it completes.
+    Cancelling makes the graph adapter roll back the neo4j work still running for the request.
+    :param http_request: request the coroutine is answering
+    :param coroutine: coroutine to run
+    :param deadline: epoch seconds after which the coroutine is cancelled
+    :param poll_interval: seconds between checks whether the client is still connected
+    :return: result of the coroutine
+    :raises asyncio.TimeoutError: if the deadline passed
+    :raises ClientDisconnectedError: if the client disconnected
+    """
+    task = asyncio.ensure_future(coroutine)
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            done, _ = await asyncio.wait({task}, timeout=min(poll_interval, remaining))
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                raise ClientDisconnectedError()
+    finally:
+        if not task.done():
+            task.cancel()
+            # wait for the cancellation, so neo4j transactions are rolled back before moving on
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
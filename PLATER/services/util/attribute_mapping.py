@@ -1,6 +1,9 @@
 import json
 import os
+import sys
 from functools import cache
+from typing import NamedTuple, Optional
+from reasoner_transpiler.cypher import ATTRIBUTE_TYPES as TRANSPILER_ATTRIBUTE_TYPES
 from PLATER.services.util.bl_helper import get_biolink_model_toolkit
 
 bmt_toolkit = get_biolink_model_toolkit()
@@ -14,6 +17,8 @@ skip_list = json.load(open(os.path.join(os.path.abspath(os.path.dirname(__file__
 # set the value type mappings
 VALUE_TYPES = map_data['value_type_map']
 
+skip_set = set(skip_list)
+
 
 @cache
 def get_attribute_info(attribute_name, attribute_type_id):
@@ -53,3 +58,97 @@ def get_attribute_info(attribute_name, attribute_type_id):
     return new_attr_meta_data
 
 
+# properties never returned as attributes, so constraints on them can't be checked against them
+CORE_PROPERTIES = {'id', 'name', 'category', 'categories', 'predicate', 'subject', 'object'}
+
+
+@cache
+def get_attribute_property(attribute_type_id):
+    """
+    Finds the graph property holding the attributes of an attribute_type_id, so attribute constraints can be checked
+    in neo4j. Constraints checked in neo4j aren't checked on the response anymore, so this assumes the property maps
+    to the attribute_type_id the same way with or without the type the transpiler returns with it. A property
+    mapped differently either way isn't used, and neither is the attribute_type_id.
+    :param attribute_type_id: attribute_type_id of an attribute constraint
+    :return: property name, or None if there isn't exactly one property for it
+    """
+    candidates = set()
+    if attribute_type_id.startswith('biolink:'):
+        candidates.add(attribute_type_id.removeprefix('biolink:'))
+    candidates.update(attribute_name.strip('`') for attribute_name, mapped_type_id
+                      in map_data['attribute_type_map'].items() if mapped_type_id == attribute_type_id)
+    candidates.update(attribute_name for attribute_name, transpiler_type_id in TRANSPILER_ATTRIBUTE_TYPES.items()
+                      if transpiler_type_id == attribute_type_id)
+    properties = []
+    for attribute_name in candidates:
+        if attribute_name in CORE_PROPERTIES or attribute_name in skip_list or '`' in attribute_name \
+                or bmt_toolkit.is_qualifier(attribute_name):
+            continue
+        mapped_type_ids = {get_attribute_info(attribute_name, None)['attribute_type_id'],
+                           get_attribute_info(attribute_name,
+                                              TRANSPILER_ATTRIBUTE_TYPES.get(attribute_name))['attribute_type_id']}
+        if attribute_type_id not in mapped_type_ids:
+            continue
+        if len(mapped_type_ids) > 1:
+            # neo4j and the response would disagree on which attributes the constraint applies to
+            return None
+        properties.append(attribute_name)
+    return properties[0] if len(properties) == 1 else None
+
+
+class AttributeClassification(NamedTuple):
+    # interned original_attribute_name, an empty string instead of None
+    attribute_name: str
+    is_qualifier: bool
+    skip: bool
+    # biolink prefixed qualifier_type_id, for qualifiers
+    qualifier_type_id: Optional[str]
+    # attribute_type_id and value_type_id mapped by get_attribute_info, for other attributes
+    attribute_info: Optional[dict]
+
+
+# classification of attributes by original_attribute_name and the attribute_type_id neo4j returned with it
+attribute_classifications = {}
+
+
+def classify_attribute(attribute_name, attribute_type_id=None) -> AttributeClassification:
+    """
+    Returns how an attribute is formatted, everything that depends only on its name and attribute_type_id.
+    Classifications are computed once per name and kept in attribute_classifications.
+    :param attribute_name: original_attribute_name of the attribute
+    :param attribute_type_id: attribute_type_id returned with the attribute, if any
+    :return: classification of the attribute
+    """
+    # get_attribute_info treats a missing attribute_type_id and the transpiler's 'NA' alike
+    if not attribute_type_id or attribute_type_id == 'NA':
+        attribute_type_id = None
+    key = (attribute_name, attribute_type_id)
+    classification = attribute_classifications.get(key)
+    if classification is None:
+        is_qualifier = bool(bmt_toolkit.is_qualifier(attribute_name))
+        skip = attribute_name in skip_set
+        classification = attribute_classifications[key] = AttributeClassification(
+            attribute_name=sys.intern(attribute_name or ''),
+            is_qualifier=is_qualifier,
+            skip=skip,
+            qualifier_type_id=sys.intern(attribute_name if attribute_name.startswith('biolink:')
+                                         else f'biolink:{attribute_name}') if is_qualifier else None,
+            attribute_info=get_attribute_info(attribute_name or '', attribute_type_id)
+            if not (is_qualifier or skip) else None
+        )
+    return classification
+
+
+def prime_attribute_classifications(meta_kg: dict):
+    """
+    Classifies the attributes listed in the meta knowledge graph up front, so responses don't pay for it. They are
+    classified with the attribute_type_id the transpiler returns with them, like in responses.
+    :param meta_kg: TRAPI meta knowledge graph
+    """
+    meta_attributes = [attribute for node in (meta_kg.get('nodes') or {}).values()
+                       for attribute in (node.get('attributes') or [])]
+    meta_attributes += [attribute for edge in (meta_kg.get('edges') or [])
+                        for attribute in (edge.get('attributes') or [])]
+    for attribute in meta_attributes:
+        for attribute_name in attribute.get('original_attribute_names') or []:
+            classify_attribute(attribute_name, TRANSPILER_ATTRIBUTE_TYPES.get(attribute_name))
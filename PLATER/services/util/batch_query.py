@@ -0,0 +1,146 @@
+import asyncio
+import re
+import time
+
+from PLATER.services.config import config
+from PLATER.services.util.admission_control import Neo4jOverloadedError, Neo4jUnavailableError
+from PLATER.services.util.graph_adapter import GraphInterface, ResponseBudgetExceeded
+from PLATER.services.util.logutil import LoggingUtil
+from PLATER.services.util.post_processing import run_post_processing, message_size
+from PLATER.services.util.question import Question, TRANSPILER_ERRORS
+
+logger = LoggingUtil.init_logging(
+    __name__,
+    config.get('logging_level'),
+    config.get('logging_format'),
+)
+
+# name of the map holding the parameters of one lookup inside a batched cypher query
+BATCH_PARAMETERS = 'batch_parameters'
+BATCH_INDEX = 'batch_index'
+
+
+def get_error_status(error: Exception) -> int:
+    """
+    Returns the http status reported for a lookup of a batch that failed with the given error.
+    """
+    if isinstance(error, Neo4jOverloadedError):
+        return 429
+    if isinstance(error, Neo4jUnavailableError):
+        return 503
+    if isinstance(error, asyncio.TimeoutError):
+        return 504
+    return 500
+
+
+def compile_batch_cypher(cypher: str) -> str:
+    """
+    Wraps a compiled lookup in a cypher query running it once per entry of the $batch list.
+    Each entry is a map of the parameters of one lookup and its batch index, every returned row includes that map.
+    :param cypher: compiled cypher of the lookup, with its curies as $id_N / $ids_N parameters and its attribute
+        constraint values as $constraint_N parameters
+    :return: batched cypher
+    :rtype: str
+    """
+    correlated_cypher = re.sub(r'\$((?:ids?|constraint)_\d+)\b', rf'{BATCH_PARAMETERS}.\1', cypher)
+    return f"UNWIND $batch AS {BATCH_PARAMETERS} " \
+           f"CALL {{ WITH {BATCH_PARAMETERS} {correlated_cypher} }} " \
+           f"RETURN *"
+
+
+class BatchQuestion:
+    """
+    Answers many lookups at once. Lookups compiling to the same cypher template only differ in their parameters, they
+    are sent to neo4j as one UNWIND query and the rows are handed back to the lookup they belong to.
+    """
+
+    def __init__(self, messages: list, max_batch_size: int = None):
+        """
+        :param messages: TRAPI messages, the batch takes ownership of them like Question does
+        :param max_batch_size: most lookups sent to neo4j in one query
+        """
+        self.questions = [Question(message) for message in messages]
+        self.max_batch_size = max_batch_size or \
+            Question.get_positive_int_from_config('BATCH_QUERY_MAX_SIZE', 100) or 100
+        # one entry per message, either ('answer', message) or ('error', status code, description)
+        self.outcomes = [None] * len(self.questions)
+
+    def _group_by_template(self) -> list:
+        groups = {}
+        # lookups pinning more curies than a chunk are split into chunks like in /query, instead of being batched
+        chunked_lookups = []
+        for index, question in enumerate(self.questions):
+            try:
+                cypher, parameters = question.compile_cypher(**question.get_query_kwargs())
+            except TRANSPILER_ERRORS as e:
+                self.outcomes[index] = ('error', 400, str(e))
+                continue
+            if len(question.chunk_parameters(parameters)) > 1:
+                chunked_lookups.append((cypher, [(index, parameters)]))
+                continue
+            groups.setdefault(cypher, []).append((index, parameters))
+        return list(groups.items()) + chunked_lookups
+
+    async def _answer_one(self, graph_interface: GraphInterface, cypher: str, index: int, parameters: dict,
+                          deadline: float):
+        # chunked and truncated like a lookup sent to /query
+        rows = await self.questions[index].run_lookup(graph_interface, cypher, parameters, deadline)
+        self.outcomes[index] = ('answer', await run_post_processing(self.questions[index].answer_from_results,
+                                                                    rows[0], size=message_size(rows[0])))
+
+    async def _answer_batch(self, graph_interface: GraphInterface, cypher: str, batch: list, deadline: float):
+        batch_parameters = [{**parameters, BATCH_INDEX: index} for index, parameters in batch]
+        # the lookups of a batch share their byte budgets
+        byte_budget = self.questions[batch[0][0]].response_byte_budget
+        budget_kwargs = {'byte_budget': byte_budget * len(batch)} if byte_budget else {}
+        try:
+            rows = await graph_interface.run_cypher_rows(compile_batch_cypher(cypher),
+                                                         parameters={'batch': batch_parameters},
+                                                         deadline=deadline, **budget_kwargs)
+        except ResponseBudgetExceeded as e:
+            # the lookups are answered one by one instead, so only the ones exceeding their own budget are truncated
+            logger.warning(f'{e} Answering the {len(batch)} lookups of the batch one by one.')
+            await asyncio.gather(*[self._answer_one(graph_interface, cypher, index, parameters, deadline)
+                                   for index, parameters in batch])
+            return
+        rows_by_index = {}
+        for row in rows:
+            rows_by_index[row.pop(BATCH_PARAMETERS)[BATCH_INDEX]] = row
+        for index, _ in batch:
+            # lookups without a single match may not produce a row at all
+            results = rows_by_index.get(index) or {'knowledge_graph': {'nodes': {}, 'edges': {}}, 'results': []}
+            self.outcomes[index] = ('answer', await run_post_processing(self.questions[index].answer_from_results,
+                                                                        results, size=message_size(results)))
+
+    async def _run_group(self, graph_interface: GraphInterface, cypher: str, batch: list, deadline: float):
+        try:
+            if len(batch) == 1:
+                await self._answer_one(graph_interface, cypher, *batch[0], deadline)
+            else:
+                await self._answer_batch(graph_interface, cypher, batch, deadline)
+        except Exception as e:
+            # a failing group doesn't take the rest of the batch down with it, cancellation still propagates
+            logger.error(f'Batch of {len(batch)} lookups failed: {e!r}')
+            status = get_error_status(e)
+            for index, _ in batch:
+                # lookups of the group answered before the failure keep their answer
+                if self.outcomes[index] is None:
+                    self.outcomes[index] = ('error', status, str(e) or type(e).__name__)
+
+    async def answer(self, graph_interface: GraphInterface, deadline: float = None) -> list:
+        """
+        Answers all the lookups, with as few neo4j queries as possible.
+        :param graph_interface: interface for neo4j
+        :param deadline: epoch seconds after which neo4j should stop working on the queries
+        :return: outcome per message, ('answer', message) or ('error', status code, description)
+        """
+        runs = []
+        for cypher, lookups in self._group_by_template():
+            for start in range(0, len(lookups), self.max_batch_size):
+                runs.append(self._run_group(graph_interface, cypher, lookups[start: start + self.max_batch_size],
+                                            deadline))
+        start_time = time.time()
+        await asyncio.gather(*runs)
+        logger.info(f'answered {len(self.questions)} lookups with {len(runs)} neo4j queries '
+                    f'in {time.time() - start_time} seconds')
+        return self.outcomes
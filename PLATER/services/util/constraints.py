@@ -1,11 +1,16 @@
 from collections.abc import Iterable, MutableSequence
+from functools import lru_cache
 from reasoner_pydantic.qgraph import AttributeConstraint, Operator as OperatorModel
 from reasoner_pydantic.shared import Attribute, HashableSequence
-from typing import List
+from typing import Callable, List
 import re
 import numbers
 
 
+@lru_cache(maxsize=1024)
+def compile_regex(pattern: str):
+    return re.compile(pattern)
+
 
 class Operator:
     """
@@ -82,7 +87,7 @@ class MatchesOperator(Operator):
 
         if isinstance(a, str):
             try:
-                expr = re.compile(a)
+                expr = compile_regex(a)
                 return bool(expr.match(b))
             except Exception:
                 raise Exception
@@ -114,6 +119,79 @@ operator_map = {
 }
 
 
+def _plain(value):
+    # unwraps pydantic custom root types, like the CURIE of an attribute_type_id or a HashableSequence value
+    return value.__root__ if hasattr(value, '__root__') else value
+
+
+def compile_attribute_constraint(attribute_constraint: AttributeConstraint) -> Callable:
+    """
+    Compiles a constraint to a function checking a value, so the constraint value is unwrapped, regexes are compiled
+    and lists are turned into sets once instead of for every value.
+    :param attribute_constraint: constraint
+    :return: function returning a boolean indicating if the constraint is satisfied for a value
+    """
+    op = operator_map[attribute_constraint.operator]
+    constraint_val = _plain(attribute_constraint.value)
+    negated = bool(attribute_constraint.negated)
+    if isinstance(op, MatchesOperator) and isinstance(constraint_val, str):
+        expr = compile_regex(constraint_val)
+
+        def check_match(db_value):
+            return (isinstance(db_value, str) and bool(expr.match(db_value))) != negated
+        return check_match
+    if isinstance(op, EqualToOperator) and op.is_iterable(constraint_val):
+        try:
+            constraint_set = frozenset(constraint_val)
+        except TypeError:
+            constraint_set = constraint_val
+
+        def check_any_equal(db_value):
+            if not op.is_iterable(db_value):
+                return negated
+            try:
+                return any(x in constraint_set for x in db_value) != negated
+            except TypeError:
+                # unhashable values can't be looked up in the set
+                return any(x in constraint_val for x in db_value) != negated
+        return check_any_equal
+
+    def check(db_value):
+        return op(constraint_val, db_value) != negated
+    return check
+
+
+def compile_attribute_constraints(attribute_constraints: List[AttributeConstraint]) -> Callable:
+    """
+    Compiles constraints to a function checking if all of them pass for a list of attributes. The attributes are
+    plain dicts, indexed by attribute_type_id once instead of scanned once per constraint.
+    :param attribute_constraints: list of constraints
+    :return: function returning a boolean indicating if the constraints are satisfied for a list of attribute dicts
+    """
+    checks = [(_plain(constraint.id), compile_attribute_constraint(constraint))
+              for constraint in attribute_constraints]
+    constrained_types = {attribute_type_id for attribute_type_id, _ in checks}
+
+    def check(db_attributes: list):
+        values_by_type = {}
+        for db_attribute in db_attributes:
+            attribute_type_id = db_attribute.get('attribute_type_id')
+            if attribute_type_id in constrained_types:
+                values_by_type.setdefault(attribute_type_id, []).append(db_attribute.get('value'))
+        for attribute_type_id, check_value in checks:
+            values = values_by_type.get(attribute_type_id)
+            # if constraint id doesn't exist in the list of attributes then no match
+            if not values:
+                return False
+            # if any constraint fails then no match , i.e `AND`ing constraints
+            for value in values:
+                if not check_value(value):
+                    return False
+        # All constraints are satisfied
+        return True
+    return check
+
+
 def check_attribute_constraint(attribute_constraint: AttributeConstraint, db_value):
     """
     Checks if a constraint is full filled for a value
@@ -121,12 +199,7 @@ def check_attribute_constraint(attribute_constraint: AttributeConstraint, db_val
     :param db_value: value
     :return: boolean indicating if constraint is satisfied
     """
-    op = operator_map[attribute_constraint.operator]
-    constraint_val = attribute_constraint.value.__root__ if isinstance(attribute_constraint.value, HashableSequence) \
-        else attribute_constraint.value
-    result = op(constraint_val, db_value)
-    # handle negation
-    return result if not attribute_constraint.negated else not result
+    return compile_attribute_constraint(attribute_constraint)(db_value)
 
 
 def check_attributes(attribute_constraints: List[AttributeConstraint], db_attributes: List[Attribute]):
@@ -136,19 +209,10 @@ def check_attributes(attribute_constraints: List[AttributeConstraint], db_attrib
     :param db_attributes: attributes from db
     :return: boolean indicating if constrains are satisfied
     """
-    for constraint in attribute_constraints:
-        constraint_is_applied = False
-        for db_attribute in db_attributes:
-            if db_attribute.attribute_type_id == constraint.id:
-                constraint_is_applied = True
-                # if any constraint fails then no match , i.e `AND`ing constraints
-                if not check_attribute_constraint(constraint, db_attribute.value):
-                    return False
-        # if constraint id doesn't exist in the list of attributes then no match
-        if not constraint_is_applied:
-            return False
-    # All constraints are satisfied
-    return True
+    return compile_attribute_constraints(attribute_constraints)(
+        [{'attribute_type_id': _plain(db_attribute.attribute_type_id), 'value': db_attribute.value}
+         for db_attribute in db_attributes]
+    )
 
 
 
@@ -1,51 +1,461 @@
+import asyncio
 import base64
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
 import traceback
 import httpx
+import ijson
+import orjson
 import time
 from opentelemetry import trace
 from collections import defaultdict
 from PLATER.services.config import config
 from PLATER.services.util.logutil import LoggingUtil
 from PLATER.services.util.bl_helper import get_biolink_model_toolkit
+from PLATER.services.util.admission_control import AdaptiveConcurrencyLimiter, AdmissionController, CircuitBreaker
 
 logger = LoggingUtil.init_logging(__name__,
                                   config.get('logging_level'),
                                   config.get('logging_format')
                                   )
 
-class Neo4jHTTPDriver:
-    def __init__(self, host: str, port: int,  auth: tuple, scheme: str = 'http'):
+class ResponseBudgetExceeded(Exception):
+    """
+    Raised when a neo4j response grows beyond its byte budget while it is being read.
+    """
+    def __init__(self, byte_budget: int):
+        super().__init__(f'Neo4j response exceeded its budget of {byte_budget} bytes.')
+        self.byte_budget = byte_budget
+        # the row being parsed when the budget ran out, as far as it got, its last items may be incomplete
+        self.partial_row = None
+
+
+class Neo4jServerError(RuntimeWarning):
+    """
+    Raised when neo4j answers a request with a server error status, as opposed to an error in the query.
+    """
+    def __init__(self, message: str, response=None):
+        super().__init__(message)
+        # what neo4j answered, the decoded json body if it was json
+        self.response = response
+
+
+class _AsyncResponseReader:
+    """
+    Async file-like wrapper around a streamed httpx response, so ijson can parse it as the bytes arrive.
+    Compressed responses are decompressed chunk by chunk by httpx.
+    """
+    def __init__(self, response: httpx.Response, byte_budget: int = None):
+        self._chunks = response.aiter_bytes()
+        # number of decoded bytes handed to the parser
+        self.bytes_read = 0
+        # most decoded bytes read before giving up on the response
+        self.byte_budget = byte_budget
+
+    async def read(self, size=-1):
+        # ijson probes the stream type with a zero length read, don't consume a chunk for it
+        if size == 0:
+            return b''
+        # an empty read means end of stream to ijson, so skip over any empty chunks
+        async for chunk in self._chunks:
+            if chunk:
+                self.bytes_read += len(chunk)
+                if self.byte_budget and self.bytes_read > self.byte_budget:
+                    raise ResponseBudgetExceeded(self.byte_budget)
+                return chunk
+        return b''
+
+
+async def parse_transaction_rows(reader, errors: list):
+    """
+    Incrementally parses a neo4j http transactional api response, yielding each row as a dict of column name to value.
+    Row metadata is skipped and never built. Errors reported by neo4j are appended to `errors`, they are only complete
+    once the generator is exhausted.
+    If the reader runs out of its byte budget, the ResponseBudgetExceeded it raises carries the row parsed so far.
+    :param reader: async file-like object with the response body
+    :param errors: list to collect neo4j errors in
+    """
+    columns = []
+    row_builder = None
+    try:
+        async for prefix, event, value in ijson.parse_async(reader, use_float=True):
+            if row_builder is not None:
+                row_builder.event(event, value)
+                if prefix == 'results.item.data.item.row' and event == 'end_array':
+                    yield dict(zip(columns, row_builder.value))
+                    row_builder = None
+            elif prefix == 'results.item.data.item.row' and event == 'start_array':
+                row_builder = ijson.ObjectBuilder()
+                row_builder.event(event, value)
+            elif prefix == 'results.item' and event == 'start_map':
+                columns = []
+            elif prefix == 'results.item.columns.item':
+                columns.append(value)
+            elif prefix == 'errors.item' and event == 'start_map':
+                errors.append({})
+            elif prefix.startswith('errors.item.') and event in ('string', 'number'):
+                errors[-1][prefix[len('errors.item.'):]] = value
+    except ResponseBudgetExceeded as e:
+        if row_builder is not None:
+            # the builder fills its containers in place, so the row holds everything parsed up to the cut
+            e.partial_row = dict(zip(columns, row_builder.value))
+        raise
+
+
+class Neo4jDriver(ABC):
+    """
+    Base class for the neo4j drivers used by GraphInterface.
+    Drivers return query results shaped like the neo4j http transactional api response,
+    {"results": [{"columns": [...], "data": [{"row": [...], "meta": [...]}]}], "errors": [...]},
+    regardless of the protocol used to talk to neo4j.
+    """
+
+    _supports_apoc = None
+    # exceptions that mean neo4j could not be reached, as opposed to errors in a query
+    connection_errors = ()
+    # exceptions that mean neo4j didn't answer in time, which overloaded instances do
+    timeout_errors = ()
+    # exceptions that mean neo4j failed to process a request, whatever the query
+    server_errors = ()
+
+    @property
+    def failure_errors(self) -> tuple:
+        """
+        Exceptions meaning this neo4j instance failed, another replica of the graph might still answer the query.
+        """
+        return tuple(self.connection_errors) + tuple(self.server_errors)
+
+    @property
+    def health_errors(self) -> tuple:
+        """
+        Exceptions telling something about the health of neo4j, admission control counts them as neo4j failures.
+        """
+        return self.failure_errors + tuple(self.timeout_errors)
+
+    @abstractmethod
+    def ping(self):
+        """
+        Pings the neo4j backend.
+        """
+
+    @abstractmethod
+    async def ping_async(self) -> float:
+        """
+        Pings the neo4j backend without blocking the event loop.
+        :return: seconds the ping took
+        """
+
+    async def initialize(self):
+        """
+        Pings neo4j and checks if it supports apoc, without blocking the event loop.
+        Nothing is sent to neo4j when a driver is constructed, this is to be awaited once before serving requests.
+        """
+        logger.debug('PINGING NEO4J')
+        try:
+            time_taken = await self.ping_async()
+        except Exception as e:
+            logger.error(f"Error contacting Neo4j -- Exception raised -- {e}")
+            raise RuntimeError('Connection to Neo4j could not be established.')
+        logger.debug(f'Contacting neo4j took {time_taken} seconds.')
+        if time_taken > 5:  # greater than 5 seconds it's not healthy
+            logger.warning(f"Contacting neo4j took more than 5 seconds ({time_taken}). Neo4j might be stressed.")
+        logger.debug('CHECKING IF NEO4J SUPPORTS APOC')
+        await self.check_apoc_support_async()
+        logger.debug(f'SUPPORTS APOC : {self._supports_apoc}')
+
+    @abstractmethod
+    async def run(self, query, parameters=None, return_errors=False, timeout=600, cancellable=False):
+        """
+        Runs a neo4j query async.
+        :return: neo4j response
+        """
+
+    @abstractmethod
+    def run_sync(self, query, parameters=None):
+        """
+        Runs a neo4j query, blocking until it completes.
+        :return: neo4j response
+        """
+
+    async def run_many(self, queries: list, return_errors=False, timeout=600) -> list:
+        """
+        Runs several neo4j queries, returning one response per query in the same shape run() returns.
+        Drivers that can send several statements in a single round trip override this.
+        :param queries: list of (query, parameters) tuples
+        :param return_errors: returns errors as values instead of raising an exception
+        :param timeout: timeout for queries sent to neo4j
+        :return: list of responses, one per query
+        :rtype: list
+        """
+        return [await self.run(query, parameters=parameters, return_errors=return_errors, timeout=timeout)
+                for query, parameters in queries]
+
+    @staticmethod
+    def split_responses(response: dict, statement_count: int) -> list:
+        """
+        Splits a response holding the results of several statements into one response per statement.
+        :param response: neo4j response with a result per statement
+        :param statement_count: number of statements that were sent
+        :return: list of responses
+        """
+        results = response.get('results', [])
+        errors = response.get('errors', [])
+        return [{"results": results[index: index + 1], "errors": errors} for index in range(statement_count)]
+
+    @abstractmethod
+    def stream_rows(self, query, parameters=None, timeout=600, cancellable=False,
+                    byte_budget=None) -> AsyncIterator[dict]:
+        """
+        Runs a neo4j query async, yielding rows as dicts of column name to value as they are received.
+        Implemented as an async generator.
+        """
+
+    async def run_rows(self, query, parameters=None, timeout=600, cancellable=False, byte_budget=None) -> list:
+        """
+        Runs a neo4j query async and returns the rows as dicts, equivalent to convert_to_dict(run(query)) but
+        without materializing the complete raw response.
+        :param timeout: timeout for queries sent to neo4j
+        :param query: Cypher query.
+        :param parameters: Cypher query parameters.
+        :param cancellable: roll the query back in neo4j if it is cancelled before it completes
+        :param byte_budget: most bytes of response to read, ResponseBudgetExceeded is raised beyond it
+        :return: list of rows
+        :rtype: list
+        """
+        return [row async for row in self.stream_rows(query, parameters=parameters, timeout=timeout,
+                                                      cancellable=cancellable, byte_budget=byte_budget)]
+
+    async def close(self):
+        pass
+
+    def get_pool_stats(self) -> dict:
+        return {}
+
+    def convert_to_dict(self, response: dict) -> list:
+        """
+        Converts a neo4j result to a structured result.
+        :param response: neo4j http raw result.
+        :type response: dict
+        :return: reformatted dict
+        :rtype: dict
+        """
+        results = response.get('results')
+        array = []
+        if results:
+            for result in results:
+                cols = result.get('columns')
+                if cols:
+                    data_items = result.get('data')
+                    for item in data_items:
+                        new_row = {}
+                        row = item.get('row')
+                        for col_name, col_value in zip(cols, row):
+                            new_row[col_name] = col_value
+                        array.append(new_row)
+        return array
+
+    def check_apoc_support(self):
+        apoc_version_query = 'call apoc.help("meta")'
+        if self._supports_apoc is None:
+            try:
+                self.run_sync(apoc_version_query)
+                self._supports_apoc = True
+            except:
+                self._supports_apoc = False
+        return self._supports_apoc
+
+    async def check_apoc_support_async(self):
+        apoc_version_query = 'call apoc.help("meta")'
+        if self._supports_apoc is None:
+            try:
+                await self.run(apoc_version_query)
+                self._supports_apoc = True
+            except:
+                self._supports_apoc = False
+        return self._supports_apoc
+
+
+class Neo4jHTTPDriver(Neo4jDriver):
+    connection_errors = (httpx.NetworkError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+    timeout_errors = (httpx.TimeoutException,)
+    server_errors = (Neo4jServerError,)
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 auth: tuple,
+                 scheme: str = 'http',
+                 max_connections: int = 100,
+                 max_keepalive_connections: int = 20,
+                 keepalive_expiry: float = 30,
+                 http2: bool = False,
+                 compression: bool = True):
         self._host = host
         self._neo4j_transaction_endpoint = "/db/data/transaction/commit"
         self._scheme = scheme
         self._full_transaction_path = f"{self._scheme}://{self._host}:{port}{self._neo4j_transaction_endpoint}"
+        # endpoint to open explicit transactions, which can be rolled back while a query is running
+        self._transaction_path = f"{self._scheme}://{self._host}:{port}/db/data/transaction"
         self._port = port
         self._supports_apoc = None
         self._header = {
                 'Accept': 'application/json; charset=UTF-8',
                 'Content-Type': 'application/json',
-                'Authorization': 'Basic %s' % base64.b64encode(f"{auth[0]}:{auth[1]}".encode('utf-8')).decode('utf-8')
+                'Authorization': 'Basic %s' % base64.b64encode(f"{auth[0]}:{auth[1]}".encode('utf-8')).decode('utf-8'),
             }
-        # ping and raise error if neo4j doesn't respond.
-        logger.debug('PINGING NEO4J')
-        self.ping()
-        logger.debug('CHECKING IF NEO4J SUPPORTS APOC')
-        self.check_apoc_support()
-        logger.debug(f'SUPPORTS APOC : {self._supports_apoc}')
+        if not compression:
+            # httpx asks for compressed responses by default
+            self._header['Accept-Encoding'] = 'identity'
+        self._compression = compression
+        # settings for the long-lived connection pool shared by every query sent from this worker
+        self._pool_limits = httpx.Limits(max_connections=max_connections,
+                                         max_keepalive_connections=max_keepalive_connections,
+                                         keepalive_expiry=keepalive_expiry)
+        self._http2 = http2
+        self._session = None
+        self._requests_in_flight = 0
+        self._peak_requests_in_flight = 0
+        self._requests_total = 0
+        self._bytes_received_total = 0
+        self._bytes_decoded_total = 0
 
-    async def post_request_json(self, payload, timeout=600):
-        async with httpx.AsyncClient(timeout=timeout) as session:
-            response = await session.post(self._full_transaction_path, json=payload, headers=self._header)
-            if response.status_code != 200:
-                logger.error(f"[x] Problem contacting Neo4j server {self._host}:{self._port} -- {response.status_code}")
-                txt = response.text
-                logger.debug(f"[x] Server responded with {txt}")
+    def _get_session(self) -> httpx.AsyncClient:
+        """
+        Returns the async http client owned by this driver, creating it on first use.
+        :return: pooled http client
+        """
+        if self._session is None or self._session.is_closed:
+            http2 = self._http2
+            if http2:
                 try:
-                    return response.json()
-                except:
-                    return txt
-            else:
-                return response.json()
+                    import h2  # noqa: F401
+                except ImportError:
+                    logger.warning('NEO4J_HTTP2 is enabled but the h2 package is not installed, using HTTP/1.1.')
+                    http2 = False
+            self._session = httpx.AsyncClient(limits=self._pool_limits,
+                                              http2=http2,
+                                              headers=self._header)
+        return self._session
+
+    async def close(self):
+        """
+        Closes the pooled http client, to be called when the application shuts down.
+        """
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+    def get_pool_stats(self) -> dict:
+        """
+        Returns statistics about the http connection pool used to talk to neo4j.
+        :return: dict of pool limits and request counts
+        :rtype: dict
+        """
+        stats = {
+            'max_connections': self._pool_limits.max_connections,
+            'max_keepalive_connections': self._pool_limits.max_keepalive_connections,
+            'keepalive_expiry': self._pool_limits.keepalive_expiry,
+            'http2': self._http2,
+            'compression': self._compression,
+            'requests_in_flight': self._requests_in_flight,
+            'requests_total': self._requests_total,
+            'bytes_received_total': self._bytes_received_total,
+            'bytes_decoded_total': self._bytes_decoded_total,
+            # httpx doesn't expose its connections, at most this many were open at once
+            'peak_requests_in_flight': self._peak_requests_in_flight
+        }
+        return stats
+
+    def _record_transfer(self, response: httpx.Response, decoded_bytes: int):
+        """
+        Records how many bytes a neo4j response took on the wire and after decompression.
+        :param response: completely read response
+        :param decoded_bytes: size of the decompressed response body
+        """
+        received_bytes = response.num_bytes_downloaded
+        encoding = response.headers.get('content-encoding', 'identity')
+        self._bytes_received_total += received_bytes
+        self._bytes_decoded_total += decoded_bytes
+        logger.debug(f'Neo4j response: {received_bytes} bytes received ({encoding}), {decoded_bytes} bytes decoded.')
+        otel_span = trace.get_current_span()
+        if otel_span and otel_span.is_recording():
+            otel_span.set_attributes({
+                'neo4j_response_encoding': encoding,
+                'neo4j_response_bytes_received': received_bytes,
+                'neo4j_response_bytes_decoded': decoded_bytes
+            })
+
+    @staticmethod
+    def _execution_time_header(timeout) -> dict:
+        # makes neo4j terminate the transaction itself once the timeout has passed, even if nobody waits for it anymore
+        return {'max-execution-time': str(max(1, int(timeout * 1000)))}
+
+    async def _begin_transaction(self, timeout) -> str:
+        """
+        Opens an explicit transaction, which can be rolled back if the query run in it gets cancelled.
+        :param timeout: timeout for the transaction
+        :return: url of the transaction
+        """
+        response = await self._get_session().post(self._transaction_path,
+                                                  json={"statements": []},
+                                                  headers=self._execution_time_header(timeout),
+                                                  timeout=timeout)
+        if response.status_code != 201:
+            logger.error(f"[x] Problem opening a transaction on Neo4j server {self._host}:{self._port} -- "
+                         f"{response.status_code}")
+            error_class = Neo4jServerError if response.status_code >= 500 else RuntimeWarning
+            raise error_class(f'Could not open a neo4j transaction. {response.text}')
+        # build the url from the transaction id, the host neo4j advertises might not be reachable from here
+        transaction_id = response.headers['location'].rstrip('/').rsplit('/', 1)[-1]
+        return f"{self._transaction_path}/{transaction_id}"
+
+    async def _rollback_transaction(self, transaction_url):
+        """
+        Rolls back an open transaction, terminating the query running in it.
+        :param transaction_url: url of the transaction
+        """
+        try:
+            response = await self._get_session().delete(transaction_url, timeout=10)
+            logger.debug(f'Rolled back neo4j transaction {transaction_url} -- {response.status_code}')
+        except httpx.HTTPError as e:
+            logger.warning(f'Could not roll back neo4j transaction {transaction_url} -- {e}')
+
+    async def post_request_json(self, payload, timeout=600, cancellable=False):
+        session = self._get_session()
+        self._requests_in_flight += 1
+        self._peak_requests_in_flight = max(self._peak_requests_in_flight, self._requests_in_flight)
+        self._requests_total += 1
+        transaction_url = None
+        completed = False
+        try:
+            if cancellable:
+                transaction_url = await self._begin_transaction(timeout)
+            response = await session.post(f"{transaction_url}/commit" if transaction_url else
+                                          self._full_transaction_path,
+                                          json=payload,
+                                          headers=self._execution_time_header(timeout),
+                                          timeout=timeout)
+            completed = True
+        finally:
+            self._requests_in_flight -= 1
+            if transaction_url and not completed:
+                # the request was cancelled or timed out, stop neo4j from working on it
+                await asyncio.shield(self._rollback_transaction(transaction_url))
+        self._record_transfer(response, len(response.content))
+        if response.status_code != 200:
+            logger.error(f"[x] Problem contacting Neo4j server {self._host}:{self._port} -- {response.status_code}")
+            txt = response.text
+            logger.debug(f"[x] Server responded with {txt}")
+            try:
+                body = response.json()
+            except:
+                body = txt
+            if response.status_code >= 500:
+                raise Neo4jServerError(f'Neo4j server {self._host}:{self._port} returned {response.status_code}. '
+                                       f'{txt}', response=body)
+            return body
+        else:
+            return response.json()
 
     def ping(self):
         """
@@ -70,25 +480,52 @@ class Neo4jHTTPDriver:
             logger.debug(traceback.print_exc())
             raise RuntimeError('Connection to Neo4j could not be established.')
 
-    async def run(self, query, return_errors=False, timeout=600):
+    async def ping_async(self) -> float:
+        """
+        Pings the neo4j backend through the pooled client.
+        :return: seconds the ping took
+        """
+        now = time.time()
+        response = await self._get_session().get(f"{self._scheme}://{self._host}:{self._port}/")
+        if response.status_code != 200:
+            raise RuntimeError(f'Neo4j @ {self._host}:{self._port} returned {response.status_code} to ping.')
+        return time.time() - now
+
+    @staticmethod
+    def _statement(query, parameters=None):
+        statement = {
+            "statement": f"{query}"
+        }
+        # only send parameters when there are some, statement text stays the same across calls
+        # so neo4j can reuse the cached query plan
+        if parameters:
+            statement["parameters"] = parameters
+        return statement
+
+    async def run(self, query, parameters=None, return_errors=False, timeout=600, cancellable=False):
         """
         Runs a neo4j query async.
         :param timeout: http timeout for queries sent to neo4j
         :param return_errors: returns errors as values instead of raising an exception
         :param query: Cypher query.
+        :param parameters: Cypher query parameters.
+        :param cancellable: run the query in an explicit transaction, rolled back if the query is cancelled
         :return: result of query.
         :rtype: dict
         """
         # make the statement dictionary
         payload = {
             "statements": [
-                {
-                    "statement": f"{query}"
-                }
+                self._statement(query, parameters)
             ]
         }
 
-        response = await self.post_request_json(payload, timeout=timeout)
+        try:
+            response = await self.post_request_json(payload, timeout=timeout, cancellable=cancellable)
+        except Neo4jServerError as e:
+            if not return_errors:
+                raise
+            response = e.response
         errors = response.get('errors')
         if errors:
             logger.error(f'Neo4j returned `{errors}` for cypher {query}.')
@@ -97,62 +534,589 @@ class Neo4jHTTPDriver:
             raise RuntimeWarning(f'Error running cypher {query}. {errors}')
         return response
 
-    def run_sync(self, query):
+    async def run_many(self, queries: list, return_errors=False, timeout=600) -> list:
+        """
+        Runs several neo4j queries in a single transactional request.
+        :param queries: list of (query, parameters) tuples
+        :param return_errors: returns errors as values instead of raising an exception
+        :param timeout: http timeout for queries sent to neo4j
+        :return: list of responses, one per query
+        :rtype: list
+        """
+        payload = {
+            "statements": [
+                self._statement(query, parameters) for query, parameters in queries
+            ]
+        }
+        try:
+            response = await self.post_request_json(payload, timeout=timeout)
+        except Neo4jServerError as e:
+            if not return_errors:
+                raise
+            response = e.response
+        errors = response.get('errors')
+        if errors:
+            logger.error(f'Neo4j returned `{errors}` for cypher statements {[query for query, _ in queries]}.')
+            if not return_errors:
+                raise RuntimeWarning(f'Error running cypher statements. {errors}')
+        return self.split_responses(response, len(queries))
+
+    async def stream_rows(self, query, parameters=None, timeout=600, cancellable=False, byte_budget=None):
+        """
+        Runs a neo4j query async, decoding the response incrementally.
+        Rows are yielded as dicts of column name to value as soon as they are parsed, the raw response body is never
+        held in memory as a whole.
+        :param timeout: http timeout for queries sent to neo4j
+        :param query: Cypher query.
+        :param parameters: Cypher query parameters.
+        :param cancellable: run the query in an explicit transaction, rolled back if the query is cancelled
+        :param byte_budget: most decoded bytes of response to read, reading stops with ResponseBudgetExceeded
+            beyond it
+        :return: async generator of rows
+        """
+        # make the statement dictionary
+        payload = {
+            "statements": [
+                self._statement(query, parameters)
+            ]
+        }
+        errors = []
+        session = self._get_session()
+        self._requests_in_flight += 1
+        self._peak_requests_in_flight = max(self._peak_requests_in_flight, self._requests_in_flight)
+        self._requests_total += 1
+        transaction_url = None
+        completed = False
+        try:
+            if cancellable:
+                transaction_url = await self._begin_transaction(timeout)
+            async with session.stream('POST',
+                                      f"{transaction_url}/commit" if transaction_url else self._full_transaction_path,
+                                      json=payload,
+                                      headers=self._execution_time_header(timeout),
+                                      timeout=timeout) as response:
+                if response.status_code != 200:
+                    # neo4j answered, so there is nothing left running to roll back
+                    completed = True
+                    await response.aread()
+                    logger.error(f"[x] Problem contacting Neo4j server {self._host}:{self._port} -- "
+                                 f"{response.status_code}")
+                    logger.debug(f"[x] Server responded with {response.text}")
+                    error_class = Neo4jServerError if response.status_code >= 500 else RuntimeWarning
+                    raise error_class(f'Error running cypher {query}. {response.text}')
+                reader = _AsyncResponseReader(response, byte_budget)
+                async for row in parse_transaction_rows(reader, errors):
+                    yield row
+                completed = True
+                self._record_transfer(response, reader.bytes_read)
+        finally:
+            self._requests_in_flight -= 1
+            if transaction_url and not completed:
+                # the query was cancelled or timed out while streaming, stop neo4j from working on it
+                await asyncio.shield(self._rollback_transaction(transaction_url))
+        if errors:
+            logger.error(f'Neo4j returned `{errors}` for cypher {query}.')
+            raise RuntimeWarning(f'Error running cypher {query}. {errors}')
+
+    def run_sync(self, query, parameters=None):
         """
         Runs a neo4j query. Can cause the async loop to block.
         :param query:
+        :param parameters:
         :return:
         """
+        # make the statement dictionary
         payload = {
             "statements": [
-                {
-                    "statement": f"{query}"
-                }
+                self._statement(query, parameters)
             ]
         }
         response = httpx.post(
             self._full_transaction_path,
             headers=self._header,
             timeout=1500,
-            json=payload).json()
+            json=payload)
+        if response.status_code >= 500:
+            raise Neo4jServerError(f'Neo4j server {self._host}:{self._port} returned {response.status_code}. '
+                                   f'{response.text}')
+        response = response.json()
         errors = response.get('errors')
         if errors:
             logger.error(f'Neo4j returned `{errors}` for cypher {query}.')
             raise RuntimeWarning(f'Error running cypher {query}.')
         return response
 
-    def convert_to_dict(self, response: dict) -> list:
+
+class Neo4jBoltDriver(Neo4jDriver):
+    """
+    Talks to neo4j over the bolt protocol using the official neo4j driver. Records are streamed in binary
+    packstream format and converted to the same shape the http driver returns.
+    """
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 auth: tuple,
+                 max_connections: int = 100,
+                 **kwargs):
+        # the neo4j package is only needed when the bolt protocol is selected
+        import neo4j
+        self._neo4j = neo4j
+        self.connection_errors = (neo4j.exceptions.ServiceUnavailable, neo4j.exceptions.SessionExpired)
+        self.server_errors = (neo4j.exceptions.DatabaseError,)
+        self._host = host
+        self._port = port
+        self._uri = f"bolt://{self._host}:{self._port}"
+        self._supports_apoc = None
+        self._max_connections = max_connections
+        self._sync_driver = neo4j.GraphDatabase.driver(self._uri, auth=auth)
+        self._async_driver = neo4j.AsyncGraphDatabase.driver(self._uri,
+                                                             auth=auth,
+                                                             max_connection_pool_size=max_connections)
+        self._requests_in_flight = 0
+        self._requests_total = 0
+
+    def ping(self):
         """
-        Converts a neo4j result to a structured result.
-        :param response: neo4j http raw result.
-        :type response: dict
-        :return: reformatted dict
+        Pings the neo4j backend.
+        :return:
+        """
+        try:
+            now = time.time()
+            self._sync_driver.verify_connectivity()
+            time_taken = time.time() - now
+            logger.debug(f'Contacting neo4j took {time_taken} seconds.')
+            if time_taken > 5:  # greater than 5 seconds it's not healthy
+                logger.warning(f"Contacting neo4j took more than 5 seconds ({time_taken}). Neo4j might be stressed.")
+        except Exception as e:
+            logger.error(f"Error contacting Neo4j @ {self._uri} -- Exception raised -- {e}")
+            raise RuntimeError('Connection to Neo4j could not be established.')
+
+    async def ping_async(self) -> float:
+        """
+        Pings the neo4j backend through the async driver.
+        :return: seconds the ping took
+        """
+        now = time.time()
+        await self._async_driver.verify_connectivity()
+        return time.time() - now
+
+    def _to_json(self, value):
+        """
+        Converts values from bolt records to the json values the http api would return for a row.
+        Nodes and relationships become their property maps.
+        """
+        graph_types = self._neo4j.graph
+        if isinstance(value, (graph_types.Node, graph_types.Relationship)):
+            return {key: self._to_json(prop) for key, prop in value.items()}
+        if isinstance(value, graph_types.Path):
+            path = [self._to_json(value.start_node)]
+            for relationship in value.relationships:
+                path.append(self._to_json(relationship))
+                path.append(self._to_json(relationship.end_node))
+            return path
+        if isinstance(value, dict):
+            return {key: self._to_json(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._to_json(item) for item in value]
+        if value is None or isinstance(value, (str, bool, int, float)):
+            return value
+        # temporal and spatial types
+        return str(value)
+
+    def _error_response(self, error):
+        return {
+            "results": [],
+            "errors": [{"code": getattr(error, 'code', None) or type(error).__name__,
+                        "message": getattr(error, 'message', None) or str(error)}]
+        }
+
+    async def run(self, query, parameters=None, return_errors=False, timeout=600, cancellable=False):
+        """
+        Runs a neo4j query async.
+        If the query is cancelled the neo4j driver closes its connection, which makes neo4j terminate the
+        transaction, so every query is cancellable over bolt.
+        :param timeout: transaction timeout for queries sent to neo4j
+        :param return_errors: returns errors as values instead of raising an exception
+        :param query: Cypher query.
+        :param parameters: Cypher query parameters.
+        :param cancellable: accepted for compatibility with the http driver
+        :return: result of query.
         :rtype: dict
         """
-        results = response.get('results')
-        array = []
-        if results:
-            for result in results:
-                cols = result.get('columns')
-                if cols:
-                    data_items = result.get('data')
-                    for item in data_items:
-                        new_row = {}
-                        row = item.get('row')
-                        for col_name, col_value in zip(cols, row):
-                            new_row[col_name] = col_value
-                        array.append(new_row)
-        return array
+        self._requests_in_flight += 1
+        self._requests_total += 1
+        try:
+            async with self._async_driver.session() as session:
+                result = await session.run(self._neo4j.Query(query, timeout=timeout), parameters)
+                columns = list(result.keys())
+                data = [{"row": [self._to_json(value) for value in record.values()], "meta": []}
+                        async for record in result]
+            response = {"results": [{"columns": columns, "data": data}], "errors": []}
+        except self._neo4j.exceptions.Neo4jError as e:
+            response = self._error_response(e)
+        finally:
+            self._requests_in_flight -= 1
+        errors = response.get('errors')
+        if errors:
+            logger.error(f'Neo4j returned `{errors}` for cypher {query}.')
+            if return_errors:
+                return response
+            raise RuntimeWarning(f'Error running cypher {query}. {errors}')
+        return response
 
-    def check_apoc_support(self):
-        apoc_version_query = 'call apoc.help("meta")'
-        if self._supports_apoc is None:
+    async def run_many(self, queries: list, return_errors=False, timeout=600) -> list:
+        """
+        Runs several neo4j queries in one transaction on a single session.
+        :param queries: list of (query, parameters) tuples
+        :param return_errors: returns errors as values instead of raising an exception
+        :param timeout: transaction timeout for queries sent to neo4j
+        :return: list of responses, one per query
+        :rtype: list
+        """
+        self._requests_in_flight += 1
+        self._requests_total += 1
+        results = []
+        try:
+            async with self._async_driver.session() as session:
+                async with await session.begin_transaction(timeout=timeout) as transaction:
+                    for query, parameters in queries:
+                        result = await transaction.run(query, parameters)
+                        columns = list(result.keys())
+                        data = [{"row": [self._to_json(value) for value in record.values()], "meta": []}
+                                async for record in result]
+                        results.append({"columns": columns, "data": data})
+            response = {"results": results, "errors": []}
+        except self._neo4j.exceptions.Neo4jError as e:
+            response = self._error_response(e)
+            response['results'] = results
+        finally:
+            self._requests_in_flight -= 1
+        errors = response.get('errors')
+        if errors:
+            logger.error(f'Neo4j returned `{errors}` for cypher statements {[query for query, _ in queries]}.')
+            if not return_errors:
+                raise RuntimeWarning(f'Error running cypher statements. {errors}')
+        return self.split_responses(response, len(queries))
+
+    async def stream_rows(self, query, parameters=None, timeout=600, cancellable=False, byte_budget=None):
+        """
+        Runs a neo4j query async, yielding rows as dicts of column name to value as records arrive.
+        :param timeout: transaction timeout for queries sent to neo4j
+        :param query: Cypher query.
+        :param parameters: Cypher query parameters.
+        :param cancellable: accepted for compatibility with the http driver, bolt queries are always cancellable
+        :param byte_budget: most bytes of rows to read, counted as their json size, reading stops with
+            ResponseBudgetExceeded. Bolt records arrive whole, so the record running over the budget is measured
+            before it's dropped.
+        :return: async generator of rows
+        """
+        self._requests_in_flight += 1
+        self._requests_total += 1
+        bytes_read = 0
+        try:
+            async with self._async_driver.session() as session:
+                result = await session.run(self._neo4j.Query(query, timeout=timeout), parameters)
+                columns = list(result.keys())
+                async for record in result:
+                    row = dict(zip(columns, [self._to_json(value) for value in record.values()]))
+                    if byte_budget:
+                        row_bytes = len(orjson.dumps(row))
+                        bytes_read += row_bytes
+                        if bytes_read > byte_budget:
+                            raise self._budget_exceeded(row, row_bytes, row_bytes - (bytes_read - byte_budget),
+                                                        byte_budget)
+                    yield row
+        except self._neo4j.exceptions.Neo4jError as e:
+            errors = self._error_response(e)['errors']
+            logger.error(f'Neo4j returned `{errors}` for cypher {query}.')
+            raise RuntimeWarning(f'Error running cypher {query}. {errors}')
+        finally:
+            self._requests_in_flight -= 1
+
+    @staticmethod
+    def _budget_exceeded(row: dict, row_bytes: int, remaining_bytes: int, byte_budget: int) -> ResponseBudgetExceeded:
+        """
+        Builds the error for a row running over the byte budget. Like the row the http driver cuts off, the partial
+        row keeps the share of every list in the row that fit in the budget, plus the item crossing it.
+        """
+        error = ResponseBudgetExceeded(byte_budget)
+        share = max(remaining_bytes, 0) / row_bytes
+        error.partial_row = {column: value[:int(len(value) * share) + 1] if isinstance(value, list) else value
+                             for column, value in row.items()}
+        return error
+
+    def run_sync(self, query, parameters=None):
+        """
+        Runs a neo4j query. Can cause the async loop to block.
+        :param query:
+        :param parameters:
+        :return:
+        """
+        try:
+            with self._sync_driver.session() as session:
+                result = session.run(query, parameters)
+                columns = list(result.keys())
+                data = [{"row": [self._to_json(value) for value in record.values()], "meta": []}
+                        for record in result]
+        except self._neo4j.exceptions.Neo4jError as e:
+            logger.error(f'Neo4j returned `{self._error_response(e)["errors"]}` for cypher {query}.')
+            raise RuntimeWarning(f'Error running cypher {query}.')
+        return {"results": [{"columns": columns, "data": data}], "errors": []}
+
+    async def close(self):
+        await self._async_driver.close()
+        self._sync_driver.close()
+
+    def get_pool_stats(self) -> dict:
+        return {
+            'protocol': 'bolt',
+            'max_connections': self._max_connections,
+            'requests_in_flight': self._requests_in_flight,
+            'requests_total': self._requests_total
+        }
+
+
+class _Replica:
+    """
+    Routing state for one neo4j replica.
+    """
+    def __init__(self, host: str, driver_factory):
+        self.host = host
+        self.driver_factory = driver_factory
+        self.driver = None
+        self.healthy = False
+        self.in_flight = 0
+        # exponentially weighted moving average of recent request latencies in seconds
+        self.latency = None
+        self.failures = 0
+
+    def record_latency(self, seconds: float, decay: float):
+        self.latency = seconds if self.latency is None else (decay * seconds + (1 - decay) * self.latency)
+
+    def load(self) -> float:
+        # replicas without a latency yet get tried first, scaled by how busy they are
+        return (self.in_flight + 1) * (self.latency or 0.0)
+
+
+class Neo4jReplicaRouter(Neo4jDriver):
+    """
+    Spreads queries across several read-only copies of the same graph.
+    Each query goes to the healthy replica with the least load, based on in flight requests and recent latency.
+    Replicas that can't be reached or fail with server errors are ejected and brought back once a background probe can
+    ping them again.
+    """
+    def __init__(self, hosts: list, driver_factory, probe_interval: float = 10, latency_decay: float = 0.3):
+        """
+        :param hosts: neo4j hosts
+        :param driver_factory: function creating a driver for a host
+        :param probe_interval: seconds between background health checks of the replicas
+        :param latency_decay: weight of the newest latency sample in the moving average
+        """
+        self._supports_apoc = None
+        self._probe_interval = probe_interval
+        self._latency_decay = latency_decay
+        self._probe_task = None
+        self._replicas = [_Replica(host, driver_factory) for host in hosts]
+        # replicas are marked healthy once they answer a ping, see initialize()
+        for replica in self._replicas:
+            self._connect(replica)
+
+    @property
+    def health_errors(self) -> tuple:
+        # queries fail with the errors of the replica's driver
+        errors = []
+        for replica in self._replicas:
+            if replica.driver is not None:
+                errors += [error for error in replica.driver.health_errors if error not in errors]
+        return tuple(errors)
+
+    def _connect(self, replica: _Replica):
+        try:
+            replica.driver = replica.driver_factory(replica.host)
+        except Exception as e:
+            logger.error(f'Could not create a driver for neo4j replica {replica.host}: {e}')
+
+    def _eject(self, replica: _Replica, error: Exception):
+        if replica.healthy:
+            logger.warning(f'Ejecting neo4j replica {replica.host} -- {error}')
+        replica.healthy = False
+        replica.failures += 1
+
+    def _ensure_probing(self):
+        # the probe runs on the event loop serving requests, so it's started from the first routed async call
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.get_running_loop().create_task(self._probe_replicas())
+
+    async def _probe_replicas(self):
+        while True:
+            await asyncio.sleep(self._probe_interval)
+            for replica in self._replicas:
+                await self.probe(replica)
+
+    async def probe(self, replica: _Replica):
+        """
+        Pings a replica, ejecting it if the ping fails and bringing it back if it succeeds.
+        :param replica: replica to check
+        """
+        if replica.driver is None:
+            self._connect(replica)
+            if replica.driver is None:
+                return
+        try:
+            replica.record_latency(await replica.driver.ping_async(), self._latency_decay)
+            if not replica.healthy:
+                logger.info(f'Neo4j replica {replica.host} is reachable again.')
+            replica.healthy = True
+            replica.failures = 0
+        except Exception as e:
+            self._eject(replica, e)
+
+    def _candidates(self) -> list:
+        """
+        Returns replicas in the order they should be tried for a query.
+        If every replica is ejected, all of them are tried anyway, least failed first.
+        """
+        healthy = sorted((replica for replica in self._replicas if replica.healthy), key=_Replica.load)
+        if healthy:
+            return healthy
+        return sorted((replica for replica in self._replicas if replica.driver is not None),
+                      key=lambda replica: replica.failures)
+
+    async def _route(self, method_name: str, *args, **kwargs):
+        self._ensure_probing()
+        last_error = None
+        for replica in self._candidates():
+            replica.in_flight += 1
+            start_time = time.time()
             try:
-                self.run_sync(apoc_version_query)
-                self._supports_apoc = True
-            except:
-                self._supports_apoc = False
-        return self._supports_apoc
+                result = await getattr(replica.driver, method_name)(*args, **kwargs)
+                replica.record_latency(time.time() - start_time, self._latency_decay)
+                return result
+            except replica.driver.failure_errors as e:
+                # neo4j could not be reached or failed, try the next replica
+                self._eject(replica, e)
+                last_error = e
+            finally:
+                replica.in_flight -= 1
+        raise RuntimeError(f'No neo4j replica could be reached. {last_error}')
+
+    def ping(self):
+        for replica in self._replicas:
+            if replica.driver is not None:
+                try:
+                    replica.driver.ping()
+                    replica.healthy = True
+                except RuntimeError as e:
+                    self._eject(replica, e)
+        if not any(replica.healthy for replica in self._replicas):
+            raise RuntimeError('Connection to Neo4j could not be established for any replica.')
+
+    async def ping_async(self) -> float:
+        for replica in self._replicas:
+            await self.probe(replica)
+        latencies = [replica.latency for replica in self._replicas if replica.healthy]
+        if not latencies:
+            raise RuntimeError('Connection to Neo4j could not be established for any replica.')
+        return min(latencies)
+
+    async def run(self, query, parameters=None, return_errors=False, timeout=600, cancellable=False):
+        return await self._route('run', query, parameters=parameters, return_errors=return_errors, timeout=timeout,
+                                 cancellable=cancellable)
+
+    async def run_many(self, queries: list, return_errors=False, timeout=600) -> list:
+        return await self._route('run_many', queries, return_errors=return_errors, timeout=timeout)
+
+    async def run_rows(self, query, parameters=None, timeout=600, cancellable=False, byte_budget=None) -> list:
+        return await self._route('run_rows', query, parameters=parameters, timeout=timeout, cancellable=cancellable,
+                                 byte_budget=byte_budget)
+
+    async def stream_rows(self, query, parameters=None, timeout=600, cancellable=False, byte_budget=None):
+        self._ensure_probing()
+        last_error = None
+        for replica in self._candidates():
+            replica.in_flight += 1
+            start_time = time.time()
+            streamed = False
+            try:
+                async for row in replica.driver.stream_rows(query, parameters=parameters, timeout=timeout,
+                                                            cancellable=cancellable, byte_budget=byte_budget):
+                    streamed = True
+                    yield row
+                replica.record_latency(time.time() - start_time, self._latency_decay)
+                return
+            except replica.driver.failure_errors as e:
+                self._eject(replica, e)
+                # rows can't be replayed once yielded, only a query that failed before its first row is retried
+                if streamed:
+                    raise
+                last_error = e
+            finally:
+                replica.in_flight -= 1
+        raise RuntimeError(f'No neo4j replica could be reached. {last_error}')
+
+    def run_sync(self, query, parameters=None):
+        last_error = None
+        for replica in self._candidates():
+            try:
+                return replica.driver.run_sync(query, parameters=parameters)
+            except replica.driver.failure_errors as e:
+                self._eject(replica, e)
+                last_error = e
+        raise RuntimeError(f'No neo4j replica could be reached. {last_error}')
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+        for replica in self._replicas:
+            if replica.driver is not None:
+                await replica.driver.close()
+
+    def get_pool_stats(self) -> dict:
+        return {
+            'replicas': [{
+                'host': replica.host,
+                'healthy': replica.healthy,
+                'in_flight': replica.in_flight,
+                'latency': replica.latency,
+                'failures': replica.failures,
+                'pool': replica.driver.get_pool_stats() if replica.driver is not None else {}
+            } for replica in self._replicas]
+        }
+
+
+def cypher_label(label: str) -> str:
+    """
+    Quotes a node label or relationship type for use in cypher. Labels can't be passed as query parameters.
+    :param label: label or relationship type
+    :return: backtick quoted label with backticks inside it escaped
+    """
+    escaped_label = label.replace('`', '``')
+    return f"`{escaped_label}`"
+
+
+def get_neo4j_driver(protocol: str, host: str, port: int, auth: tuple, replica_probe_interval: float = 10,
+                     **kwargs) -> Neo4jDriver:
+    """
+    Creates the driver for the configured neo4j protocol.
+    If host is a comma separated list of hosts, queries are routed across them as replicas of the same graph.
+    :param protocol: http or bolt
+    :return: neo4j driver
+    """
+    if protocol == 'bolt':
+        driver_class = Neo4jBoltDriver
+    elif protocol == 'http':
+        driver_class = Neo4jHTTPDriver
+    else:
+        raise ValueError(f'Unsupported neo4j protocol: {protocol}')
+    hosts = [replica_host.strip() for replica_host in str(host).split(',') if replica_host.strip()]
+    if len(hosts) > 1:
+        return Neo4jReplicaRouter(
+            hosts=hosts,
+            driver_factory=lambda replica_host: driver_class(host=replica_host, port=port, auth=auth, **kwargs),
+            probe_interval=replica_probe_interval
+        )
+    return driver_class(host=host, port=port, auth=auth, **kwargs)
 
 
 class GraphInterface:
@@ -161,8 +1125,24 @@ class GraphInterface:
     """
 
     class _GraphInterface:
-        def __init__(self, host, port, auth, query_timeout, bl_version="3.1"):
-            self.driver = Neo4jHTTPDriver(host=host, port=port, auth=auth)
+        def __init__(self, host, port, auth, query_timeout, bl_version="3.1", driver_settings=None, protocol='http',
+                     stream_responses=False, admission_settings=None, cancellable_transactions=False):
+            self.driver = get_neo4j_driver(protocol=protocol, host=host, port=port, auth=auth,
+                                           **(driver_settings or {}))
+            # limits work in flight to neo4j and fails fast while it's unhealthy
+            admission_settings = dict(admission_settings or {})
+            circuit_breaker = CircuitBreaker(failure_threshold=admission_settings.pop('failure_threshold', 5),
+                                             reset_timeout=admission_settings.pop('reset_timeout', 30))
+            self.admission_controller = AdmissionController(
+                limiter=AdaptiveConcurrencyLimiter(**admission_settings),
+                circuit_breaker=circuit_breaker,
+                health_errors=self.driver.health_errors + (RuntimeError,)
+            )
+            # decode neo4j responses incrementally instead of loading them whole
+            self.stream_responses = stream_responses
+            # run queries with a deadline in explicit http transactions, so they can be rolled back when cancelled,
+            # at the cost of an extra round trip per query
+            self.cancellable_transactions = cancellable_transactions
             self.schema = None
             # used to keep track of derived inverted predicates
             self.inverted_predicates = defaultdict(lambda: defaultdict(set))
@@ -205,7 +1185,13 @@ class GraphInterface:
             # if an inverse is found
             return self.toolkit.get_element(element['inverse']).slot_uri
 
-        def get_schema(self):
+        async def initialize(self):
+            """
+            Pings neo4j and checks for apoc support, to be awaited when the application starts.
+            """
+            await self.driver.initialize()
+
+        async def get_schema(self):
             """
             Gets the schema of the graph. To be used by. Also generates graph summary
             :return: Dict of structure source label as outer most keys, target labels as inner keys and list of predicates
@@ -219,7 +1205,7 @@ class GraphInterface:
                 """
                 logger.info(f"Starting schema query {query} on graph... this might take a few.")
                 before_time = time.time()
-                result = self.driver.run_sync(query)
+                result = await self.run_cypher(query)
                 after_time = time.time()
                 logger.info(f"Completed schema query ({after_time - before_time} seconds). Preparing initial schema.")
                 schema_query_results = self.convert_to_dict(result)
@@ -303,8 +1289,8 @@ class GraphInterface:
             :param target_id:
             :return:
             """
-            source_id_syntaxed = f"{{id: \"{source_id}\"}}" if source_id else ''
-            target_id_syntaxed = f"{{id: \"{target_id}\"}}" if target_id else ''
+            source_id_syntaxed = "{id: $source_id}" if source_id else ''
+            target_id_syntaxed = "{id: $target_id}" if target_id else ''
             query = f"""
                             MATCH (a{source_id_syntaxed})-[x]->(b{target_id_syntaxed}) WITH
                                 [la in labels(a) where la <> 'Concept'] as source_label,
@@ -312,7 +1298,7 @@ class GraphInterface:
                                 type(x) as predicate
                             RETURN DISTINCT source_label, predicate, target_label
                         """
-            response = await self.driver.run(query)
+            response = await self.run_cypher(query, parameters={'source_id': source_id, 'target_id': target_id})
             response = self.convert_to_dict(response)
             return response
 
@@ -326,8 +1312,8 @@ class GraphInterface:
             :return: value of the node in neo4j.
             :rtype: list
             """
-            query = f"MATCH (c:`{node_type}`{{id: '{curie}'}}) return c"
-            response = await self.driver.run(query)
+            query = f"MATCH (c:{cypher_label(node_type)}{{id: $curie}}) return c"
+            response = await self.run_cypher(query, parameters={'curie': curie})
 
             data = response.get('results',[{}])[0].get('data', [])
             '''
@@ -357,24 +1343,68 @@ class GraphInterface:
             :rtype: list
             """
 
-            query = f'MATCH (c:`{source_type}`{{id: \'{curie}\'}})-[e]->(b:`{target_type}`) return distinct c , e, b'
-            response = await self.driver.run(query)
-            rows = list(map(lambda data: data['row'], response['results'][0]['data']))
-            query = f'MATCH (c:`{source_type}`{{id: \'{curie}\'}})<-[e]-(b:`{target_type}`) return distinct b , e, c'
-            response = await self.driver.run(query)
-            rows += list(map(lambda data: data['row'], response['results'][0]['data']))
+            source_label, target_label = cypher_label(source_type), cypher_label(target_type)
+            parameters = {'curie': curie}
+            # outbound and inbound hops are sent together in one round trip
+            responses = await self.run_cypher_many([
+                (f'MATCH (c:{source_label}{{id: $curie}})-[e]->(b:{target_label}) return distinct c , e, b', parameters),
+                (f'MATCH (c:{source_label}{{id: $curie}})<-[e]-(b:{target_label}) return distinct b , e, c', parameters)
+            ])
+            rows = []
+            for response in responses:
+                rows += list(map(lambda data: data['row'], response['results'][0]['data']))
 
             return rows
 
         async def run_cypher(self, cypher: str, **kwargs) -> list:
             """
             Runs cypher directly.
+            A deadline (epoch seconds) can be passed as a keyword argument, neo4j then stops the query at the deadline.
+            With cancellable_transactions on, such queries are also rolled back when they are cancelled.
             :param cypher: cypher query.
             :type cypher: str
             :return: unprocessed neo4j response.
             :rtype: list
             """
+            return await self._run_traced(self.driver.run, cypher, **kwargs)
+
+        async def run_cypher_rows(self, cypher: str, **kwargs) -> list:
+            """
+            Runs cypher and returns the rows as dicts of column name to value.
+            If stream_responses is on the neo4j response is decoded incrementally, so only the rows are materialized.
+            A byte_budget keyword argument limits how much of the response is read, such queries are always streamed.
+            :param cypher: cypher query.
+            :type cypher: str
+            :return: rows of the result
+            :rtype: list
+            :raises ResponseBudgetExceeded: if the response is bigger than the byte budget
+            """
+            if self.stream_responses or kwargs.get('byte_budget'):
+                return await self._run_traced(self.driver.run_rows, cypher, **kwargs)
+            kwargs.pop('byte_budget', None)
+            return self.convert_to_dict(await self.run_cypher(cypher, **kwargs))
+
+        async def run_cypher_many(self, queries: list, **kwargs) -> list:
+            """
+            Runs several cypher queries in a single round trip to neo4j.
+            :param queries: list of (cypher, parameters) tuples
+            :type queries: list
+            :return: unprocessed neo4j response for each query
+            :rtype: list
+            """
+            kwargs['timeout'] = self.query_timeout
+            async with self.admission_controller.admit():
+                return await self.driver.run_many(queries, **kwargs)
+
+        async def _run_traced(self, driver_method, cypher: str, deadline: float = None, **kwargs):
             kwargs['timeout'] = self.query_timeout
+            if deadline is not None:
+                # neo4j shouldn't keep working on the query after the requester gave up on it, the timeout is sent
+                # along as the max execution time of the transaction
+                kwargs['timeout'] = min(self.query_timeout, deadline - time.time())
+                if kwargs['timeout'] <= 0:
+                    raise asyncio.TimeoutError(f'Deadline passed before running cypher {cypher}.')
+                kwargs['cancellable'] = self.cancellable_transactions
             # get a reference to the current opentelemetry span
             otel_span = trace.get_current_span()
             if not otel_span or not otel_span.is_recording():
@@ -384,7 +1414,8 @@ class GraphInterface:
                                     attributes={
                                         'cypher_query': cypher
                                     })
-            cypher_results = await self.driver.run(cypher, **kwargs)
+            async with self.admission_controller.admit():
+                cypher_results = await driver_method(cypher, **kwargs)
             if otel_span is not None:
                 otel_span.add_event("neo4j_query_end")
             return cypher_results
@@ -397,17 +1428,17 @@ class GraphInterface:
             :return: Node dict values.
             :rtype: dict
             """
-            query = f"MATCH (c:{node_type}) return c limit 5"
-            response = await self.driver.run(query)
+            query = f"MATCH (c:{cypher_label(node_type)}) return c limit 5"
+            response = await self.run_cypher(query)
             rows = response['results'][0]['data'][0]['row']
             return rows
 
-        def get_examples(self,
-                         subject_node_type,
-                         object_node_type=None,
-                         predicate=None,
-                         num_examples=1,
-                         use_qualifiers=False):
+        async def get_examples(self,
+                               subject_node_type,
+                               object_node_type=None,
+                               predicate=None,
+                               num_examples=1,
+                               use_qualifiers=False):
             """
             Returns an example for source node only if target is not specified, if target is specified a sample one hop
             is returned.
@@ -423,28 +1454,32 @@ class GraphInterface:
             :rtype:
             """
             qualifiers_check = " WHERE edge.qualified_predicate IS NOT NULL " if use_qualifiers else ""
+            parameters = {'num_examples': num_examples}
             if object_node_type and predicate:
-                query = f"MATCH (subject:`{subject_node_type}`)-[edge:`{predicate}`]->(object:`{object_node_type}`) " \
-                        f"{qualifiers_check} return subject, edge, object limit {num_examples}"
-                response = self.convert_to_dict(self.driver.run_sync(query))
+                query = f"MATCH (subject:{cypher_label(subject_node_type)})-[edge:{cypher_label(predicate)}]->" \
+                        f"(object:{cypher_label(object_node_type)}) " \
+                        f"{qualifiers_check} return subject, edge, object limit $num_examples"
+                response = self.convert_to_dict(await self.run_cypher(query, parameters=parameters))
                 return response
             elif object_node_type:
-                query = f"MATCH (subject:`{subject_node_type}`)-[edge]->(object:`{object_node_type}`) " \
-                        f"{qualifiers_check} return subject, edge, object limit {num_examples}"
-                response = self.convert_to_dict(self.driver.run_sync(query))
+                query = f"MATCH (subject:{cypher_label(subject_node_type)})-[edge]->" \
+                        f"(object:{cypher_label(object_node_type)}) " \
+                        f"{qualifiers_check} return subject, edge, object limit $num_examples"
+                response = self.convert_to_dict(await self.run_cypher(query, parameters=parameters))
                 return response
             else:
-                query = f"MATCH (subject:`{subject_node_type}`) " \
-                        f"return subject limit {num_examples}"
-                response = self.convert_to_dict(self.driver.run_sync(query))
+                query = f"MATCH (subject:{cypher_label(subject_node_type)}) " \
+                        f"return subject limit $num_examples"
+                response = self.convert_to_dict(await self.run_cypher(query, parameters=parameters))
                 return response
 
-        def supports_apoc(self):
+        async def supports_apoc(self):
             """
             Returns true if apoc is supported by backend database.
             :return: bool true if neo4j supports apoc.
             """
-            return self.driver.check_apoc_support()
+            # answered from the check made by initialize(), without blocking the event loop otherwise
+            return await self.driver.check_apoc_support_async()
 
         async def run_apoc_cover(self, ids: list):
             """
@@ -452,58 +1487,85 @@ class GraphInterface:
             :param ids:
             :return: dictionary of edges and source and target nodes ids
             """
-            query = f"""
+            query = """
                         MATCH (node:`biolink:NamedThing`)
                         USING INDEX node:`biolink:NamedThing`(id)
-                        WHERE node.id in {ids}
+                        WHERE node.id in $ids
                         WITH collect(node) as nodes
                         CALL apoc.algo.cover(nodes) yield rel
-                        WITH {{subject: startNode(rel).id ,
+                        WITH {subject: startNode(rel).id ,
                                object: endNode(rel).id,
                                predicate: type(rel),
-                               edge: rel }} as row
+                               edge: rel } as row
                         return collect(row) as result                                        
                         """
-            result = self.convert_to_dict(self.driver.run_sync(query))
+            result = self.convert_to_dict(await self.run_cypher(query, parameters={'ids': ids}))
             return result
 
-        async def get_nodes(self, node_ids, core_attributes, attr_types, **kwargs):
-            query = f"""
-            UNWIND  {node_ids} as id
-            match (n:`biolink:NamedThing`{{id: id}})
+        async def get_nodes(self, node_ids: list, core_attributes: list, attr_types: dict, **kwargs):
+            """
+            Returns nodes with their categories, name and attributes keyed by node id.
+            :param node_ids: ids of nodes to look up
+            :param core_attributes: node properties to leave out of the attributes list
+            :param attr_types: mapping of property name to attribute_type_id
+            :return: unprocessed neo4j response
+            """
+            query = """
+            UNWIND $node_ids as id
+            match (n:`biolink:NamedThing`{id: id})
             return apoc.map.fromLists(
                 [n IN collect(DISTINCT n) | n.id], 
                 [
-                    n IN collect(DISTINCT n)| {{
+                    n IN collect(DISTINCT n)| {
                             categories: labels(n),
                             name: n.name,
                             attributes: [
-                                key in apoc.coll.subtract(keys(n), {core_attributes})
+                                key in apoc.coll.subtract(keys(n), $core_attributes)
                                 | 
-                                {{
+                                {
                                     original_attribute_name: key, 
                                     value: n[key],
-                                    attribute_type_id: COALESCE({attr_types}[key], "NA")                                    
-                                }}                                
+                                    attribute_type_id: COALESCE($attr_types[key], "NA")                                    
+                                }                                
                                 ]
-                            }}
+                            }
                 ]) as result
             """
-            return await self.driver.run(query, **kwargs)
+            parameters = {'node_ids': node_ids, 'core_attributes': core_attributes, 'attr_types': attr_types}
+            return await self.run_cypher(query, parameters=parameters, **kwargs)
 
         def convert_to_dict(self, result):
             return self.driver.convert_to_dict(result)
 
+        def get_pool_stats(self):
+            """
+            Returns connection pool statistics of the neo4j driver, along with the state of admission control.
+            :return: dict of pool statistics
+            """
+            return {**self.driver.get_pool_stats(), 'admission_control': self.admission_controller.get_stats()}
+
+        async def close(self):
+            """
+            Releases connections held by the neo4j driver.
+            """
+            await self.driver.close()
+
     instance = None
 
-    def __init__(self, host, port, auth, query_timeout=600, bl_version="3.1"):
+    def __init__(self, host, port, auth, query_timeout=600, bl_version="3.1", driver_settings=None, protocol='http',
+                 stream_responses=False, admission_settings=None, cancellable_transactions=False):
         # create a new instance if not already created.
         if not GraphInterface.instance:
             GraphInterface.instance = GraphInterface._GraphInterface(host=host,
                                                                      port=port,
                                                                      auth=auth,
                                                                      query_timeout=query_timeout,
-                                                                     bl_version=bl_version)
+                                                                     bl_version=bl_version,
+                                                                     driver_settings=driver_settings,
+                                                                     protocol=protocol,
+                                                                     stream_responses=stream_responses,
+                                                                     admission_settings=admission_settings,
+                                                                     cancellable_transactions=cancellable_transactions)
 
     def __getattr__(self, item):
         # proxy function calls to the inner object.
@@ -1,5 +1,5 @@
 from PLATER.services.util.graph_adapter import GraphInterface
-from PLATER.services.util.question import Question, cypher_expression, RESERVED_NODE_PROPS
+from PLATER.services.util.question import Question, RESERVED_NODE_PROPS
 import os
 import json
 
@@ -34,7 +34,7 @@ class Overlay:
                     for n in nodes:
                         all_kg_nodes.append(n['id'])
 
-            if self.graph_interface.supports_apoc():
+            if await self.graph_interface.supports_apoc():
                 all_kg_nodes = list(all_kg_nodes)
                 apoc_result = (await self.graph_interface.run_apoc_cover(all_kg_nodes))[0]['result']
                 apoc_result = self.structure_for_easy_lookup(apoc_result)
@@ -103,11 +103,10 @@ class Overlay:
 
     async def annotate_node(self, message):
         node_ids = list(message['knowledge_graph'].get('nodes').keys())
-        node_ids = cypher_expression.dumps(node_ids)
         # skip name , id , categories from being returned in attributes array
-        core_properties = cypher_expression.dumps(RESERVED_NODE_PROPS + ['name'])
+        core_properties = RESERVED_NODE_PROPS + ['name']
         # mapping for attributes
-        attribute_types = cypher_expression.dumps(ATTRIBUTE_TYPES)
+        attribute_types = ATTRIBUTE_TYPES
         response = self.graph_interface.convert_to_dict(
             await self.graph_interface.get_nodes(node_ids, core_properties, attribute_types)
         )[0]['result']
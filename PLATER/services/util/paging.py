@@ -0,0 +1,48 @@
+import base64
+import binascii
+
+import orjson
+
+
+class InvalidPageTokenError(ValueError):
+    pass
+
+
+def encode_page_token(query_key: str, offset: int, page_size: int, graph_version: str) -> str:
+    """
+    Makes the opaque token a client sends back, together with the same query, to get the next page.
+    The token only locates a position in the answers of a query, the query itself is always compiled from the request,
+    so a token can never make plater run cypher the client wrote.
+    :param query_key: key of the canonical query graph the page belongs to
+    :param offset: number of results before the next page
+    :param page_size: results per page
+    :param graph_version: version of the graph, pages of an older graph can't be continued
+    :return: url safe token
+    """
+    token = orjson.dumps({'q': query_key, 'o': offset, 's': page_size, 'v': graph_version})
+    return base64.urlsafe_b64encode(token).decode('ascii')
+
+
+def decode_page_token(token: str, query_key: str, graph_version: str) -> tuple:
+    """
+    Reads a page token, checking that it continues the given query on the current graph.
+    :param token: token sent by the client
+    :param query_key: key of the canonical query graph of the request, None if it couldn't be canonicalized
+    :param graph_version: current version of the graph
+    :return: offset and page size of the next page
+    :rtype: tuple
+    :raises InvalidPageTokenError: if the token is malformed or belongs to another query or graph version
+    """
+    try:
+        page = orjson.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        offset, page_size = int(page['o']), int(page['s'])
+    except (binascii.Error, UnicodeEncodeError, orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+        raise InvalidPageTokenError('Malformed page token.')
+    if query_key is None or page.get('q') != query_key:
+        raise InvalidPageTokenError('The page token belongs to a different query.')
+    if page.get('v') != graph_version:
+        raise InvalidPageTokenError('The graph changed since the page token was issued, start again from the '
+                                    'first page.')
+    if offset < 0 or page_size <= 0:
+        raise InvalidPageTokenError('Malformed page token.')
+    return offset, page_size
@@ -0,0 +1,149 @@
+import asyncio
+import functools
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import orjson
+
+from PLATER.services.config import config
+from PLATER.services.util.logutil import LoggingUtil
+
+logger = LoggingUtil.init_logging(
+    __name__,
+    config.get('logging_level'),
+    config.get('logging_format'),
+)
+
+# knowledge graph nodes, edges and results below which post-processing stays on the event loop
+INLINE_LIMIT = int(config.get('POST_PROCESSING_INLINE_LIMIT', 10000))
+# knowledge graph nodes and edges from which formatting is sharded over worker processes
+SHARDING_THRESHOLD = int(config.get('SHARDED_POST_PROCESSING_THRESHOLD', 200000))
+# worker processes formatting shards, 0 turns sharding off
+SHARDING_WORKERS = int(config.get('SHARDED_POST_PROCESSING_WORKERS', 0))
+# shards per worker process, more shards even out the work between workers
+SHARDS_PER_WORKER = 4
+
+post_processing_executor = None
+sharding_executor = None
+# executors are created lazily, possibly from post-processing threads
+executor_lock = threading.Lock()
+
+
+def get_post_processing_executor() -> ThreadPoolExecutor:
+    global post_processing_executor
+    with executor_lock:
+        if post_processing_executor is None:
+            post_processing_executor = ThreadPoolExecutor(max_workers=int(config.get('POST_PROCESSING_WORKERS', 2)),
+                                                          thread_name_prefix='post_processing')
+        return post_processing_executor
+
+
+def get_sharding_executor() -> ProcessPoolExecutor:
+    global sharding_executor
+    with executor_lock:
+        if sharding_executor is None:
+            # workers are spawned, forking a process running an event loop and threads isn't safe
+            sharding_executor = ProcessPoolExecutor(max_workers=SHARDING_WORKERS,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=_init_shard_worker)
+        return sharding_executor
+
+
+def message_size(message: dict) -> int:
+    """
+    Estimates the work of post-processing a TRAPI message by its knowledge graph nodes and edges and its results.
+    """
+    knowledge_graph = message.get('knowledge_graph') or {}
+    return len(knowledge_graph.get('nodes') or {}) + len(knowledge_graph.get('edges') or {}) + \
+        len(message.get('results') or [])
+
+
+async def run_post_processing(function, *args, size: int):
+    """
+    Runs CPU bound post-processing of a response. Small jobs run right away, large ones run in a bounded thread pool,
+    so the event loop keeps serving other requests in the meantime.
+    :param function: function to run
+    :param args: arguments of the function
+    :param size: size of the job, compared to POST_PROCESSING_INLINE_LIMIT
+    :return: result of the function
+    """
+    if size < INLINE_LIMIT:
+        return function(*args)
+    logger.debug(f'post-processing {size} items in the thread pool')
+    return await asyncio.get_running_loop().run_in_executor(get_post_processing_executor(),
+                                                            functools.partial(function, *args))
+
+
+def should_shard(item_count: int) -> bool:
+    return SHARDING_WORKERS > 0 and item_count >= SHARDING_THRESHOLD
+
+
+# question formatting shards in a worker process, set up once per worker by _init_shard_worker
+shard_worker_question = None
+
+
+def _init_shard_worker():
+    # loads the biolink model toolkit and the attribute mappings once per worker process, not with the first shard
+    global shard_worker_question
+    from PLATER.services.util.question import Question
+    shard_worker_question = Question({})
+
+
+def _format_shard(shard: bytes, node: bool) -> bytes:
+    # runs in a worker process, shards go both ways as json bytes which are far cheaper to pickle than dicts
+    if shard_worker_question is None:
+        _init_shard_worker()
+    return orjson.dumps(shard_worker_question.format_attribute_trapi(orjson.loads(shard), node=node))
+
+
+def format_sharded(kg_items: dict, node: bool, format_inline) -> dict:
+    """
+    Formats knowledge graph nodes or edges in parallel worker processes, a shard of them per process.
+    Each shard is handed to the workers as soon as it's serialized, and formatted shards are decoded while the
+    workers format the rest, so the serialization in this process overlaps with the formatting.
+    :param kg_items: knowledge graph nodes or edges
+    :param node: whether the items are nodes
+    :param format_inline: formats the items in this process, if the worker processes fail
+    :return: formatted items, in the same order
+    """
+    identifiers = list(kg_items)
+    shard_size = math.ceil(len(identifiers) / (SHARDING_WORKERS * SHARDS_PER_WORKER)) or 1
+    futures = []
+    try:
+        executor = get_sharding_executor()
+        for start in range(0, len(identifiers), shard_size):
+            shard = orjson.dumps({identifier: kg_items[identifier]
+                                  for identifier in identifiers[start: start + shard_size]})
+            futures.append(executor.submit(_format_shard, shard, node))
+        formatted = {}
+        for future in futures:
+            formatted.update(orjson.loads(future.result()))
+        return formatted
+    except Exception as e:
+        # a broken pool, a shard that couldn't be pickled or an error raised in a worker
+        logger.error(f'Sharded post-processing failed, formatting in process: {e!r}')
+        for future in futures:
+            future.cancel()
+        if isinstance(e, BrokenProcessPool):
+            shutdown_sharding()
+        return format_inline(kg_items, node=node)
+
+
+def shutdown_sharding():
+    global sharding_executor
+    with executor_lock:
+        executor, sharding_executor = sharding_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_post_processing():
+    global post_processing_executor
+    with executor_lock:
+        executor, post_processing_executor = post_processing_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+    shutdown_sharding()
@@ -1,18 +1,25 @@
-import copy
+import asyncio
+import numbers
 import orjson
+import re
+import sys
 import time
 
+from datetime import datetime, timezone
+from functools import lru_cache
 from secrets import token_hex
 from opentelemetry import trace
-from PLATER.services.util.graph_adapter import GraphInterface
+from PLATER.services.util.graph_adapter import GraphInterface, ResponseBudgetExceeded
 from reasoner_transpiler.cypher import get_query, RESERVED_NODE_PROPS, cypher_expression
+from reasoner_transpiler.exceptions import (
+    InvalidPredicateError, InvalidQualifierError, InvalidQualifierValueError, UnsupportedError
+)
 from reasoner_pydantic.qgraph import AttributeConstraint
-from reasoner_pydantic.shared import Attribute
-from PLATER.services.util.constraints import check_attributes
+from PLATER.services.util.constraints import compile_attribute_constraints
 from PLATER.services.config import config
-from PLATER.services.util.attribute_mapping import skip_list, get_attribute_info
-from PLATER.services.util.bl_helper import BIOLINK_MODEL_TOOLKIT as bmt
+from PLATER.services.util.attribute_mapping import classify_attribute, get_attribute_property
 from PLATER.services.util.logutil import LoggingUtil
+from PLATER.services.util.post_processing import run_post_processing, message_size, should_shard, format_sharded
 
 logger = LoggingUtil.init_logging(
     __name__,
@@ -20,6 +27,196 @@ logger = LoggingUtil.init_logging(
     config.get('logging_format'),
 )
 
+# placeholder curies compiled into cached cypher templates in place of the curies of a query
+TEMPLATE_ID_PREFIX = 'PLATER_TEMPLATE_ID:'
+# placeholder numbers compiled into cached cypher templates in place of the skip and limit of a page
+TEMPLATE_SKIP = 1000000007
+TEMPLATE_LIMIT = 1000000009
+# attribute constraint operators that compare the same way in cypher, for string and number values
+PUSHDOWN_OPERATORS = {'==': '=', '===': '=', '>': '>', '<': '<'}
+# queries sent to neo4j for one lookup before giving up on fitting its response in the byte budget
+BUDGET_ATTEMPTS = 3
+# errors compiling a query graph to cypher, caused by the query graph itself
+TRANSPILER_ERRORS = (InvalidPredicateError, InvalidQualifierError, InvalidQualifierValueError, UnsupportedError)
+
+
+# clauses ending the leading MATCH clauses of a compiled query, WITH of STARTS WITH and ENDS WITH is an operator
+NEXT_CLAUSE = re.compile(r'(?<!STARTS )(?<!ENDS )\b(WITH|RETURN|CALL|UNWIND|UNION)\b')
+
+
+def push_down_filter(cypher: str, cypher_filter: str):
+    """
+    Filters the matches of a compiled query before anything else happens to them, with a WITH * WHERE clause right
+    after its MATCH clauses. The transpiler starts a query with one MATCH clause per edge and one per expanded
+    subclass hierarchy, then assembles the results, so every query node and edge variable is bound at that point.
+    :param cypher: compiled query
+    :param cypher_filter: cypher boolean expression on the query node and edge variables
+    :return: filtered query, or None if the query doesn't start with the MATCH clauses this relies on
+    """
+    if not cypher.lstrip().startswith('MATCH') or 'OPTIONAL MATCH' in cypher:
+        return None
+    next_clause = NEXT_CLAUSE.search(cypher)
+    if next_clause is None:
+        return None
+    # the filter must see every variable, so no MATCH clause may come after it
+    if re.search(r'\bMATCH\b', cypher[next_clause.start():]):
+        return None
+    # the filter must stay in the scope of the MATCH clauses, not end up behind the end of a subquery
+    match_clauses = cypher[:next_clause.start()]
+    if match_clauses.count('{') != match_clauses.count('}'):
+        return None
+    return f"{match_clauses}WITH * WHERE {cypher_filter} {cypher[next_clause.start():]}"
+
+
+def page_order(query_graph: dict) -> str:
+    """
+    Sort keys giving the results of a query the same order on every run and every replica, so consecutive pages
+    neither repeat nor miss results. Results are grouped by the nodes bound to the query nodes that aren't sets, so
+    their curies, and the curies of the superclasses they were matched through, tell the results apart. Internal
+    edge ids aren't used, they differ between replicas.
+    :param query_graph: query graph of the query
+    :return: cypher ORDER BY expressions on the assembled result
+    """
+    keys = []
+    for qnode_id, qnode in query_graph.get('nodes', {}).items():
+        if qnode.get('is_set') or qnode.get('set_interpretation') == 'ALL':
+            continue
+        binding = f"result.node_bindings.`{qnode_id.replace('`', '``')}`[0]"
+        keys += [f"{binding}.id", f"{binding}.query_id"]
+    return ", ".join(keys)
+
+
+def order_pages(cypher: str, order_by: str, skip) -> str:
+    """
+    Sorts the results of a paged query before they are skipped.
+    :return: sorted query, or None if the query doesn't have exactly one SKIP clause
+    """
+    if not order_by:
+        # every query node is a set, there's a single result at most
+        return cypher
+    literal = f"SKIP {skip} "
+    if cypher.count(literal) != 1:
+        return None
+    return cypher.replace(literal, f"ORDER BY {order_by} {literal}")
+
+
+@lru_cache(maxsize=int(config.get('CYPHER_TEMPLATE_CACHE_SIZE', 1000)))
+def compile_cypher_template(template_key: bytes):
+    """
+    Compiles a query graph with placeholder curies to cypher, replacing the placeholders with cypher parameters.
+    :param template_key: json with the query graph, the placeholders, the literals to turn into parameters and
+        the get_query arguments
+    :return: cypher template, or None if the placeholders could not be replaced unambiguously
+    :rtype: str
+    """
+    template = orjson.loads(template_key)
+    cypher = get_query(template['query_graph'], **template['kwargs'])
+    if template['filter']:
+        cypher = push_down_filter(cypher, template['filter']) or cypher
+    if template['literals']:
+        # a page is only well defined in a deterministic order
+        cypher = order_pages(cypher, page_order(template['query_graph']), TEMPLATE_SKIP)
+        if cypher is None:
+            return None
+    for parameter_name, placeholders in template['placeholders']:
+        placeholder_literals = ", ".join(cypher_expression.dumps(placeholder) for placeholder in placeholders)
+        # a single curie is matched as a node property, several with an IN list
+        literal = placeholder_literals if len(placeholders) == 1 else f"[{placeholder_literals}]"
+        if cypher.count(literal) != 1:
+            return None
+        cypher = cypher.replace(literal, f"${parameter_name}")
+    for parameter_name, keyword, value in template['literals']:
+        literal = f"{keyword} {value}"
+        if cypher.count(literal) != 1:
+            return None
+        cypher = cypher.replace(literal, f"{keyword} ${parameter_name}")
+    if TEMPLATE_ID_PREFIX in cypher:
+        return None
+    return cypher
+
+
+# lists of vocabulary terms, like categories, shared by every node with the same list
+shared_vocabulary_lists = {}
+MAX_SHARED_VOCABULARY_LISTS = 100000
+
+
+def share_vocabulary_list(values: list) -> list:
+    """
+    Returns a shared list of interned strings equal to the given list, so a response holds every distinct list of
+    terms once instead of once per node. Shared lists must not be modified.
+    """
+    key = tuple(values)
+    shared = shared_vocabulary_lists.get(key)
+    if shared is None:
+        if len(shared_vocabulary_lists) >= MAX_SHARED_VOCABULARY_LISTS:
+            return values
+        shared = shared_vocabulary_lists[key] = [sys.intern(value) if type(value) is str else value
+                                                 for value in values]
+    return shared
+
+
+# This function takes 'sources' results from the transpiler, converts lists of aggregator sources into the proper
+# TRAPI dictionaries, and assigns the proper upstream ids to each resource. It does not currently attempt to avoid
+# duplicate aggregator results, which probably shouldn't ever occur.
+# Trees are cached and shared between all the edges with the same sources, they must not be modified.
+@lru_cache(maxsize=int(config.get('SOURCES_TREE_CACHE_SIZE', 10000)))
+def construct_sources_tree(source_key: tuple, plater_provenance: str):
+    # TODO - The transpiler currently returns some null resource ids, partially due to the cypher call
+    #  implementation and partially due to currently supporting knowledge source attributes with and
+    #  without biolink prefixes. In the future it would be more efficient to remove the following two checks.
+    #
+    # remove null or empty string resources, and the biolink prefix if it exists
+    sources = [{'resource_id': list(resource_id) if isinstance(resource_id, tuple) else resource_id,
+                'resource_role': resource_role.removeprefix('biolink:')}
+               for resource_role, resource_id in source_key if resource_id]
+
+    # first find the primary knowledge source, there should always be one
+    primary_knowledge_source = None
+    formatted_sources = None
+    for source in sources:
+        if source['resource_role'] == "primary_knowledge_source":
+            primary_knowledge_source = source['resource_id']
+            # add it to the formatted TRAPI output
+            formatted_sources = [{
+                "resource_id": primary_knowledge_source,
+                "resource_role": "primary_knowledge_source"
+            }]
+    if not primary_knowledge_source:
+        # we could hard fail here, every edge should have a primary ks, but I haven't fixed all the tests yet
+        #     raise KeyError(f'primary_knowledge_source missing from sources section of cypher results! '
+        #                    f'sources: {sources}')
+        return []
+
+    # then find any aggregator lists
+    aggregator_list_sources = []
+    for source in sources:
+        # this looks weird but the idea is that you could have a few parallel lists like:
+        # aggregator_knowledge_source, aggregator_knowledge_source_2, aggregator_knowledge_source_3
+        if source['resource_role'].startswith("aggregator_knowledge_source"):
+            aggregator_list_sources.append(source)
+    # walk through the aggregator lists and construct the chains of provenance
+    terminal_aggregators = set()
+    for source in aggregator_list_sources:
+        # each aggregator list should be in order, so we can deduce the upstream chains
+        last_aggregator = None
+        for aggregator_knowledge_source in source['resource_id']:
+            formatted_sources.append({
+                "resource_id": aggregator_knowledge_source,
+                "resource_role": "aggregator_knowledge_source",
+                "upstream_resource_ids": [last_aggregator] if last_aggregator else [primary_knowledge_source]
+            })
+            last_aggregator = aggregator_knowledge_source
+        # store the last aggregator in the list, because this will be an upstream source for the plater one
+        terminal_aggregators.add(last_aggregator)
+    # add the plater infores as an aggregator,
+    # it will have as upstream either the primary ks or all of the furthest downstream aggregators if they exist
+    formatted_sources.append({
+        "resource_id": plater_provenance,
+        "resource_role": "aggregator_knowledge_source",
+        "upstream_resource_ids": list(terminal_aggregators) if terminal_aggregators else [primary_knowledge_source]
+    })
+    return list(formatted_sources)
+
 
 class Question:
     # SPEC VARS
@@ -39,132 +236,262 @@ class Question:
     CURIE_KEY = 'curie'
 
     def __init__(self, question_json):
-        self._question_json = copy.deepcopy(question_json)
+        # the question takes ownership of the message, it's updated in place with the answer
+        self._question_json = question_json
 
         self.plater_provenance = config.get('PROVENANCE_TAG', 'infores:plater.notspecified')
         self.results_limit = self.get_positive_int_from_config('RESULTS_LIMIT', None)
         self.subclass_depth = self.get_positive_int_from_config('SUBCLASS_DEPTH', 1)
+        self.id_chunk_size = self.get_positive_int_from_config('ID_CHUNK_SIZE', 5000)
+        self.id_chunk_concurrency = self.get_positive_int_from_config('ID_CHUNK_CONCURRENCY', 4) or 1
+        # vocabulary strings repeated across the knowledge graph are held once
+        self.intern_strings = config.get('INTERN_RESPONSE_STRINGS', 'true') not in ('false', 'False')
+        self.page_size = None
+        self.page_offset = 0
+        self.has_next_page = False
+        # most bytes of neo4j response read for a lookup, bigger responses are truncated
+        self.response_byte_budget = self.get_positive_int_from_config('RESPONSE_BYTE_BUDGET', None)
+        self.truncated = False
+        # TRAPI log entries for the response, explaining how the answer was truncated
+        self.logs = []
+        # attribute constraints checked in neo4j, by query node and edge id
+        self.pushed_down_constraints = {'nodes': {}, 'edges': {}}
+
+    def set_page(self, page_size: int, page_offset: int = 0):
+        """
+        Only answers with one page of the results, instead of the first results up to the results limit.
+        :param page_size: results per page, pages are never bigger than the results limit
+        :param page_offset: results before the page
+        """
+        self.page_size = min(page_size, self.results_limit) if self.results_limit else page_size
+        self.page_offset = page_offset
 
     def compile_cypher(self, **kwargs):
-        query_graph = copy.deepcopy(self._question_json[Question.QUERY_GRAPH_KEY])
-        edges = query_graph.get('edges')
+        """
+        Compiles the query graph to cypher, passing the curies of the query nodes as cypher parameters.
+        The cypher is compiled once per query graph shape, queries only differing in their curies reuse it.
+        :return: cypher query and its parameters
+        :rtype: tuple
+        """
+        # the query graph in the message is left as it is, only the parts that change get copied
+        query_graph = {**self._question_json[Question.QUERY_GRAPH_KEY]}
+        edges = query_graph['edges'] = {**query_graph.get('edges', {})}
         for e in edges:
             # removes "biolink:" from qualifier constraint names. since these are not encoded in the graph.
             if edges[e]['qualifier_constraints']:
-                for qualifier in edges[e]['qualifier_constraints']:
-                    for item in qualifier['qualifier_set']:
-                        item['qualifier_type_id'] = item['qualifier_type_id'].removeprefix('biolink:')
-        return get_query(query_graph, **kwargs)
-
-    # This function takes 'sources' results from the transpiler, converts lists of aggregator sources into the proper
-    # TRAPI dictionaries, and assigns the proper upstream ids to each resource. It does not currently attempt to avoid
-    # duplicate aggregator results, which probably shouldn't ever occur.
+                edges[e] = {**edges[e], 'qualifier_constraints': [
+                    {**qualifier, 'qualifier_set': [
+                        {**item, 'qualifier_type_id': item['qualifier_type_id'].removeprefix('biolink:')}
+                        for item in qualifier['qualifier_set']
+                    ]}
+                    for qualifier in edges[e]['qualifier_constraints']
+                ]}
+        # swap the curies for placeholders, one for a single curie and two for any longer list
+        parameters = {}
+        placeholders = []
+        curies = {}
+        nodes = query_graph['nodes'] = {**query_graph.get('nodes', {})}
+        for index, (qnode_id, qnode) in enumerate(nodes.items()):
+            ids = qnode.get('ids')
+            if not isinstance(ids, list) or not ids:
+                continue
+            curies[qnode_id] = ids
+            qnode = nodes[qnode_id] = {**qnode}
+            if len(ids) == 1:
+                parameter_name = f'id_{index}'
+                parameters[parameter_name] = str(ids[0])
+                qnode['ids'] = [f'{TEMPLATE_ID_PREFIX}{index}']
+            else:
+                parameter_name = f'ids_{index}'
+                parameters[parameter_name] = [str(curie) for curie in ids]
+                qnode['ids'] = [f'{TEMPLATE_ID_PREFIX}{index}_0', f'{TEMPLATE_ID_PREFIX}{index}_1']
+            placeholders.append([parameter_name, qnode['ids']])
+        # the transpiler leaves attribute constraints alone and their values are cypher parameters, so only what
+        # they check tells templates apart
+        for qnode_id, qnode in nodes.items():
+            if qnode.get('constraints'):
+                nodes[qnode_id] = {**qnode, 'constraints': self.constraint_template_keys(qnode['constraints'])}
+        for e in edges:
+            if edges[e].get('attribute_constraints'):
+                edges[e] = {**edges[e],
+                            'attribute_constraints': self.constraint_template_keys(edges[e]['attribute_constraints'])}
+        # attribute constraints that neo4j can check are compiled into the query
+        cypher_filter, filter_parameters, pushed_down_constraints = \
+            self.compile_constraint_filter(self._question_json[Question.QUERY_GRAPH_KEY])
+        parameters.update(filter_parameters)
+        # pages share a template, their skip and limit are parameters too
+        literals = []
+        template_kwargs = kwargs
+        if kwargs.get('skip') is not None:
+            parameters['page_skip'] = kwargs['skip']
+            parameters['page_limit'] = kwargs['limit']
+            literals = [['page_skip', 'SKIP', TEMPLATE_SKIP], ['page_limit', 'LIMIT', TEMPLATE_LIMIT]]
+            template_kwargs = {**kwargs, 'skip': TEMPLATE_SKIP, 'limit': TEMPLATE_LIMIT}
+        template = compile_cypher_template(orjson.dumps({'query_graph': query_graph,
+                                                         'placeholders': placeholders,
+                                                         'literals': literals,
+                                                         'filter': cypher_filter,
+                                                         'kwargs': template_kwargs}))
+        if template is not None:
+            self._set_pushed_down_constraints(template, cypher_filter, pushed_down_constraints, parameters)
+            return template, parameters
+        # the placeholders couldn't be found in the cypher, compile with the curies inlined
+        for qnode_id, ids in curies.items():
+            query_graph['nodes'][qnode_id]['ids'] = ids
+        cypher = get_query(query_graph, **kwargs)
+        if kwargs.get('skip') is not None:
+            cypher = order_pages(cypher, page_order(query_graph), kwargs['skip'])
+            if cypher is None:
+                raise UnsupportedError('Paging is not supported for this query.')
+        if cypher_filter:
+            cypher = push_down_filter(cypher, cypher_filter) or cypher
+        self._set_pushed_down_constraints(cypher, cypher_filter, pushed_down_constraints, filter_parameters)
+        return cypher, filter_parameters
+
+    @staticmethod
+    def constraint_template_keys(constraints: list) -> list:
+        """
+        Returns the attribute constraints as they are compiled into a cypher template, without their values.
+        """
+        return [{'id': constraint.get('id'), 'operator': constraint.get('operator')} for constraint in constraints]
+
+    def _set_pushed_down_constraints(self, cypher, cypher_filter, pushed_down_constraints, parameters):
+        if cypher_filter and f"WITH * WHERE {cypher_filter} " in cypher:
+            self.pushed_down_constraints = pushed_down_constraints
+            return
+        # the filter couldn't be added to the query, every constraint is checked after the query
+        self.pushed_down_constraints = {'nodes': {}, 'edges': {}}
+        for parameter_name in [name for name in parameters if name.startswith('constraint_')]:
+            del parameters[parameter_name]
+
+    @staticmethod
+    def compile_constraint_filter(query_graph: dict) -> tuple:
+        """
+        Compiles the attribute constraints of a query graph that compare the same way in cypher, on attributes stored
+        in a single graph property, to a cypher filter. Constraint values are passed as cypher parameters.
+        :param query_graph: TRAPI query graph
+        :return: cypher filter or None, its parameters and the indexes of the constraints it covers per query node
+            and edge
+        :rtype: tuple
+        """
+        filters = []
+        parameters = {}
+        pushed_down_constraints = {'nodes': {}, 'edges': {}}
+        for kind, constraints_key in (('nodes', 'constraints'), ('edges', 'attribute_constraints')):
+            for q_id, q_item in (query_graph.get(kind) or {}).items():
+                for index, constraint in enumerate(q_item.get(constraints_key) or []):
+                    operator = getattr(constraint.get('operator'), 'value', constraint.get('operator'))
+                    cypher_operator = PUSHDOWN_OPERATORS.get(operator)
+                    value = constraint.get('value')
+                    # booleans are numbers to the python operators but not to cypher, and only numbers are ordered
+                    if cypher_operator is None or isinstance(value, bool) or \
+                            not isinstance(value, (str, numbers.Number)) or \
+                            (cypher_operator != '=' and isinstance(value, str)) or '`' in q_id:
+                        continue
+                    property_name = get_attribute_property(constraint.get('id') or '')
+                    if property_name is None:
+                        continue
+                    parameter_name = f'constraint_{len(parameters)}'
+                    parameters[parameter_name] = value
+                    cypher_property = f'`{q_id}`.`{property_name}`'
+                    # the constraint value is on the left, like in the python operators, and a comparison of
+                    # different types is null in cypher but false for the python operators
+                    comparison = f'coalesce(${parameter_name} {cypher_operator} {cypher_property}, false)'
+                    filters.append(f'({cypher_property} IS NOT NULL AND NOT {comparison})'
+                                   if constraint.get('not') else comparison)
+                    pushed_down_constraints[kind].setdefault(q_id, set()).add(index)
+        return (' AND '.join(filters) or None), parameters, pushed_down_constraints
+
     def _construct_sources_tree(self, sources):
-        # TODO - The transpiler currently returns some null resource ids, partially due to the cypher call
-        #  implementation and partially due to currently supporting knowledge source attributes with and
-        #  without biolink prefixes. In the future it would be more efficient to remove the following two checks.
-        #
-        # remove null or empty string resources
-        sources = [source for source in sources if source['resource_id']]
-        # remove biolink prefix if it exists
-        for source in sources:
-            source['resource_role'] = source['resource_role'].removeprefix('biolink:')
-
-        # first find the primary knowledge source, there should always be one
-        primary_knowledge_source = None
-        formatted_sources = None
-        for source in sources:
-            if source['resource_role'] == "primary_knowledge_source":
-                primary_knowledge_source = source['resource_id']
-                # add it to the formatted TRAPI output
-                formatted_sources = [{
-                    "resource_id": primary_knowledge_source,
-                    "resource_role": "primary_knowledge_source"
-                }]
-        if not primary_knowledge_source:
-            # we could hard fail here, every edge should have a primary ks, but I haven't fixed all the tests yet
-            #     raise KeyError(f'primary_knowledge_source missing from sources section of cypher results! '
-            #                    f'sources: {sources}')
-            return []
-
-        # then find any aggregator lists
-        aggregator_list_sources = []
-        for source in sources:
-            # this looks weird but the idea is that you could have a few parallel lists like:
-            # aggregator_knowledge_source, aggregator_knowledge_source_2, aggregator_knowledge_source_3
-            if source['resource_role'].startswith("aggregator_knowledge_source"):
-                aggregator_list_sources.append(source)
-        # walk through the aggregator lists and construct the chains of provenance
-        terminal_aggregators = set()
-        for source in aggregator_list_sources:
-            # each aggregator list should be in order, so we can deduce the upstream chains
-            last_aggregator = None
-            for aggregator_knowledge_source in source['resource_id']:
-                formatted_sources.append({
-                    "resource_id": aggregator_knowledge_source,
-                    "resource_role": "aggregator_knowledge_source",
-                    "upstream_resource_ids": [last_aggregator] if last_aggregator else [primary_knowledge_source]
-                })
-                last_aggregator = aggregator_knowledge_source
-            # store the last aggregator in the list, because this will be an upstream source for the plater one
-            terminal_aggregators.add(last_aggregator)
-        # add the plater infores as an aggregator,
-        # it will have as upstream either the primary ks or all of the furthest downstream aggregators if they exist
-        formatted_sources.append({
-            "resource_id": self.plater_provenance,
-            "resource_role": "aggregator_knowledge_source",
-            "upstream_resource_ids": list(terminal_aggregators) if terminal_aggregators else [primary_knowledge_source]
-        })
-        return list(formatted_sources)
+        # a graph has few distinct combinations of sources, each is only turned into a tree once
+        try:
+            source_key = tuple((source['resource_role'],
+                                tuple(source['resource_id']) if isinstance(source['resource_id'], list)
+                                else source['resource_id'])
+                               for source in sources)
+            return construct_sources_tree(source_key, self.plater_provenance)
+        except TypeError:
+            # unhashable resource ids, build the tree without the cache
+            return construct_sources_tree.__wrapped__(tuple((source['resource_role'], source['resource_id'])
+                                                            for source in sources), self.plater_provenance)
 
     def format_attribute_trapi(self, kg_items, node=False):
         for identifier in kg_items:
             # get the properties for the record
             props = kg_items[identifier]
 
-            # save the transpiler attribs
-            attributes = props.get('attributes', [])
+            # save the transpiler attribs, with the classification of their names
+            attributes = [(attribute, classify_attribute(attribute['original_attribute_name'],
+                                                         attribute.get('attribute_type_id')))
+                          for attribute in props.get('attributes', [])]
+
+            if self.intern_strings:
+                if node:
+                    if isinstance(props.get('categories'), list):
+                        props['categories'] = share_vocabulary_list(props['categories'])
+                elif type(props.get('predicate')) is str:
+                    props['predicate'] = sys.intern(props['predicate'])
 
             # for edges handle qualifiers and provenance/sources
             if not node:
-                # separate the qualifiers from other attributes
-                qualifiers = [attribute for attribute in attributes
-                              if bmt.is_qualifier(attribute['original_attribute_name'])]
+                # format the qualifiers with type_id and value, 'biolink:' prefixes are added if needed
+                qualifiers = [{"qualifier_type_id": classification.qualifier_type_id,
+                               "qualifier_value": sys.intern(attribute['value'])
+                               if self.intern_strings and type(attribute['value']) is str else attribute['value']}
+                              for attribute, classification in attributes if classification.is_qualifier]
                 if qualifiers:
-                    # format the qualifiers with type_id and value and add 'biolink:' prefixes if needed
-                    props['qualifiers'] = [
-                        {"qualifier_type_id": f"biolink:{qualifier['original_attribute_name']}"
-                            if not qualifier['original_attribute_name'].startswith("biolink:")
-                            else qualifier['original_attribute_name'],
-                         "qualifier_value": qualifier['value']}
-                        for qualifier in qualifiers
-                    ]
+                    props['qualifiers'] = qualifiers
 
                 # construct the sources TRAPI from the sources results from the transpiler
                 kg_items[identifier]["sources"] = self._construct_sources_tree(kg_items[identifier].get("sources", []))
 
             # create a list of attributes that doesn't include the core properties, skipped attributes, or qualifiers
-            other_attributes = [attribute for attribute in attributes
-                                if attribute['original_attribute_name'] not in props
-                                and not bmt.is_qualifier(attribute['original_attribute_name'])
-                                and attribute['original_attribute_name'] not in skip_list]
-            for attr in other_attributes:
+            other_attributes = []
+            for attr, classification in attributes:
+                if classification.is_qualifier or classification.skip or attr['original_attribute_name'] in props:
+                    continue
                 # make sure the original_attribute_name has something other than none
-                attr['original_attribute_name'] = attr['original_attribute_name'] or ''
+                attr['original_attribute_name'] = classification.attribute_name if self.intern_strings \
+                    else attr['original_attribute_name'] or ''
 
                 # map the attribute data using the biolink model and optionally custom attribute mapping
-                attribute_data = get_attribute_info(attr["original_attribute_name"], attr.get("attribute_type_id", None))
-                if attribute_data:
-                    attr.update(attribute_data)
+                if classification.attribute_info:
+                    attr.update(classification.attribute_info)
+                other_attributes.append(attr)
 
             # assign the filtered and formatted attributes back to the original attrib list
             props['attributes'] = other_attributes
 
         return kg_items
 
+    def share_sharded_values(self, nodes: dict, edges: dict):
+        """
+        Shares the values repeated across a knowledge graph formatted by worker processes, which come back as separate
+        copies per node or edge: category lists, predicates and sources trees.
+        """
+        sources_trees = {}
+        for edge in edges.values():
+            if self.intern_strings and type(edge.get('predicate')) is str:
+                edge['predicate'] = sys.intern(edge['predicate'])
+            if edge.get('sources'):
+                edge['sources'] = sources_trees.setdefault(orjson.dumps(edge['sources']), edge['sources'])
+        if self.intern_strings:
+            for node in nodes.values():
+                if isinstance(node.get('categories'), list):
+                    node['categories'] = share_vocabulary_list(node['categories'])
+
     def transform_attributes(self, trapi_message):
-        self.format_attribute_trapi(trapi_message.get('knowledge_graph', {}).get('nodes', {}), node=True)
-        self.format_attribute_trapi(trapi_message.get('knowledge_graph', {}).get('edges', {}))
+        knowledge_graph = trapi_message.get('knowledge_graph', {})
+        if should_shard(len(knowledge_graph.get('nodes', {})) + len(knowledge_graph.get('edges', {}))):
+            # very large knowledge graphs are formatted by several processes
+            knowledge_graph['nodes'] = format_sharded(knowledge_graph.get('nodes', {}), True,
+                                                      self.format_attribute_trapi)
+            knowledge_graph['edges'] = format_sharded(knowledge_graph.get('edges', {}), False,
+                                                      self.format_attribute_trapi)
+            self.share_sharded_values(knowledge_graph['nodes'], knowledge_graph['edges'])
+        else:
+            self.format_attribute_trapi(knowledge_graph.get('nodes', {}), node=True)
+            self.format_attribute_trapi(knowledge_graph.get('edges', {}))
         for r in trapi_message.get("results", []):
             # add an attributes list to every node binding, remove query_id when it's redundant with the actual id
             for node_binding_list in r["node_bindings"].values():
@@ -180,10 +507,11 @@ class Question:
                         edge_binding["attributes"] = []
         return trapi_message
 
-    async def answer(self, graph_interface: GraphInterface):
+    async def answer(self, graph_interface: GraphInterface, deadline: float = None):
         """
         Updates the query graph with answers from the neo4j backend
         :param graph_interface: interface for neo4j
+        :param deadline: epoch seconds after which neo4j should stop working on the query
         :return: None
         """
         # get a reference to the current opentelemetry span
@@ -192,17 +520,14 @@ class Question:
             otel_span = None
 
         # compile a cypher query and return a string
-        cypher_query = self.compile_cypher(**{"use_hints": True,
-                                              "relationship_id": "internal",
-                                              "limit": self.results_limit,
-                                              "subclass_depth": self.subclass_depth})
+        cypher_query, cypher_parameters = self.compile_cypher(**self.get_query_kwargs())
         # convert the incoming TRAPI query into a string for logging and tracing
         trapi_query = str(orjson.dumps(self._question_json), "utf-8")
         # create a probably-unique id to be associated with this query in the logs
         query_logging_id = token_hex(10)
         logger.info(f"querying neo4j for query {query_logging_id}, trapi: {trapi_query}")
         start_time = time.time()
-        results = await graph_interface.run_cypher(cypher_query)
+        results_dict = await self.run_lookup(graph_interface, cypher_query, cypher_parameters, deadline)
         neo4j_duration = time.time() - start_time
         logger.info(f"returned results from neo4j for {query_logging_id}, neo4j_duration: {neo4j_duration}")
         if otel_span is not None:
@@ -213,23 +538,230 @@ class Question:
                     "query_logging_id": query_logging_id
                 }
             )
-        results_dict = graph_interface.convert_to_dict(results)
-        self._question_json.update(self.transform_attributes(results_dict[0]))
-        self._question_json = Question.apply_attribute_constraints(self._question_json)
+        # formatting and filtering large results would hold up the event loop
+        return await run_post_processing(self.answer_from_results, results_dict[0],
+                                         size=message_size(results_dict[0]))
+
+    async def run_lookup(self, graph_interface: GraphInterface, cypher_query: str, cypher_parameters: dict,
+                         deadline: float = None) -> list:
+        """
+        Runs the compiled cypher of the query graph, split into chunks of curies if it pins too many of them, and
+        within the byte budget.
+        :return: rows of the result
+        """
+        parameter_chunks = self.chunk_parameters(cypher_parameters)
+        if len(parameter_chunks) == 1:
+            return await self.run_within_budget(graph_interface, cypher_query, cypher_parameters, deadline)
+        logger.info(f"splitting query into {len(parameter_chunks)} chunks")
+        return [await self.run_chunks(graph_interface, cypher_query, parameter_chunks, deadline)]
+
+    def chunk_parameters(self, parameters: dict) -> list:
+        """
+        Splits the longest list of curies in the parameters into chunks of at most id_chunk_size curies.
+        Query nodes that are sets aren't split, their results need all the curies at once.
+        :param parameters: cypher parameters of the query
+        :return: list of cypher parameters, one per chunk
+        """
+        # chunks would each return their own page
+        if not self.id_chunk_size or not parameters or self.page_size:
+            return [parameters]
+        set_parameters = {f'ids_{index}'
+                          for index, qnode in enumerate(self._question_json[Question.QUERY_GRAPH_KEY]
+                                                        .get('nodes', {}).values())
+                          if qnode.get('is_set')}
+        list_parameters = [name for name, value in parameters.items()
+                           if isinstance(value, list) and name not in set_parameters]
+        if not list_parameters:
+            return [parameters]
+        chunked_name = max(list_parameters, key=lambda name: len(parameters[name]))
+        curies = parameters[chunked_name]
+        if len(curies) <= self.id_chunk_size:
+            return [parameters]
+        return [{**parameters, chunked_name: curies[start: start + self.id_chunk_size]}
+                for start in range(0, len(curies), self.id_chunk_size)]
+
+    async def run_chunks(self, graph_interface: GraphInterface, cypher_query: str, parameter_chunks: list,
+                         deadline: float = None) -> dict:
+        """
+        Runs the cypher once per chunk of parameters, at most id_chunk_concurrency at a time, and merges the results.
+        Nodes and edges found by several chunks are only kept once.
+        :return: merged row with the knowledge graph and the results
+        """
+        semaphore = asyncio.Semaphore(self.id_chunk_concurrency)
+        # the chunks share the byte budget, a chunk running over its share is left out
+        budget_kwargs = {'byte_budget': max(self.response_byte_budget // len(parameter_chunks), 1)} \
+            if self.response_byte_budget else {}
+        dropped_chunks = []
+
+        async def run_chunk(parameters):
+            async with semaphore:
+                try:
+                    return await graph_interface.run_cypher_rows(cypher_query, parameters=parameters,
+                                                                 deadline=deadline, **budget_kwargs)
+                except ResponseBudgetExceeded as e:
+                    logger.warning(f'Dropping a chunk of the query: {e}')
+                    dropped_chunks.append(parameters)
+                    return []
+
+        chunk_rows = await asyncio.gather(*[run_chunk(parameters) for parameters in parameter_chunks])
+        if dropped_chunks:
+            self.add_truncation_log(f'The results of {len(dropped_chunks)} of {len(parameter_chunks)} chunks of '
+                                    f'query curies were left out, their responses exceeded the response size budget.')
+        nodes = {}
+        edges = {}
+        results = []
+        merged = {}
+        for rows in chunk_rows:
+            for row in rows:
+                nodes.update(row['knowledge_graph']['nodes'])
+                edges.update(row['knowledge_graph']['edges'])
+                results.extend(row['results'])
+                # any other columns are merged by type, maps are combined and lists concatenated
+                for column, value in row.items():
+                    if column in ('knowledge_graph', 'results'):
+                        continue
+                    if column not in merged:
+                        merged[column] = value
+                    elif isinstance(value, dict):
+                        merged[column] = {**merged[column], **value}
+                    elif isinstance(value, list):
+                        merged[column] = merged[column] + value
+        if self.results_limit is not None and len(results) > self.results_limit:
+            results = results[:self.results_limit]
+            nodes, edges = Question.get_bound_knowledge_graph(results, nodes, edges)
+        return {**merged, 'knowledge_graph': {'nodes': nodes, 'edges': edges}, 'results': results}
+
+    @staticmethod
+    def get_bound_knowledge_graph(results: list, nodes: dict, edges: dict) -> tuple:
+        """
+        Keeps the knowledge graph nodes and edges the results are bound to, and the nodes those edges connect.
+        :return: kept nodes and edges
+        :rtype: tuple
+        """
+        bound_edges = {}
+        for result in results:
+            for analysis in result.get('analyses', []):
+                for edge_binding_list in analysis.get('edge_bindings', {}).values():
+                    for edge_binding in edge_binding_list:
+                        if edge_binding['id'] in edges:
+                            bound_edges[edge_binding['id']] = edges[edge_binding['id']]
+        bound_node_ids = {node_binding['id']
+                          for result in results
+                          for node_binding_list in result.get('node_bindings', {}).values()
+                          for node_binding in node_binding_list}
+        for edge in bound_edges.values():
+            bound_node_ids.update((edge.get('subject'), edge.get('object')))
+        bound_nodes = {node_id: node for node_id, node in nodes.items() if node_id in bound_node_ids}
+        return bound_nodes, bound_edges
+
+    async def run_within_budget(self, graph_interface: GraphInterface, cypher_query: str, cypher_parameters: dict,
+                                deadline: float = None) -> list:
+        """
+        Runs the cypher, keeping the neo4j response within the byte budget. A response exceeding it is cut off while
+        it's read, and the query is run again for fewer results, so the answer is truncated but still complete.
+        :return: rows of the result
+        """
+        if not self.response_byte_budget:
+            return await graph_interface.run_cypher_rows(cypher_query, parameters=cypher_parameters, deadline=deadline)
+        limit = self.page_size or self.results_limit
+        for attempt in range(BUDGET_ATTEMPTS):
+            try:
+                rows = await graph_interface.run_cypher_rows(cypher_query, parameters=cypher_parameters,
+                                                             deadline=deadline, byte_budget=self.response_byte_budget)
+            except ResponseBudgetExceeded as e:
+                limit = self.get_truncated_limit(e.partial_row, limit)
+                logger.warning(f'{e} Running the query again for {limit} results.')
+                if not limit:
+                    break
+                if self.page_size:
+                    # the next page starts after the truncated one
+                    self.page_size = limit
+                query_kwargs = self.get_query_kwargs()
+                query_kwargs['limit'] = limit
+                cypher_query, cypher_parameters = self.compile_cypher(**query_kwargs)
+                continue
+            if attempt:
+                self.add_truncation_log(f'The response exceeded the response size budget of '
+                                        f'{self.response_byte_budget} bytes, it was truncated to at most {limit} '
+                                        f'results.')
+            return rows
+        self.add_truncation_log(f'No results fit in the response size budget of {self.response_byte_budget} bytes.')
+        return [{'knowledge_graph': {'nodes': {}, 'edges': {}}, 'results': []}]
+
+    @staticmethod
+    def get_truncated_limit(partial_row: dict, limit: int = None) -> int:
+        """
+        Picks a results limit for running a query again, after its response exceeded the byte budget.
+        :param partial_row: row parsed before the response was cut off
+        :param limit: results limit of the query that exceeded the budget
+        :return: new results limit, 0 if there's no sensible one
+        """
+        # the last result parsed may be incomplete
+        complete_results = max(len((partial_row or {}).get('results') or []) - 1, 0)
+        # the knowledge graph of the results needs room in the budget too
+        truncated_limit = complete_results // 2 if complete_results else 0
+        if limit:
+            truncated_limit = min(truncated_limit, limit // 2) if truncated_limit else limit // 2
+        return truncated_limit
+
+    def add_truncation_log(self, message: str):
+        self.truncated = True
+        self.logs.append({'timestamp': datetime.now(timezone.utc).isoformat(),
+                          'level': 'WARNING',
+                          'code': 'ResponseTruncated',
+                          'message': message})
+
+    def get_query_kwargs(self) -> dict:
+        """
+        Returns the arguments the query graph is compiled to cypher with.
+        """
+        if self.page_size:
+            return {"use_hints": True,
+                    "relationship_id": "internal",
+                    "skip": self.page_offset,
+                    "limit": self.page_size,
+                    "subclass_depth": self.subclass_depth}
+        return {"use_hints": True,
+                "relationship_id": "internal",
+                "limit": self.results_limit,
+                "subclass_depth": self.subclass_depth}
+
+    def answer_from_results(self, results: dict):
+        """
+        Updates the query graph with the results of its compiled cypher
+        :param results: row returned by neo4j, with the knowledge graph and the results
+        :return: answered message
+        """
+        # a full page means there may be more, attribute constraints filtering the page don't change that
+        self.has_next_page = bool(self.page_size) and len(results.get('results') or []) >= self.page_size
+        self._question_json.update(self.transform_attributes(results))
+        self._question_json = Question.apply_attribute_constraints(self._question_json,
+                                                                   pushed_down=self.pushed_down_constraints)
         return self._question_json
 
     @staticmethod
-    def apply_attribute_constraints(message):
+    def apply_attribute_constraints(message, pushed_down: dict = None):
         q_nodes = message['query_graph'].get('nodes', {})
         q_edges = message['query_graph'].get('edges', {})
+        # constraints already checked by neo4j are skipped
+        pushed_down_nodes = (pushed_down or {}).get('nodes', {})
+        pushed_down_edges = (pushed_down or {}).get('edges', {})
         node_constraints = {
-            q_id: [AttributeConstraint(**constraint) for constraint in q_nodes[q_id]['constraints']] for q_id in q_nodes
-            if q_nodes[q_id]['constraints']
+            q_id: [AttributeConstraint(**constraint) for index, constraint in enumerate(q_nodes[q_id]['constraints'])
+                   if index not in pushed_down_nodes.get(q_id, ())]
+            for q_id in q_nodes if q_nodes[q_id]['constraints']
         }
+        # constraints are compiled once per query node and edge, not for every attribute checked
+        node_constraints = {q_id: compile_attribute_constraints(constraints)
+                            for q_id, constraints in node_constraints.items() if constraints}
         edge_constraints = {
-            q_id: [AttributeConstraint(**constraint) for constraint in q_edges[q_id]['attribute_constraints']] for q_id in q_edges
-            if q_edges[q_id]['attribute_constraints']
+            q_id: [AttributeConstraint(**constraint)
+                   for index, constraint in enumerate(q_edges[q_id]['attribute_constraints'])
+                   if index not in pushed_down_edges.get(q_id, ())]
+            for q_id in q_edges if q_edges[q_id]['attribute_constraints']
         }
+        edge_constraints = {q_id: compile_attribute_constraints(constraints)
+                            for q_id, constraints in edge_constraints.items() if constraints}
         # if there are no constraints no need to do stuff.
         if not(len(node_constraints) or len(edge_constraints)):
             return message
@@ -248,8 +780,7 @@ class Question:
         nodes_to_filter = set()
         for node_id in constrained_node_ids:
             kg_node = message['knowledge_graph']['nodes'][node_id]
-            attributes = [Attribute(**attr) for attr in kg_node['attributes']]
-            keep = check_attributes(attribute_constraints=constrained_node_ids[node_id], db_attributes=attributes)
+            keep = constrained_node_ids[node_id](kg_node['attributes'])
             if not keep:
                 nodes_to_filter.add(node_id)
         # mark edges for deletion
@@ -261,8 +792,7 @@ class Question:
                 continue
             # else check if edge is in constrained list and do filter
             if edge_id in constrained_edge_ids:
-                attributes = [Attribute(**attr) for attr in edge['attributes']]
-                keep = check_attributes(attribute_constraints=constrained_edge_ids[edge_id], db_attributes=attributes)
+                keep = constrained_edge_ids[edge_id](edge['attributes'])
                 if not keep:
                     edges_to_filter.add(edge_id)
         # remove some nodes
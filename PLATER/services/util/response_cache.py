@@ -0,0 +1,257 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import orjson
+
+from PLATER.services.config import config
+from PLATER.services.util.api_utils import orjson_default
+from PLATER.services.util.logutil import LoggingUtil
+
+logger = LoggingUtil.init_logging(
+    __name__,
+    config.get('logging_level'),
+    config.get('logging_format'),
+)
+
+METADATA_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'metadata', 'metadata.json')
+
+
+def _canonical_json(value) -> bytes:
+    return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+
+
+class CanonicalQueryGraph:
+    """
+    Names the nodes and edges of a query graph by their content instead of the names the requester picked, so
+    query graphs asking the same question produce the same cache key regardless of naming and key order.
+    """
+    # lists where the order of the items doesn't change the question
+    UNORDERED_LISTS = ('ids', 'categories', 'predicates')
+
+    def __init__(self, query_graph: dict, **settings):
+        """
+        :param query_graph: TRAPI query graph
+        :param settings: anything else changing the answer, included in the key
+        """
+        query_graph = query_graph or {}
+        nodes = query_graph.get('nodes') or {}
+        edges = query_graph.get('edges') or {}
+        node_content = {name: self._content(node) for name, node in nodes.items()}
+        edge_content = {name: self._content(edge, exclude=('subject', 'object')) for name, edge in edges.items()}
+
+        # a node is described by its own content and the edges it takes part in, if that still leaves ties the
+        # original names decide, which only costs cache hits, never correctness
+        def node_signature(name):
+            neighbourhood = sorted(
+                [('subject', edge_content[edge_name], node_content[edge['object']])
+                 for edge_name, edge in edges.items() if edge['subject'] == name] +
+                [('object', edge_content[edge_name], node_content[edge['subject']])
+                 for edge_name, edge in edges.items() if edge['object'] == name]
+            )
+            return node_content[name], neighbourhood, name
+        self.node_names = {name: f'n{index}' for index, name in enumerate(sorted(nodes, key=node_signature))}
+
+        def edge_signature(name):
+            edge = edges[name]
+            return (self.node_names[edge['subject']], self.node_names[edge['object']], edge_content[name], name)
+        self.edge_names = {name: f'e{index}' for index, name in enumerate(sorted(edges, key=edge_signature))}
+
+        canonical = {
+            'nodes': {self.node_names[name]: node_content[name] for name in nodes},
+            'edges': {self.edge_names[name]: [self.node_names[edge['subject']], self.node_names[edge['object']],
+                                              edge_content[name]]
+                      for name, edge in edges.items()},
+            'settings': settings
+        }
+        self.key = hashlib.sha256(_canonical_json(canonical)).hexdigest()
+
+    @classmethod
+    def create(cls, query_graph: dict, **settings) -> Optional['CanonicalQueryGraph']:
+        """
+        Canonicalizes a query graph, if it can be.
+        :param query_graph: TRAPI query graph
+        :param settings: anything else changing the answer, included in the key
+        :return: canonical query graph, or None for malformed query graphs, like edges between missing nodes, which
+        are left for the lookup itself to report
+        """
+        try:
+            return cls(query_graph, **settings)
+        except (KeyError, TypeError, AttributeError) as e:
+            logger.debug(f'Could not canonicalize the query graph, not caching it: {e!r}')
+            return None
+
+    @classmethod
+    def _content(cls, element: dict, exclude=()) -> str:
+        content = {}
+        for key, value in element.items():
+            if key in exclude or value is None:
+                continue
+            if key in cls.UNORDERED_LISTS and isinstance(value, list):
+                value = sorted(value, key=_canonical_json)
+            content[key] = value
+        return _canonical_json(content).decode('utf-8')
+
+    @staticmethod
+    def _rename_bindings(message: dict, node_names: dict, edge_names: dict) -> dict:
+        # results and analyses are copied, the message passed in is left as it is
+        results = []
+        for result in message.get('results') or []:
+            result = {**result, 'node_bindings': {node_names.get(q_id, q_id): bindings
+                                                  for q_id, bindings in result['node_bindings'].items()}}
+            if result.get('analyses'):
+                result['analyses'] = [{**analysis, 'edge_bindings': {edge_names.get(q_id, q_id): bindings
+                                                                     for q_id, bindings
+                                                                     in analysis['edge_bindings'].items()}}
+                                      for analysis in result['analyses']]
+            results.append(result)
+        if 'results' in message:
+            message = {**message, 'results': results if message['results'] is not None else None}
+        return message
+
+    def to_canonical(self, message: dict) -> dict:
+        """
+        Renames the bindings of an answered message to the canonical node and edge names.
+        """
+        return self._rename_bindings(message, self.node_names, self.edge_names)
+
+    def from_canonical(self, message: dict) -> dict:
+        """
+        Renames the bindings of a cached message to the node and edge names of this query graph.
+        """
+        return self._rename_bindings(message,
+                                     {canonical: name for name, canonical in self.node_names.items()},
+                                     {canonical: name for name, canonical in self.edge_names.items()})
+
+
+class ResponseCache:
+    """
+    LRU cache of answered TRAPI lookups, bounded by the bytes of the serialized messages and expiring entries after
+    a time to live. The cache empties itself when the graph version in metadata.json changes.
+    """
+    def __init__(self, max_bytes: int, ttl: float, metadata_path: str = METADATA_PATH, version_check_interval=10):
+        """
+        :param max_bytes: total size of the cached messages, 0 disables the cache
+        :param ttl: seconds an entry is kept
+        :param metadata_path: graph metadata file, the cache is cleared when its graph version changes
+        :param version_check_interval: min seconds between checks of the metadata file
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.metadata_path = metadata_path
+        self.version_check_interval = version_check_interval
+        self._entries = OrderedDict()
+        self._size = 0
+        self._metadata_mtime = None
+        self._last_version_check = 0
+        self.graph_version = None
+        self.hits = 0
+        self.misses = 0
+        self._check_graph_version()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _check_graph_version(self):
+        now = time.time()
+        if now - self._last_version_check < self.version_check_interval:
+            return
+        self._last_version_check = now
+        try:
+            mtime = os.path.getmtime(self.metadata_path)
+            if mtime == self._metadata_mtime:
+                return
+            with open(self.metadata_path, 'rb') as metadata_file:
+                raw_metadata = metadata_file.read()
+        except OSError as e:
+            logger.warning(f'Could not read graph metadata for the response cache: {e}')
+            return
+        self._metadata_mtime = mtime
+        try:
+            metadata = orjson.loads(raw_metadata)
+        except orjson.JSONDecodeError:
+            metadata = {}
+        # fall back to the content of the file when there is no explicit version
+        graph_version = (metadata.get('graph_version') if isinstance(metadata, dict) else None) or \
+            hashlib.sha256(raw_metadata).hexdigest()
+        if graph_version != self.graph_version:
+            if self.graph_version is not None:
+                logger.info(f'Graph version changed from {self.graph_version} to {graph_version}, '
+                            f'clearing the response cache.')
+            self.clear()
+            self.graph_version = graph_version
+
+    def get_graph_version(self) -> str:
+        self._check_graph_version()
+        return self.graph_version
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def get(self, query_graph: CanonicalQueryGraph):
+        """
+        Returns a copy of the cached message answering the query graph, with bindings named like the query graph.
+        :param query_graph: canonicalized query graph
+        :return: cached message without the query graph, or None
+        """
+        if not self.enabled:
+            return None
+        self._check_graph_version()
+        entry = self._entries.get(query_graph.key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                self._remove(query_graph.key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(query_graph.key)
+        self.hits += 1
+        return query_graph.from_canonical(orjson.loads(entry[1]))
+
+    def put(self, query_graph: CanonicalQueryGraph, message: dict):
+        """
+        Caches the answer to a query graph.
+        :param query_graph: canonicalized query graph
+        :param message: answered message, the query graph itself isn't cached
+        """
+        if not self.enabled:
+            return
+        self._check_graph_version()
+        cached_message = {key: value for key, value in message.items() if key != 'query_graph'}
+        serialized = orjson.dumps(query_graph.to_canonical(cached_message), default=orjson_default)
+        if len(serialized) > self.max_bytes:
+            return
+        self._remove(query_graph.key)
+        self._entries[query_graph.key] = (time.time() + self.ttl, serialized)
+        self._size += len(serialized)
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def get_stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'graph_version': self.graph_version
+        }
+
+
+response_cache = None
+
+
+def get_response_cache() -> ResponseCache:
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache(max_bytes=int(config.get('RESPONSE_CACHE_MAX_BYTES', 100 * 1024 * 1024)),
+                                       ttl=float(config.get('RESPONSE_CACHE_TTL', 3600)))
+    return response_cache
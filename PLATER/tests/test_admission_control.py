@@ -0,0 +1,105 @@
+import asyncio
+import httpx
+import pytest
+from PLATER.services.util.admission_control import AdaptiveConcurrencyLimiter, AdmissionController, CircuitBreaker, \
+    Neo4jOverloadedError, Neo4jUnavailableError
+
+
+@pytest.mark.asyncio
+async def test_limiter_queues_then_sheds_load():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_limit=1, max_queue=1, queue_timeout=0.1)
+    await limiter.acquire()
+    # one query may wait for the slot, the next one is rejected right away
+    waiting = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    with pytest.raises(Neo4jOverloadedError):
+        await limiter.acquire()
+    await limiter.release(latency=0.01, success=True)
+    await waiting
+    assert limiter.in_flight == 1
+    # nothing frees the slot this time, so the waiting query times out
+    with pytest.raises(Neo4jOverloadedError) as e:
+        await limiter.acquire()
+    assert e.value.retry_after >= 0
+    assert limiter.rejected == 2
+
+
+@pytest.mark.asyncio
+async def test_limiter_aimd():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=10, max_limit=11)
+    for _ in range(20):
+        await limiter.acquire()
+        await limiter.release(latency=0.1, success=True)
+    # additive increase up to the max
+    assert limiter.get_stats()['limit'] == 11
+    # multiplicative decrease when latency climbs well above the baseline
+    await limiter.acquire()
+    await limiter.release(latency=10, success=True)
+    assert limiter.get_stats()['limit'] == 9
+    # and on failures
+    await limiter.acquire()
+    await limiter.release(latency=0.1, success=False)
+    assert limiter.get_stats()['limit'] == 8
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    controller = AdmissionController(limiter=AdaptiveConcurrencyLimiter(),
+                                     circuit_breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+    # errors in queries don't count against the health of neo4j
+    for _ in range(3):
+        with pytest.raises(RuntimeWarning):
+            async with controller.admit():
+                raise RuntimeWarning('Error running cypher')
+    assert controller.circuit_breaker.state == CircuitBreaker.CLOSED
+    for _ in range(2):
+        with pytest.raises(httpx.ConnectError):
+            async with controller.admit():
+                raise httpx.ConnectError('connection refused')
+    assert controller.circuit_breaker.state == CircuitBreaker.OPEN
+    # fail fast without running the query
+    with pytest.raises(Neo4jUnavailableError) as e:
+        async with controller.admit():
+            assert False
+    assert e.value.retry_after > 0
+    assert controller.limiter.in_flight == 0
+    # after the reset timeout a trial query closes the breaker again
+    controller.circuit_breaker.opened_at -= 60
+    async with controller.admit():
+        assert controller.circuit_breaker.state == CircuitBreaker.HALF_OPEN
+    assert controller.circuit_breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_trial_settles():
+    controller = AdmissionController(limiter=AdaptiveConcurrencyLimiter(initial_limit=10),
+                                     circuit_breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+    with pytest.raises(httpx.ConnectError):
+        async with controller.admit():
+            raise httpx.ConnectError('connection refused')
+    assert controller.circuit_breaker.state == CircuitBreaker.OPEN
+    controller.circuit_breaker.opened_at -= 60
+    limit = controller.limiter.limit
+
+    # a cancelled trial tells nothing about neo4j, the next query gets to be the trial
+    async def trial():
+        async with controller.admit():
+            await asyncio.sleep(10)
+    task = asyncio.create_task(trial())
+    await asyncio.sleep(0)
+    assert controller.circuit_breaker.state == CircuitBreaker.HALF_OPEN
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert controller.circuit_breaker.state == CircuitBreaker.OPEN
+    assert controller.limiter.in_flight == 0
+    assert controller.limiter.latency_baseline is None
+    assert controller.limiter.limit == limit
+
+    # a trial failing with an error in its cypher means neo4j answered
+    with pytest.raises(RuntimeWarning):
+        async with controller.admit():
+            raise RuntimeWarning('Error running cypher')
+    assert controller.circuit_breaker.state == CircuitBreaker.CLOSED
+    assert controller.limiter.latency_baseline is None
+    assert controller.limiter.in_flight == 0
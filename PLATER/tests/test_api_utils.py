@@ -0,0 +1,23 @@
+import orjson
+
+from PLATER.services.util.api_utils import iter_trapi_json, orjson_default
+
+
+def test_iter_trapi_json():
+    content = {
+        "message": {
+            "query_graph": {"nodes": {"n0": {"ids": ["CURIE:1"]}}, "edges": {}},
+            "knowledge_graph": {"nodes": {f"CURIE:{i}": {"name": f"node {i}", "categories": {"biolink:Gene"}}
+                                          for i in range(1000)},
+                                "edges": {}},
+            "results": [{"node_bindings": {"n0": [{"id": f"CURIE:{i}"}]}} for i in range(1000)],
+            "auxiliary_graphs": None
+        },
+        "workflow": [{"id": "lookup"}]
+    }
+    expected = orjson.loads(orjson.dumps(content, default=orjson_default))
+    chunks = list(iter_trapi_json(content, buffer_size=1024))
+    assert len(chunks) > 1
+    assert orjson.loads(b"".join(chunks)) == expected
+    # the content is released while it's written
+    assert content == {}
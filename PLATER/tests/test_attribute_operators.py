@@ -210,4 +210,26 @@ def test_check_constraint():
     )
     assert not check_attribute_constraint(
         negated_constraint, ['a']
-    )
\ No newline at end of file
+    )
+
+def test_compile_attribute_constraints():
+    check = compile_attribute_constraints([
+        AttributeConstraint(**{'id': 'biolink:p_value', 'operator': '>', 'value': 0.05, 'name': 'p value'}),
+        AttributeConstraint(**{'id': 'biolink:publications', 'operator': '==', 'value': ['PMID:1', 'PMID:2'],
+                               'name': 'publications'}),
+        AttributeConstraint(**{'id': 'biolink:description', 'operator': 'matches', 'value': 'gene.*',
+                               'name': 'description', 'not': True}),
+    ])
+    attributes = [
+        {'attribute_type_id': 'biolink:p_value', 'value': 0.01},
+        {'attribute_type_id': 'biolink:publications', 'value': ['PMID:2', 'PMID:3']},
+        {'attribute_type_id': 'biolink:description', 'value': 'a disease'},
+    ]
+    assert check(attributes)
+    # all attributes of a constrained type have to pass
+    assert not check(attributes + [{'attribute_type_id': 'biolink:p_value', 'value': 0.1}])
+    assert not check(attributes[:2] + [{'attribute_type_id': 'biolink:description', 'value': 'gene x'}])
+    # type mismatches fail, missing attributes fail
+    assert not check([attributes[0], {'attribute_type_id': 'biolink:publications', 'value': 'PMID:2'},
+                      attributes[2]])
+    assert not check(attributes[1:])
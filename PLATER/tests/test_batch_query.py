@@ -0,0 +1,143 @@
+import asyncio
+import re
+
+from PLATER.services.util.admission_control import Neo4jUnavailableError
+from PLATER.services.util.graph_adapter import ResponseBudgetExceeded
+from PLATER.services.util.batch_query import BatchQuestion, compile_batch_cypher, BATCH_PARAMETERS
+from PLATER.services.util.question import Question, compile_cypher_template
+
+
+def one_hop(gene_ids, predicate="biolink:related_to"):
+    return {
+        "query_graph": {
+            "nodes": {"n0": {"ids": gene_ids, "categories": ["biolink:Gene"], "constraints": []},
+                      "n1": {"ids": None, "categories": ["biolink:Disease"], "constraints": []}},
+            "edges": {"e0": {"subject": "n0", "object": "n1", "predicates": [predicate],
+                             "qualifier_constraints": [], "attribute_constraints": []}}
+        }
+    }
+
+
+class MockGraphInterface:
+    def __init__(self):
+        self.queries = []
+
+    async def run_cypher_rows(self, cypher, parameters=None, deadline=None, byte_budget=None):
+        self.queries.append((cypher, parameters))
+        if 'batch' not in parameters:
+            return [{"knowledge_graph": {"nodes": {}, "edges": {}}, "results": []}]
+        # the first lookup of a batch doesn't match anything, so it gets no row
+        return [{BATCH_PARAMETERS: batch_parameters,
+                 "knowledge_graph": {"nodes": {batch_parameters['id_0']: {"attributes": []}}, "edges": {}},
+                 "results": []}
+                for batch_parameters in parameters['batch'][1:]]
+
+
+def test_compile_batch_cypher():
+    cypher = compile_batch_cypher("MATCH (n0 {id: $id_0})-[e0]-(n1) WHERE n1.id IN $ids_1 RETURN n0")
+    assert cypher.startswith(f"UNWIND $batch AS {BATCH_PARAMETERS} CALL {{ WITH {BATCH_PARAMETERS} ")
+    assert f"{BATCH_PARAMETERS}.id_0" in cypher and f"{BATCH_PARAMETERS}.ids_1" in cypher
+    assert "$id_0" not in cypher and "$ids_1" not in cypher
+
+
+def test_compile_batch_cypher_transpiler_query():
+    compile_cypher_template.cache_clear()
+    message = one_hop(["NCBIGene:1", "NCBIGene:2"])
+    message["query_graph"]["nodes"]["n1"]["ids"] = ["MONDO:1"]
+    message["query_graph"]["edges"]["e0"]["attribute_constraints"] = [
+        {"id": "biolink:publications", "operator": "==", "value": "PMID:1", "not": False}]
+    question = Question(message)
+    cypher, parameters = question.compile_cypher(**question.get_query_kwargs())
+    assert "USING INDEX" in cypher
+    assert set(parameters) == {"ids_0", "id_1", "constraint_0"}
+    batch_cypher = compile_batch_cypher(cypher)
+    for parameter_name in parameters:
+        assert f"${parameter_name}" not in batch_cypher
+        assert batch_cypher.count(f"{BATCH_PARAMETERS}.{parameter_name}") == cypher.count(f"${parameter_name}")
+    # only the batch itself is left as a top level parameter
+    assert re.findall(r"\$\w+", batch_cypher) == ["$batch"]
+    # index hints stay right behind their MATCH clauses inside the subquery
+    assert batch_cypher.count("USING INDEX") == cypher.count("USING INDEX")
+
+
+def test_batch_question_groups_lookups():
+    compile_cypher_template.cache_clear()
+    graph_interface = MockGraphInterface()
+    messages = [one_hop(["NCBIGene:1"]), one_hop(["NCBIGene:2"]), one_hop(["NCBIGene:3"]),
+                one_hop(["NCBIGene:4"], predicate="biolink:treats"),
+                one_hop(["NCBIGene:5"], predicate="biolink:not_a_predicate")]
+    outcomes = asyncio.run(BatchQuestion(messages).answer(graph_interface))
+    # the three lookups differing only in their curie share a query, the other valid one runs on its own
+    assert len(graph_interface.queries) == 2
+    batch_cypher, batch_parameters = graph_interface.queries[0]
+    assert batch_cypher.startswith("UNWIND $batch")
+    assert [parameters['batch_index'] for parameters in batch_parameters['batch']] == [0, 1, 2]
+    # rows are handed back to the lookup they belong to
+    assert [outcome[0] for outcome in outcomes[:4]] == ['answer'] * 4
+    assert outcomes[0][1]['knowledge_graph']['nodes'] == {}
+    assert list(outcomes[1][1]['knowledge_graph']['nodes']) == ["NCBIGene:2"]
+    assert list(outcomes[2][1]['knowledge_graph']['nodes']) == ["NCBIGene:3"]
+    # invalid lookups fail on their own
+    assert outcomes[4][:2] == ('error', 400)
+
+
+def test_batch_question_failing_group():
+    compile_cypher_template.cache_clear()
+
+    class FailingGraphInterface(MockGraphInterface):
+        async def run_cypher_rows(self, cypher, parameters=None, deadline=None, byte_budget=None):
+            if 'batch' in parameters:
+                raise Neo4jUnavailableError('Neo4j is currently unavailable, try again later.', retry_after=1)
+            return await super().run_cypher_rows(cypher, parameters=parameters, deadline=deadline)
+
+    messages = [one_hop(["NCBIGene:1"]), one_hop(["NCBIGene:2"]),
+                one_hop(["NCBIGene:4"], predicate="biolink:treats")]
+    outcomes = asyncio.run(BatchQuestion(messages).answer(FailingGraphInterface()))
+    # only the lookups of the failing group get an error, with a status matching it
+    assert [outcome[:2] for outcome in outcomes[:2]] == [('error', 503), ('error', 503)]
+    assert outcomes[2][0] == 'answer'
+
+
+def test_batch_question_byte_budget():
+    compile_cypher_template.cache_clear()
+
+    class BudgetGraphInterface(MockGraphInterface):
+        async def run_cypher_rows(self, cypher, parameters=None, deadline=None, byte_budget=None):
+            self.queries.append((cypher, parameters))
+            if 'batch' in parameters:
+                assert byte_budget == 3000
+                raise ResponseBudgetExceeded(byte_budget)
+            assert byte_budget == 1000
+            if parameters['id_0'] == "NCBIGene:3":
+                # a single lookup exceeding its own budget is run again for fewer results
+                error = ResponseBudgetExceeded(byte_budget)
+                error.partial_row = {'results': [{}] * 9}
+                raise error
+            return [{"knowledge_graph": {"nodes": {}, "edges": {}}, "results": []}]
+
+    messages = [one_hop(["NCBIGene:1"]), one_hop(["NCBIGene:2"]), one_hop(["NCBIGene:3"])]
+    batch_question = BatchQuestion(messages)
+    for question in batch_question.questions:
+        question.response_byte_budget = 1000
+    graph_interface = BudgetGraphInterface()
+    outcomes = asyncio.run(batch_question.answer(graph_interface))
+    # the batch exceeding the budget is answered lookup by lookup, only the lookup exceeding its budget is truncated
+    assert [outcome[0] for outcome in outcomes] == ['answer'] * 3
+    assert [question.truncated for question in batch_question.questions] == [False, False, True]
+
+
+def test_batch_question_chunks_large_lookups():
+    compile_cypher_template.cache_clear()
+    graph_interface = MockGraphInterface()
+    messages = [one_hop(["NCBIGene:1"]), one_hop(["NCBIGene:2"]),
+                one_hop([f"NCBIGene:{index}" for index in range(10, 15)])]
+    batch_question = BatchQuestion(messages)
+    for question in batch_question.questions:
+        question.id_chunk_size = 2
+    outcomes = asyncio.run(batch_question.answer(graph_interface))
+    assert [outcome[0] for outcome in outcomes] == ['answer'] * 3
+    # the two small lookups are batched, the large one is split into chunks of curies like in /query
+    batch_queries = [parameters for _, parameters in graph_interface.queries if 'batch' in parameters]
+    chunk_queries = [parameters for _, parameters in graph_interface.queries if 'batch' not in parameters]
+    assert len(batch_queries) == 1 and len(batch_queries[0]['batch']) == 2
+    assert [len(parameters['ids_0']) for parameters in chunk_queries] == [2, 2, 1]
@@ -11,6 +11,8 @@ from PLATER.services.app_trapi import APP, get_graph_interface, get_graph_metada
 
 
 class MockGraphInterface(GraphInterface):
+    query_timeout = 600
+
     def __init__(self, *args, **kwargs):
         pass
 
@@ -129,6 +131,19 @@ async def test_cypher_response(graph_interface):
     assert response.json() == graph_resp
 
 
+@pytest.mark.asyncio
+async def test_batch_response_invalid_request():
+    valid_request = {"message": {"query_graph": {"nodes": {}, "edges": {}}},
+                     "workflow": [{"id": "overlay_connect_knodes"}]}
+    async with AsyncClient(app=APP, base_url="http://test") as ac:
+        response = await ac.post("/query_batch", json=[valid_request, {"message": {"query_graph": 5}}])
+    # an invalid request is reported on its own instead of failing the whole batch
+    assert response.status_code == 200
+    responses = response.json()
+    assert responses[0] == {"status": 400, "description": "Only the lookup workflow can be batched."}
+    assert responses[1]["status"] == 400 and responses[1]["description"].startswith("Validation Errors Occurred")
+
+
 # @pytest.mark.asyncio
 # async def test_graph_schema_response(graph_interface):
 #     async with AsyncClient(app=APP, base_url="http://test") as ac:
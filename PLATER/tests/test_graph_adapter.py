@@ -1,22 +1,30 @@
 import json
+import time
 from collections import defaultdict
-from PLATER.services.util.graph_adapter import Neo4jHTTPDriver, GraphInterface
+from PLATER.services.util.graph_adapter import Neo4jHTTPDriver, Neo4jBoltDriver, Neo4jReplicaRouter, GraphInterface, \
+    get_neo4j_driver, cypher_label, ResponseBudgetExceeded
 from pytest_httpx import HTTPXMock
+import httpx
 import pytest
 import os
 
 
-def test_neo4j_http_driver_ping_success(httpx_mock: HTTPXMock):
+@pytest.mark.asyncio
+async def test_neo4j_http_driver_ping_success(httpx_mock: HTTPXMock):
     httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
     driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    await driver.initialize()
 
 
-def test_neo4j_http_driver_ping_fail(httpx_mock: HTTPXMock):
+@pytest.mark.asyncio
+async def test_neo4j_http_driver_ping_fail(httpx_mock: HTTPXMock):
     httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=500)
+    # nothing is sent to neo4j until the driver is initialized
+    driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
     try:
-        driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+        await driver.initialize()
         assert False
-    except:
+    except RuntimeError:
         assert True
 
 
@@ -24,6 +32,7 @@ def test_neo4j_http_driver_ping_fail(httpx_mock: HTTPXMock):
 async def test_neo4j_http_driver_run_cypher(httpx_mock: HTTPXMock):
     httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
     driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    await driver.initialize()
     test_response = {"some": "response"}
     query = "some test cypher"
 
@@ -45,6 +54,7 @@ async def test_neo4j_http_driver_run_cypher(httpx_mock: HTTPXMock):
 async def test_neo4j_http_driver_run_cypher_fail(httpx_mock: HTTPXMock):
     httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
     driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    await driver.initialize()
     test_response = {"errors": "some_error"}
     query = "some test cypher"
 
@@ -81,6 +91,7 @@ async def test_neo4j_http_driver_apoc(httpx_mock: HTTPXMock):
                             }).encode('utf-8'), json={}
                             )
     driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    await driver.initialize()
     assert driver.check_apoc_support() == True
     httpx_mock.add_response(url="http://localhost:7474/db/data/transaction/commit", method="POST", status_code=500,
                             match_content=json.dumps({
@@ -92,12 +103,14 @@ async def test_neo4j_http_driver_apoc(httpx_mock: HTTPXMock):
                             }).encode('utf-8'), json={"errors": "apoc not supported"}
                             )
     driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    await driver.initialize()
     assert driver.check_apoc_support() is False
 
 @pytest.mark.asyncio
 async def test_driver_convert_to_dict(httpx_mock: HTTPXMock):
     httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
     driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    await driver.initialize()
     sample_resp = {
           "results": [
             {
@@ -124,6 +137,7 @@ async def test_driver_convert_to_dict(httpx_mock: HTTPXMock):
 async def test_graph_interface_biolink_leaves(httpx_mock: HTTPXMock):
     httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
     gi = GraphInterface('localhost','7474', auth=('neo4j', ''))
+    await gi.initialize()
     list_1 = [
       "biolink:SmallMolecule",
       "biolink:MolecularEntity",
@@ -144,6 +158,7 @@ async def test_graph_interface_biolink_leaves(httpx_mock: HTTPXMock):
 async def test_graph_interface_predicate_inverse(httpx_mock: HTTPXMock):
     httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
     gi = GraphInterface('localhost', '7474', auth=('neo4j', ''))
+    await gi.initialize()
     non_exist_predicate = "biolink:some_predicate"
     assert gi.invert_predicate(non_exist_predicate) is None
     symmetric_predicate = "biolink:related_to"
@@ -162,6 +177,7 @@ async  def test_graph_interface_get_schema(httpx_mock: HTTPXMock):
                 """
     httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
     gi = GraphInterface('localhost', '7474', auth=('neo4j', ''))
+    await gi.initialize()
     with open( os.path.join(os.path.dirname(__file__), 'data', 'schema_cypher_response.json'))as f:
         get_schema_response_json = json.load(f)
     httpx_mock.add_response(url="http://localhost:7474/db/data/transaction/commit", method="POST", status_code=200,
@@ -176,7 +192,7 @@ async  def test_graph_interface_get_schema(httpx_mock: HTTPXMock):
 
     # lets pretend we already have summary
     # gi.instance.summary = True
-    schema = gi.get_schema()
+    schema = await gi.get_schema()
     expected = defaultdict(lambda: defaultdict(set))
     expected['biolink:Disease']['biolink:Disease'] = {'biolink:has_phenotype'}
     expected['biolink:PhenotypicFeature']['biolink:Disease'] = set()
@@ -184,3 +200,309 @@ async  def test_graph_interface_get_schema(httpx_mock: HTTPXMock):
 
     assert schema == expected
     GraphInterface.instance = None
+
+
+@pytest.mark.asyncio
+async def test_neo4j_http_driver_reuses_pooled_client(httpx_mock: HTTPXMock):
+    driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'), max_connections=5)
+    httpx_mock.add_response(url=driver._full_transaction_path, method='POST', json={"results": [], "errors": []})
+    await driver.run("some test cypher")
+    session = driver._get_session()
+    await driver.run("some test cypher")
+    assert driver._get_session() is session
+    stats = driver.get_pool_stats()
+    assert stats['max_connections'] == 5
+    assert stats['requests_total'] == 2
+    assert stats['requests_in_flight'] == 0
+    assert stats['peak_requests_in_flight'] == 1
+    await driver.close()
+    assert driver._session is None
+
+
+def test_neo4j_bolt_driver_converts_records():
+    from unittest.mock import patch
+    from neo4j.graph import Graph, Node, Relationship
+    with patch('neo4j.GraphDatabase.driver'), patch('neo4j.AsyncGraphDatabase.driver'):
+        driver = get_neo4j_driver('bolt', host='localhost', port=7687, auth=('neo4j', 'somepass'))
+    assert isinstance(driver, Neo4jBoltDriver)
+    graph = Graph()
+    node = Node(graph, 'element:1', 1, ['biolink:Gene'], {'id': 'NCBIGene:1', 'name': 'gene'})
+    edge = Relationship(graph, 'element:2', 2, {'id': 'edge_1', 'publications': ['PMID:1']})
+    converted = driver._to_json({'nodes': [node], 'edge': edge, 'count': 1})
+    assert converted == {
+        'nodes': [{'id': 'NCBIGene:1', 'name': 'gene'}],
+        'edge': {'id': 'edge_1', 'publications': ['PMID:1']},
+        'count': 1
+    }
+
+
+@pytest.mark.asyncio
+async def test_neo4j_bolt_driver_byte_budget():
+    from unittest.mock import patch, MagicMock
+    with patch('neo4j.GraphDatabase.driver'), patch('neo4j.AsyncGraphDatabase.driver'):
+        driver = get_neo4j_driver('bolt', host='localhost', port=7687, auth=('neo4j', 'somepass'))
+    results = [{"node_bindings": {"n0": [{"id": f"CURIE:{index}"}]}} for index in range(100)]
+
+    class Record:
+        def values(self):
+            return [results, {"nodes": {}, "edges": {}}]
+
+    class Result:
+        def keys(self):
+            return ["results", "knowledge_graph"]
+
+        async def __aiter__(self):
+            yield Record()
+
+    class Session:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            return False
+
+        async def run(self, *args, **kwargs):
+            return Result()
+
+    driver._async_driver = MagicMock()
+    driver._async_driver.session = Session
+    row_bytes = len(json.dumps({"results": results, "knowledge_graph": {"nodes": {}, "edges": {}}},
+                               separators=(',', ':')))
+    assert len(await driver.run_rows("some test cypher", byte_budget=row_bytes)) == 1
+    with pytest.raises(ResponseBudgetExceeded) as error:
+        await driver.run_rows("some test cypher", byte_budget=row_bytes // 4)
+    # the partial row keeps about the share of the results that fit in the budget
+    assert 20 <= len(error.value.partial_row['results']) <= 30
+    assert driver.get_pool_stats()['requests_in_flight'] == 0
+
+
+@pytest.mark.asyncio
+async def test_neo4j_http_driver_stream_rows(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
+    driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    await driver.initialize()
+    test_response = {
+        "results": [{
+            "columns": ["results", "knowledge_graph"],
+            "data": [{
+                "row": [[{"node_bindings": {"n0": [{"id": "CURIE:1"}]}}],
+                        {"nodes": {"CURIE:1": {"name": "one", "score": 0.5, "count": 2}}, "edges": {}}],
+                "meta": [None, None]
+            }]
+        }],
+        "errors": []
+    }
+    httpx_mock.add_response(url=driver._full_transaction_path, method='POST', json=test_response)
+    rows = await driver.run_rows("some test cypher")
+    assert rows == driver.convert_to_dict(test_response)
+
+    httpx_mock.add_response(url=driver._full_transaction_path, method='POST', json={
+        "results": [],
+        "errors": [{"code": "Neo.ClientError.Statement.SyntaxError", "message": "bad cypher"}]
+    })
+    with pytest.raises(RuntimeWarning):
+        await driver.run_rows("some bad cypher")
+
+
+@pytest.mark.asyncio
+async def test_neo4j_http_driver_byte_budget(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
+    driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    await driver.initialize()
+    test_response = json.dumps({
+        "results": [{
+            "columns": ["results", "knowledge_graph"],
+            "data": [{"row": [[{"node_bindings": {"n0": [{"id": f"CURIE:{i}"}]}} for i in range(1000)],
+                              {"nodes": {}, "edges": {}}],
+                      "meta": [None, None]}]
+        }],
+        "errors": []
+    }).encode('utf-8')
+    httpx_mock.add_response(url=driver._full_transaction_path, method='POST', content=test_response)
+    with pytest.raises(ResponseBudgetExceeded):
+        await driver.run_rows("some test cypher", byte_budget=len(test_response) // 2)
+    httpx_mock.add_response(url=driver._full_transaction_path, method='POST', content=test_response)
+    rows = await driver.run_rows("some test cypher", byte_budget=len(test_response))
+    assert len(rows[0]["results"]) == 1000
+
+
+@pytest.mark.asyncio
+async def test_graph_interface_get_node_parameterized(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
+    gi = GraphInterface('localhost', '7474', auth=('neo4j', ''))
+    await gi.initialize()
+    curie = "CURIE:with'quote"
+    httpx_mock.add_response(url="http://localhost:7474/db/data/transaction/commit", method="POST", status_code=200,
+                            match_content=json.dumps({
+                                "statements": [
+                                    {
+                                        "statement": "MATCH (c:`biolink:Gene`{id: $curie}) return c",
+                                        "parameters": {"curie": curie}
+                                    }
+                                ]
+                            }).encode('utf-8'),
+                            json={"results": [{"columns": ["c"], "data": [{"row": [{"id": curie}], "meta": []}]}],
+                                  "errors": []}
+                            )
+    assert await gi.get_node('biolink:Gene', curie) == [{"id": curie}]
+    assert cypher_label('biolink:Gene`) DETACH DELETE (n') == '`biolink:Gene``) DETACH DELETE (n`'
+    GraphInterface.instance = None
+
+
+@pytest.mark.asyncio
+async def test_graph_interface_deadline_single_round_trip(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
+    gi = GraphInterface('localhost', '7474', auth=('neo4j', ''))
+    await gi.initialize()
+    # a deadline is enforced by neo4j through the max execution time, without opening a transaction first
+    httpx_mock.add_response(url="http://localhost:7474/db/data/transaction/commit", method="POST", status_code=200,
+                            json={"results": [{"columns": ["c"], "data": [{"row": [1], "meta": []}]}],
+                                  "errors": []})
+    await gi.run_cypher("RETURN 1 AS c", deadline=time.time() + 10)
+    requests = [request for request in httpx_mock.get_requests() if b"RETURN 1 AS c" in request.content]
+    assert len(requests) == 1
+    assert 0 < int(requests[0].headers["max-execution-time"]) <= 10000
+    GraphInterface.instance = None
+
+
+@pytest.mark.asyncio
+async def test_graph_interface_timeouts_are_failures(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
+    gi = GraphInterface('localhost', '7474', auth=('neo4j', ''), admission_settings={'failure_threshold': 2})
+    await gi.initialize()
+    limit = gi.admission_controller.limiter.limit
+    # neo4j too overloaded to answer in time cuts the concurrency limit and opens the circuit breaker
+    for _ in range(2):
+        httpx_mock.add_exception(httpx.ReadTimeout("Read timed out"),
+                                 url="http://localhost:7474/db/data/transaction/commit", method="POST")
+        with pytest.raises(httpx.ReadTimeout):
+            await gi.run_cypher("RETURN 1 AS c")
+    assert gi.admission_controller.limiter.limit < limit
+    assert gi.admission_controller.circuit_breaker.state == 'open'
+    GraphInterface.instance = None
+
+
+@pytest.mark.asyncio
+async def test_neo4j_http_driver_run_many(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
+    driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    await driver.initialize()
+    first_result = {"columns": ["a"], "data": [{"row": [1], "meta": []}]}
+    second_result = {"columns": ["b"], "data": [{"row": [2], "meta": []}]}
+    httpx_mock.add_response(url=driver._full_transaction_path, method='POST',
+                            match_content=json.dumps({
+                                "statements": [
+                                    {"statement": "RETURN 1 as a"},
+                                    {"statement": "RETURN $b as b", "parameters": {"b": 2}}
+                                ]
+                            }).encode('utf-8'),
+                            json={"results": [first_result, second_result], "errors": []})
+    responses = await driver.run_many([("RETURN 1 as a", None), ("RETURN $b as b", {"b": 2})])
+    assert [driver.convert_to_dict(response) for response in responses] == [[{"a": 1}], [{"b": 2}]]
+
+
+@pytest.mark.asyncio
+async def test_replica_router_ejects_unreachable_replica(httpx_mock: HTTPXMock):
+    import httpx
+    httpx_mock.add_response(url="http://replica1:7474/", method="GET", status_code=200)
+    httpx_mock.add_response(url="http://replica2:7474/", method="GET", status_code=200)
+    router = get_neo4j_driver('http', host='replica1, replica2', port=7474, auth=('neo4j', 'somepass'))
+    await router.initialize()
+    assert isinstance(router, Neo4jReplicaRouter)
+    # replica1 looks busier, so replica2 is picked first
+    router._replicas[0].latency = 1.0
+    router._replicas[1].latency = 0.1
+    test_response = {"results": [], "errors": []}
+    httpx_mock.add_exception(httpx.ConnectError("connection refused"),
+                             url="http://replica2:7474/db/data/transaction/commit")
+    httpx_mock.add_response(url="http://replica1:7474/db/data/transaction/commit", method='POST', json=test_response)
+    assert await router.run("some test cypher") == test_response
+    stats = {replica['host']: replica for replica in router.get_pool_stats()['replicas']}
+    assert stats['replica1']['healthy'] and not stats['replica2']['healthy']
+    # a successful probe brings the replica back
+    await router.probe(router._replicas[1])
+    assert router._replicas[1].healthy
+    await router.close()
+
+
+@pytest.mark.asyncio
+async def test_replica_router_fails_over_on_server_errors(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(url="http://replica1:7474/", method="GET", status_code=200)
+    httpx_mock.add_response(url="http://replica2:7474/", method="GET", status_code=200)
+    router = get_neo4j_driver('http', host='replica1, replica2', port=7474, auth=('neo4j', 'somepass'))
+    await router.initialize()
+    router._replicas[0].latency = 1.0
+    router._replicas[1].latency = 0.1
+    test_response = {"results": [{"columns": ["a"], "data": [{"row": [1], "meta": []}]}], "errors": []}
+    # replica2 is reachable but fails every query
+    httpx_mock.add_response(url="http://replica2:7474/db/data/transaction/commit", method='POST', status_code=503,
+                            text="Service Unavailable")
+    httpx_mock.add_response(url="http://replica1:7474/db/data/transaction/commit", method='POST', json=test_response)
+    assert await router.run("some test cypher") == test_response
+    assert router._replicas[0].healthy and not router._replicas[1].healthy
+
+    # a streamed query failing before its first row is retried on the next replica
+    await router.probe(router._replicas[1])
+    router._replicas[0].latency = 1.0
+    router._replicas[1].latency = 0.1
+    httpx_mock.add_response(url="http://replica2:7474/db/data/transaction/commit", method='POST', status_code=500,
+                            text="Internal Server Error")
+    httpx_mock.add_response(url="http://replica1:7474/db/data/transaction/commit", method='POST', json=test_response)
+    assert [row async for row in router.stream_rows("some test cypher")] == [{"a": 1}]
+    assert router._replicas[0].healthy and not router._replicas[1].healthy
+    assert all(replica.in_flight == 0 for replica in router._replicas)
+    await router.close()
+
+
+@pytest.mark.asyncio
+async def test_neo4j_http_driver_cancellable_run(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(url="http://localhost:7474/", method="GET", status_code=200)
+    driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    await driver.initialize()
+    transaction_url = "http://localhost:7474/db/data/transaction/7"
+    test_response = {"results": [{"columns": ["a"], "data": [{"row": [1], "meta": []}]}], "errors": []}
+    # cancellable queries run in an explicit transaction, the location advertised by neo4j isn't used
+    httpx_mock.add_response(url="http://localhost:7474/db/data/transaction", method='POST', status_code=201,
+                            headers={'location': "http://advertised-host:7474/db/data/transaction/7"},
+                            json={"commit": "http://advertised-host:7474/db/data/transaction/7/commit",
+                                  "results": [], "errors": []})
+    httpx_mock.add_response(url=f"{transaction_url}/commit", method='POST', json=test_response)
+    response = await driver.run("some test cypher", timeout=5, cancellable=True)
+    assert response == test_response
+    assert httpx_mock.get_requests(url=f"{transaction_url}/commit")[0].headers['max-execution-time'] == '5000'
+
+    # when the query doesn't complete the transaction is rolled back
+    httpx_mock.add_response(url="http://localhost:7474/db/data/transaction", method='POST', status_code=201,
+                            headers={'location': transaction_url},
+                            json={"results": [], "errors": []})
+    httpx_mock.add_exception(httpx.ReadTimeout('timed out'), url=f"{transaction_url}/commit", method='POST')
+    httpx_mock.add_response(url=transaction_url, method='DELETE', json={"results": [], "errors": []})
+    with pytest.raises(httpx.ReadTimeout):
+        await driver.run("some test cypher", timeout=5, cancellable=True)
+    assert len(httpx_mock.get_requests(url=transaction_url, method='DELETE')) == 1
+    await driver.close()
+
+
+@pytest.mark.asyncio
+async def test_neo4j_http_driver_compressed_responses(httpx_mock: HTTPXMock):
+    import gzip
+    driver = Neo4jHTTPDriver(host='localhost', port=7474, auth=('neo4j', 'somepass'))
+    row = [{"id": "CURIE:1", "category": ["biolink:Gene", "biolink:NamedThing"], "provided_by": "infores:test"}]
+    test_response = {"results": [{"columns": ["n"], "data": [{"row": row, "meta": []}] * 50}], "errors": []}
+    body = json.dumps(test_response).encode('utf-8')
+    compressed_body = gzip.compress(body)
+
+    class CompressedStream(httpx.AsyncByteStream):
+        # httpx decodes plain content when the mocked response is created, a stream reaches the client compressed
+        async def __aiter__(self):
+            yield compressed_body
+
+    httpx_mock.add_response(url=driver._full_transaction_path, method='POST', stream=CompressedStream(),
+                            headers={'content-encoding': 'gzip', 'content-type': 'application/json'})
+    assert await driver.run("some test cypher") == test_response
+    assert await driver.run_rows("some test cypher") == driver.convert_to_dict(test_response)
+    assert 'gzip' in httpx_mock.get_requests()[0].headers['accept-encoding']
+    stats = driver.get_pool_stats()
+    assert stats['bytes_received_total'] == 2 * len(compressed_body)
+    assert stats['bytes_decoded_total'] == 2 * len(body)
+    await driver.close()
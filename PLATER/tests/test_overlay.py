@@ -6,7 +6,7 @@ from PLATER.services.util.overlay import Overlay
 @pytest.fixture()
 def graph_interface_apoc_supported():
     class MockGI:
-        def supports_apoc(self):
+        async def supports_apoc(self):
             return True
 
         async def run_apoc_cover(self, idlist):
@@ -57,7 +57,7 @@ def graph_interface_apoc_supported():
 @pytest.fixture()
 def graph_interface_apoc_unsupported():
     class MockGI:
-        def supports_apoc(self):
+        async def supports_apoc(self):
             return True
 
     return MockGI()
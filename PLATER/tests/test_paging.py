@@ -0,0 +1,44 @@
+import pytest
+
+from PLATER.services.util.paging import encode_page_token, decode_page_token, InvalidPageTokenError
+from PLATER.services.util.question import Question
+
+
+def test_page_token_round_trip():
+    token = encode_page_token('query_key', 200, 100, 'graph_v1')
+    assert decode_page_token(token, 'query_key', 'graph_v1') == (200, 100)
+    # tokens only continue the query and graph they were issued for
+    with pytest.raises(InvalidPageTokenError):
+        decode_page_token(token, 'other_query_key', 'graph_v1')
+    with pytest.raises(InvalidPageTokenError):
+        decode_page_token(token, 'query_key', 'graph_v2')
+    with pytest.raises(InvalidPageTokenError):
+        decode_page_token('not a token', 'query_key', 'graph_v1')
+    # a query graph that can't be canonicalized has no key, its token can't continue any query
+    with pytest.raises(InvalidPageTokenError):
+        decode_page_token(encode_page_token(None, 200, 100, 'graph_v1'), None, 'graph_v1')
+
+
+def test_question_pages():
+    question = Question({"query_graph": {"nodes": {}, "edges": {}}})
+    question.results_limit = 50
+    question.set_page(100, 300)
+    # pages are capped by the results limit
+    assert question.get_query_kwargs()['limit'] == 50
+    assert question.get_query_kwargs()['skip'] == 300
+    assert question.chunk_parameters({"ids_0": ["CURIE:1", "CURIE:2"]}) == [{"ids_0": ["CURIE:1", "CURIE:2"]}]
+
+
+def test_paged_cypher_is_ordered():
+    question = Question({"query_graph": {
+        "nodes": {"n0": {"ids": ["NCBIGene:1"], "categories": ["biolink:Gene"], "constraints": []},
+                  "n1": {"ids": None, "categories": ["biolink:Disease"], "constraints": []}},
+        "edges": {"e0": {"subject": "n0", "object": "n1", "predicates": ["biolink:related_to"],
+                         "qualifier_constraints": [], "attribute_constraints": []}}}})
+    question.set_page(10, 20)
+    cypher, parameters = question.compile_cypher(**question.get_query_kwargs())
+    # results are sorted by the curies bound to them before a page is skipped to
+    order_by = "ORDER BY result.node_bindings.`n0`[0].id, result.node_bindings.`n0`[0].query_id, " \
+               "result.node_bindings.`n1`[0].id, result.node_bindings.`n1`[0].query_id SKIP $page_skip"
+    assert order_by in cypher
+    assert parameters["page_skip"] == 20
@@ -0,0 +1,99 @@
+import asyncio
+import copy
+import threading
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+from PLATER.services.util import post_processing
+from PLATER.services.util.post_processing import run_post_processing, message_size, should_shard, \
+    format_sharded
+
+
+def test_message_size():
+    assert message_size({}) == 0
+    assert message_size({"knowledge_graph": {"nodes": {"a": {}, "b": {}}, "edges": {"e": {}}},
+                         "results": [{}, {}, {}]}) == 6
+
+
+def test_run_post_processing(monkeypatch):
+    monkeypatch.setattr(post_processing, 'INLINE_LIMIT', 10)
+
+    async def run(size):
+        return await run_post_processing(lambda: threading.current_thread().name, size=size)
+    # small jobs stay on the event loop's thread, large ones go to the pool
+    assert asyncio.run(run(1)) == threading.current_thread().name
+    assert asyncio.run(run(10)).startswith('post_processing')
+    post_processing.shutdown_post_processing()
+
+
+def test_should_shard(monkeypatch):
+    monkeypatch.setattr(post_processing, 'SHARDING_THRESHOLD', 100)
+    monkeypatch.setattr(post_processing, 'SHARDING_WORKERS', 0)
+    assert not should_shard(1000)
+    monkeypatch.setattr(post_processing, 'SHARDING_WORKERS', 2)
+    assert not should_shard(99)
+    assert should_shard(100)
+
+
+def test_format_sharded_falls_back_when_workers_fail(monkeypatch):
+    class BrokenExecutor:
+        def submit(self, *args):
+            raise BrokenProcessPool('worker died')
+
+        def shutdown(self, **kwargs):
+            pass
+    monkeypatch.setattr(post_processing, 'SHARDING_WORKERS', 2)
+    monkeypatch.setattr(post_processing, 'sharding_executor', BrokenExecutor())
+    kg_items = {f'n{i}': {'attributes': []} for i in range(10)}
+    formatted = format_sharded(kg_items, True, lambda items, node: {key: node for key in items})
+    assert formatted == {f'n{i}': True for i in range(10)}
+    assert post_processing.sharding_executor is None
+
+
+def test_format_sharded_falls_back_when_a_shard_fails(monkeypatch):
+    class FailingExecutor:
+        def __init__(self):
+            self.futures = []
+
+        def submit(self, *args):
+            # the second shard raises in its worker, the ones after it are still pending
+            future = Future()
+            if len(self.futures) == 0:
+                future.set_result(b'{}')
+            elif len(self.futures) == 1:
+                future.set_exception(ValueError('bad attribute'))
+            self.futures.append(future)
+            return future
+    executor = FailingExecutor()
+    monkeypatch.setattr(post_processing, 'SHARDING_WORKERS', 2)
+    monkeypatch.setattr(post_processing, 'sharding_executor', executor)
+    kg_items = {f'n{i}': {'attributes': []} for i in range(10)}
+    formatted = format_sharded(kg_items, True, lambda items, node: {key: node for key in items})
+    assert formatted == {f'n{i}': True for i in range(10)}
+    # the shards left are cancelled, but the pool itself still works, only a broken pool is shut down
+    assert all(future.cancelled() for future in executor.futures[2:])
+    assert post_processing.sharding_executor is executor
+
+
+def test_format_sharded_in_worker_processes(monkeypatch):
+    from PLATER.services.util.question import Question
+    monkeypatch.setattr(post_processing, 'SHARDING_WORKERS', 1)
+    monkeypatch.setattr(post_processing, 'sharding_executor', None)
+    nodes = {f"NCBIGene:{i}": {"name": f"gene {i}", "categories": ["biolink:Gene"], "attributes": [
+                 {"original_attribute_name": "equivalent_identifiers", "value": [f"NCBIGene:{i}"]},
+                 {"original_attribute_name": "information_content", "value": i}]}
+             for i in range(10)}
+    edges = {f"e{i}": {"subject": f"NCBIGene:{i}", "object": "MONDO:1", "predicate": "biolink:related_to",
+                       "sources": [{"resource_id": "infores:source", "resource_role": "primary_knowledge_source"}],
+                       "attributes": [{"original_attribute_name": "object_aspect_qualifier", "value": "activity"},
+                                      {"original_attribute_name": "publications", "value": ["PMID:1"]}]}
+             for i in range(10)}
+    try:
+        # the shards formatted by the worker process merge back into what formatting in process gives
+        for kg_items, node in ((nodes, True), (edges, False)):
+            expected = Question({}).format_attribute_trapi(copy.deepcopy(kg_items), node=node)
+            formatted = format_sharded(copy.deepcopy(kg_items), node, Question({}).format_attribute_trapi)
+            assert list(formatted) == list(expected)
+            assert formatted == expected
+    finally:
+        post_processing.shutdown_sharding()
@@ -2,8 +2,10 @@ from unittest.mock import patch
 
 import pytest
 
-from PLATER.services.util.question import Question
+from PLATER.services.util.question import Question, compile_cypher_template, push_down_filter, construct_sources_tree
+from PLATER.services.util.graph_adapter import ResponseBudgetExceeded
 from bmt import Toolkit
+from reasoner_transpiler.cypher import get_query
 import asyncio, json
 import os
 import copy
@@ -176,6 +178,10 @@ class MOCK_GRAPH_ADAPTER():
         assert cypher == "SOME CYPHER"
         self.called = True
 
+    async def run_cypher_rows(self, cypher, **kwargs):
+        await self.run_cypher(cypher)
+        return self.convert_to_dict(None)
+
     @staticmethod
     def convert_to_dict(item):
         return [{"trapi": {"compatible_ result"}}]
@@ -183,7 +189,7 @@ class MOCK_GRAPH_ADAPTER():
 
 def test_answer():
     def compile_cypher_mock(**kwargs):
-        return "SOME CYPHER"
+        return "SOME CYPHER", {}
     question = Question({"query_graph": {}})
     question.compile_cypher = compile_cypher_mock
     graph_interface = MOCK_GRAPH_ADAPTER()
@@ -250,4 +256,320 @@ def test_attribute_constraint_filter_edge(message):
     assert len(result['knowledge_graph']['nodes']) == 3
     assert len(result['knowledge_graph']['edges']) == 1
     assert len(result['results']) == 1
-    assert len(result['results'][0]['analyses'][0]['edge_bindings']['e0']) == 1
\ No newline at end of file
+    assert len(result['results'][0]['analyses'][0]['edge_bindings']['e0']) == 1
+
+def test_compile_cypher_template():
+    def one_hop(gene_ids, disease_ids):
+        return {
+            "query_graph": {
+                "nodes": {"n0": {"ids": gene_ids, "categories": ["biolink:Gene"]},
+                          "n1": {"ids": disease_ids, "categories": ["biolink:Disease"]}},
+                "edges": {"e0": {"subject": "n0", "object": "n1", "predicates": ["biolink:related_to"],
+                                 "qualifier_constraints": []}}
+            }
+        }
+    compile_cypher_template.cache_clear()
+    cypher, parameters = Question(one_hop(["NCBIGene:1"], ["MONDO:1", "MONDO:2"])).compile_cypher(subclass_depth=1)
+    assert parameters == {"id_0": "NCBIGene:1", "ids_1": ["MONDO:1", "MONDO:2"]}
+    assert "$id_0" in cypher and "$ids_1" in cypher
+    assert "NCBIGene:1" not in cypher and "MONDO:" not in cypher
+    # other curies reuse the compiled template, only the parameters change
+    other_cypher, other_parameters = Question(one_hop(["NCBIGene:2"], ["MONDO:3", "MONDO:4", "MONDO:5"]))\
+        .compile_cypher(subclass_depth=1)
+    assert other_cypher == cypher
+    assert other_parameters == {"id_0": "NCBIGene:2", "ids_1": ["MONDO:3", "MONDO:4", "MONDO:5"]}
+    assert compile_cypher_template.cache_info().hits == 1
+    # a different shape compiles a new template
+    Question(one_hop(["NCBIGene:2"], None)).compile_cypher(subclass_depth=1)
+    assert compile_cypher_template.cache_info().misses == 2
+
+
+def test_compile_cypher_leaves_message_untouched():
+    message = {
+        "query_graph": {
+            "nodes": {"n0": {"ids": ["NCBIGene:1"], "categories": ["biolink:Gene"]},
+                      "n1": {"ids": ["MONDO:1", "MONDO:2"], "categories": ["biolink:Disease"]}},
+            "edges": {"e0": {"subject": "n0", "object": "n1", "predicates": ["biolink:affects"],
+                             "qualifier_constraints": [{"qualifier_set": [
+                                 {"qualifier_type_id": "biolink:object_aspect_qualifier",
+                                  "qualifier_value": "activity"}]}]}}
+        }
+    }
+    original = copy.deepcopy(message)
+    question = Question(message)
+    # the question owns the message instead of copying it
+    assert question._question_json is message
+    question.compile_cypher(subclass_depth=1)
+    assert message == original
+
+
+def test_chunk_parameters_and_merge():
+    question = Question({"query_graph": {"nodes": {"n0": {"ids": ["NCBIGene:1"]},
+                                                   "n1": {"ids": [f"MONDO:{i}" for i in range(5)]}},
+                                         "edges": {}}})
+    question.id_chunk_size = 2
+    question.id_chunk_concurrency = 2
+    parameters = {"id_0": "NCBIGene:1", "ids_1": [f"MONDO:{i}" for i in range(5)]}
+    chunks = question.chunk_parameters(parameters)
+    assert [chunk["ids_1"] for chunk in chunks] == [["MONDO:0", "MONDO:1"], ["MONDO:2", "MONDO:3"], ["MONDO:4"]]
+    assert all(chunk["id_0"] == "NCBIGene:1" for chunk in chunks)
+    # lists within the chunk size and sets are left whole
+    question.id_chunk_size = 5
+    assert question.chunk_parameters(parameters) == [parameters]
+    question.id_chunk_size = 2
+    question._question_json["query_graph"]["nodes"]["n1"]["is_set"] = True
+    assert question.chunk_parameters(parameters) == [parameters]
+
+    class MockGraphInterface:
+        async def run_cypher_rows(self, cypher, parameters=None, deadline=None):
+            return [{"knowledge_graph": {"nodes": {"NCBIGene:1": {}, **{curie: {} for curie in parameters["ids_1"]}},
+                                         "edges": {f"e_{curie}": {} for curie in parameters["ids_1"]}},
+                     "results": [{"curie": curie} for curie in parameters["ids_1"]]}]
+
+    merged = asyncio.run(question.run_chunks(MockGraphInterface(), "cypher", chunks))
+    # the shared node is only kept once
+    assert len(merged["knowledge_graph"]["nodes"]) == 6
+    assert len(merged["knowledge_graph"]["edges"]) == 5
+    assert [result["curie"] for result in merged["results"]] == [f"MONDO:{i}" for i in range(5)]
+
+
+def test_run_chunks_truncates_knowledge_graph():
+    question = Question({"query_graph": {"nodes": {}, "edges": {}}})
+    question.results_limit = 2
+
+    class MockGraphInterface:
+        async def run_cypher_rows(self, cypher, parameters=None, deadline=None):
+            return [{"knowledge_graph": {
+                        "nodes": {"NCBIGene:1": {}, **{curie: {} for curie in parameters["ids_1"]}},
+                        "edges": {f"e_{curie}": {"subject": "NCBIGene:1", "object": curie}
+                                  for curie in parameters["ids_1"]}},
+                     "results": [{"node_bindings": {"n0": [{"id": "NCBIGene:1"}], "n1": [{"id": curie}]},
+                                  "analyses": [{"edge_bindings": {"e0": [{"id": f"e_{curie}"}]}}]}
+                                 for curie in parameters["ids_1"]],
+                     "auxiliary_graphs": {f"a_{curie}": {} for curie in parameters["ids_1"]}}]
+
+    chunks = [{"ids_1": ["MONDO:0", "MONDO:1"]}, {"ids_1": ["MONDO:2", "MONDO:3"]}]
+    merged = asyncio.run(question.run_chunks(MockGraphInterface(), "cypher", chunks))
+    assert len(merged["results"]) == 2
+    # nothing in the knowledge graph is left over from the results that were cut
+    assert set(merged["knowledge_graph"]["nodes"]) == {"NCBIGene:1", "MONDO:0", "MONDO:1"}
+    assert set(merged["knowledge_graph"]["edges"]) == {"e_MONDO:0", "e_MONDO:1"}
+    # other columns are merged as well
+    assert len(merged["auxiliary_graphs"]) == 4
+
+
+def test_get_truncated_limit():
+    partial_row = {"results": [{} for _ in range(101)]}
+    # half of the complete results, leaving room for their knowledge graph
+    assert Question.get_truncated_limit(partial_row, 1000) == 50
+    assert Question.get_truncated_limit(partial_row, 60) == 30
+    # without parsed results the limit is halved, without a limit there's nothing to go by
+    assert Question.get_truncated_limit(None, 1000) == 500
+    assert Question.get_truncated_limit({"knowledge_graph": {}}, None) == 0
+
+
+def test_run_within_budget():
+    question = Question({"query_graph": {"nodes": {}, "edges": {}}})
+    question.response_byte_budget = 1000
+    question.results_limit = 100
+    question.compile_cypher = lambda **kwargs: (f"cypher limit {kwargs['limit']}", {})
+
+    class MockGraphInterface:
+        def __init__(self, fits):
+            self.fits = fits
+            self.cyphers = []
+
+        async def run_cypher_rows(self, cypher, parameters=None, deadline=None, byte_budget=None):
+            assert byte_budget == 1000
+            self.cyphers.append(cypher)
+            if not self.fits(cypher):
+                e = ResponseBudgetExceeded(byte_budget)
+                e.partial_row = {"results": [{} for _ in range(41)]}
+                raise e
+            return [{"knowledge_graph": {"nodes": {}, "edges": {}}, "results": [{}]}]
+
+    graph_interface = MockGraphInterface(lambda cypher: cypher == "cypher limit 10")
+    rows = asyncio.run(question.run_within_budget(graph_interface, "cypher", {}))
+    assert rows[0]["results"] == [{}]
+    assert graph_interface.cyphers == ["cypher", "cypher limit 20", "cypher limit 10"]
+    assert question.truncated
+    assert question.logs[0]["code"] == "ResponseTruncated"
+
+    # a response that never fits ends up empty, with a log entry explaining why
+    question = Question({"query_graph": {"nodes": {}, "edges": {}}})
+    question.response_byte_budget = 1000
+    question.compile_cypher = lambda **kwargs: (f"cypher limit {kwargs['limit']}", {})
+    rows = asyncio.run(question.run_within_budget(MockGraphInterface(lambda cypher: False), "cypher", {}))
+    assert rows == [{"knowledge_graph": {"nodes": {}, "edges": {}}, "results": []}]
+    assert question.logs[0]["level"] == "WARNING"
+
+
+def test_push_down_filter():
+    cypher = "MATCH (`n0` {`id`: $id_0})-[`e0`]->(`n1`) WHERE `n1`.id IN $ids_1 WITH `n0`, `e0`, `n1` RETURN `n0`"
+    filtered = push_down_filter(cypher, "$constraint_0 > `n1`.`score`")
+    assert filtered == "MATCH (`n0` {`id`: $id_0})-[`e0`]->(`n1`) WHERE `n1`.id IN $ids_1 " \
+                       "WITH * WHERE $constraint_0 > `n1`.`score` WITH `n0`, `e0`, `n1` RETURN `n0`"
+    # the filter goes after the last of the leading MATCH clauses, the WITH of STARTS WITH isn't a clause
+    assert push_down_filter("MATCH (`n0`) MATCH (`n1`) WHERE `n1`.name STARTS WITH 'a' RETURN `n0`", "true") == \
+        "MATCH (`n0`) MATCH (`n1`) WHERE `n1`.name STARTS WITH 'a' WITH * WHERE true RETURN `n0`"
+    # queries binding variables after other clauses, or in subqueries, aren't filtered
+    assert push_down_filter("MATCH (`n0`) WITH `n0` MATCH (`n1`) RETURN `n0`", "true") is None
+    assert push_down_filter("MATCH (`n0`) OPTIONAL MATCH (`n1`) RETURN `n0`", "true") is None
+    assert push_down_filter("CALL { MATCH (`n0`) } RETURN `n0`", "true") is None
+
+
+def assert_filtered_before_results(cypher: str, cypher_filter: str):
+    filtered = push_down_filter(cypher, cypher_filter)
+    assert filtered is not None
+    matches, assembled = filtered.split(f"WITH * WHERE {cypher_filter} ")
+    # every MATCH clause binds its variables before the filter, the results are assembled after it
+    assert matches == cypher[:len(matches)] and matches.count("MATCH") == cypher.count("MATCH")
+    assert assembled.startswith("WITH {node_bindings:") and matches + assembled == cypher
+
+
+def test_push_down_filter_transpiler_queries():
+    multi_hop = {
+        "nodes": {"n0": {"ids": ["NCBIGene:1"], "categories": ["biolink:Gene"]},
+                  "n1": {"categories": ["biolink:Disease"]},
+                  "n2": {"ids": ["CHEBI:1", "CHEBI:2"], "categories": ["biolink:ChemicalEntity"]}},
+        "edges": {"e0": {"subject": "n0", "object": "n1", "predicates": ["biolink:related_to"]},
+                  "e1": {"subject": "n2", "object": "n1", "predicates": ["biolink:treats"]}}
+    }
+    cypher_filter = "coalesce($constraint_0 = `e1`.`publications`, false)"
+    for subclass_depth in (0, 1, 2):
+        assert_filtered_before_results(get_query(copy.deepcopy(multi_hop), use_hints=True,
+                                                 relationship_id="internal", limit=10,
+                                                 subclass_depth=subclass_depth), cypher_filter)
+    # set nodes are aggregated after the filter, so only their members failing the constraint are dropped
+    set_query = {
+        "nodes": {"n0": {"ids": ["NCBIGene:1", "NCBIGene:2"], "categories": ["biolink:Gene"],
+                         "set_interpretation": "ALL"},
+                  "n1": {"categories": ["biolink:Disease"]}},
+        "edges": {"e0": {"subject": "n0", "object": "n1", "predicates": ["biolink:related_to"]}}
+    }
+    assert_filtered_before_results(get_query(set_query, use_hints=True, relationship_id="internal", subclass_depth=1),
+                                   "coalesce($constraint_0 = `n0`.`publications`, false)")
+
+
+def test_compile_cypher_pushes_down_constraints():
+    compile_cypher_template.cache_clear()
+    message = {
+        "query_graph": {
+            "nodes": {"n0": {"ids": ["NCBIGene:1"], "categories": ["biolink:Gene"], "constraints": []},
+                      "n1": {"ids": ["MONDO:1", "MONDO:2"], "categories": ["biolink:Disease"], "constraints": []}},
+            "edges": {"e0": {"subject": "n0", "object": "n1", "predicates": ["biolink:related_to"],
+                             "qualifier_constraints": [], "attribute_constraints": [
+                                 {"id": "biolink:publications", "operator": "==", "value": "PMID:1", "not": False}]}}
+        }
+    }
+    question = Question(message)
+    cypher, parameters = question.compile_cypher(**question.get_query_kwargs())
+    assert parameters == {"id_0": "NCBIGene:1", "ids_1": ["MONDO:1", "MONDO:2"], "constraint_0": "PMID:1"}
+    assert "WITH * WHERE coalesce($constraint_0 = `e0`.`publications`, false) WITH {node_bindings:" in cypher
+    assert question.pushed_down_constraints == {"nodes": {}, "edges": {"e0": {0}}}
+    # other constraint values reuse the template
+    message["query_graph"]["edges"]["e0"]["attribute_constraints"][0]["value"] = "PMID:2"
+    other_question = Question(message)
+    other_cypher, other_parameters = other_question.compile_cypher(**other_question.get_query_kwargs())
+    assert other_cypher == cypher and other_parameters["constraint_0"] == "PMID:2"
+    assert compile_cypher_template.cache_info().hits == 1
+
+
+def test_compile_constraint_filter():
+    query_graph = {
+        "nodes": {"n0": {"constraints": []},
+                  "n1": {"constraints": [
+                      {"id": "biolink:publications", "operator": "==", "value": "PMID:1", "not": False},
+                      {"id": "biolink:publications", "operator": "matches", "value": "PMID:.*", "not": False},
+                      {"id": "biolink:publications", "operator": ">", "value": True, "not": False}]}},
+        "edges": {"e0": {"attribute_constraints": [
+            {"id": "biolink:publications", "operator": "==", "value": "PMID:2", "not": True},
+            {"id": "biolink:same_as", "operator": "==", "value": ["DRUGBANK:DB0450"], "not": False}]}}
+    }
+    cypher_filter, parameters, pushed_down = Question.compile_constraint_filter(query_graph)
+    assert parameters == {"constraint_0": "PMID:1", "constraint_1": "PMID:2"}
+    assert cypher_filter == "coalesce($constraint_0 = `n1`.`publications`, false) AND " \
+                            "(`e0`.`publications` IS NOT NULL AND " \
+                            "NOT coalesce($constraint_1 = `e0`.`publications`, false))"
+    # regexes, booleans and lists are left to the python filter
+    assert pushed_down == {"nodes": {"n1": {0}}, "edges": {"e0": {0}}}
+
+
+def test_attribute_property_mapped_the_same_either_way():
+    from PLATER.services.util import attribute_mapping
+    from reasoner_transpiler.cypher import ATTRIBUTE_TYPES
+    attribute_mapping.get_attribute_property.cache_clear()
+    assert attribute_mapping.get_attribute_property('biolink:publications') == 'publications'
+    attribute_mapping.get_attribute_property.cache_clear()
+    # responses type plater_test_publications as biolink:publications too, the transpiler returns it with that type,
+    # but without the type it's a plain biolink:Attribute, so neo4j checking publications alone could disagree
+    with patch.dict(ATTRIBUTE_TYPES, {'plater_test_publications': 'biolink:publications'}):
+        assert attribute_mapping.get_attribute_property('biolink:publications') is None
+    attribute_mapping.get_attribute_property.cache_clear()
+
+
+def test_attribute_constraint_skips_pushed_down(message):
+    node_constraints = [
+        {"id": "biolink:same_as", "name": "eq_id_filter", "value": ["DRUGBANK:DB0450"], "operator": "=="}
+    ]
+    message['query_graph']['nodes']['n1']['constraints'] = node_constraints
+    expected = copy.deepcopy(message)
+    # neo4j already checked the constraint, so nothing is filtered afterwards
+    result = Question.apply_attribute_constraints(message, pushed_down={'nodes': {'n1': {0}}, 'edges': {}})
+    assert result == expected
+
+
+def test_classify_attribute():
+    from PLATER.services.util.attribute_mapping import classify_attribute, attribute_classifications
+    qualifier = classify_attribute('object_aspect_qualifier')
+    assert qualifier.is_qualifier and qualifier.qualifier_type_id == 'biolink:object_aspect_qualifier'
+    assert classify_attribute('biolink:object_aspect_qualifier').qualifier_type_id == 'biolink:object_aspect_qualifier'
+    assert classify_attribute('provided_by').skip
+    attribute = classify_attribute('publications')
+    assert not attribute.is_qualifier and not attribute.skip
+    assert attribute.attribute_info == {'attribute_type_id': 'biolink:publications',
+                                        'value_type_id': 'linkml:Uriorcurie'}
+    # classifications are kept per name
+    assert attribute_classifications[('publications', None)] is attribute
+    # the transpiler's 'NA' for attributes without a type shares the entry of a missing attribute_type_id
+    assert classify_attribute('publications', 'NA') is attribute
+
+
+def test_primed_attribute_classifications():
+    from PLATER.services.util import attribute_mapping
+    from reasoner_transpiler.cypher import ATTRIBUTE_TYPES
+    meta_kg = {"nodes": {"biolink:Gene": {"attributes": [{"attribute_type_id": "biolink:Attribute",
+                                                          "original_attribute_names": ["some_score"]}]}},
+               "edges": [{"attributes": [{"attribute_type_id": "biolink:publications",
+                                          "original_attribute_names": ["publications"]}]}]}
+    attribute_mapping.attribute_classifications.clear()
+    attribute_mapping.prime_attribute_classifications(meta_kg)
+    primed = dict(attribute_mapping.attribute_classifications)
+    with patch.object(attribute_mapping, 'get_attribute_info', side_effect=AssertionError('not primed')):
+        # attributes shaped like the transpiler returns them find the primed classifications
+        for attribute_name in ('some_score', 'publications'):
+            attribute_type_id = ATTRIBUTE_TYPES.get(attribute_name, 'NA')
+            classification = attribute_mapping.classify_attribute(attribute_name, attribute_type_id)
+            assert classification in primed.values()
+    assert len(attribute_mapping.attribute_classifications) == len(primed)
+
+
+def test_sources_tree_is_shared():
+    question = Question({})
+    construct_sources_tree.cache_clear()
+    sources_tree = question._construct_sources_tree([
+        {"resource_role": "biolink:primary_knowledge_source", "resource_id": "infores:primary"},
+        {"resource_role": "aggregator_knowledge_source", "resource_id": ["infores:aggregator"]},
+        {"resource_role": "supporting_data_source", "resource_id": None}])
+    assert sources_tree == [
+        {"resource_id": "infores:primary", "resource_role": "primary_knowledge_source"},
+        {"resource_id": "infores:aggregator", "resource_role": "aggregator_knowledge_source",
+         "upstream_resource_ids": ["infores:primary"]},
+        {"resource_id": "infores:plater.notspecified", "resource_role": "aggregator_knowledge_source",
+         "upstream_resource_ids": ["infores:aggregator"]}]
+    # edges with the same sources get the same tree
+    assert question._construct_sources_tree([
+        {"resource_role": "biolink:primary_knowledge_source", "resource_id": "infores:primary"},
+        {"resource_role": "aggregator_knowledge_source", "resource_id": ["infores:aggregator"]},
+        {"resource_role": "supporting_data_source", "resource_id": None}]) is sources_tree
+    assert construct_sources_tree.cache_info().hits == 1
@@ -0,0 +1,95 @@
+import json
+from PLATER.services.util.response_cache import CanonicalQueryGraph, ResponseCache
+
+
+def one_hop(subject_name, object_name, edge_name, ids=('NCBIGene:1', 'NCBIGene:2')):
+    return {
+        "nodes": {
+            subject_name: {"ids": list(ids), "categories": ["biolink:Gene"], "is_set": False},
+            object_name: {"categories": ["biolink:Disease"], "ids": None, "is_set": False},
+        },
+        "edges": {
+            edge_name: {"subject": subject_name, "object": object_name, "predicates": ["biolink:related_to"]}
+        }
+    }
+
+
+def answer(subject_name, object_name, edge_name):
+    return {
+        "query_graph": one_hop(subject_name, object_name, edge_name),
+        "knowledge_graph": {"nodes": {"NCBIGene:1": {"name": "gene"}, "MONDO:1": {"name": "disease"}},
+                            "edges": {"edge_1": {"subject": "NCBIGene:1", "object": "MONDO:1"}}},
+        "results": [{
+            "node_bindings": {subject_name: [{"id": "NCBIGene:1"}], object_name: [{"id": "MONDO:1"}]},
+            "analyses": [{"resource_id": "infores:test", "edge_bindings": {edge_name: [{"id": "edge_1"}]}}]
+        }]
+    }
+
+
+def test_canonical_query_graph_ignores_names_and_order():
+    reference = CanonicalQueryGraph(one_hop('n0', 'n1', 'e0'), results_limit=None, subclass_depth=1)
+    renamed = CanonicalQueryGraph(one_hop('gene', 'disease', 'treats'), results_limit=None, subclass_depth=1)
+    reordered = CanonicalQueryGraph(one_hop('n0', 'n1', 'e0', ids=('NCBIGene:2', 'NCBIGene:1')),
+                                    results_limit=None, subclass_depth=1)
+    assert reference.key == renamed.key == reordered.key
+    # settings and content are part of the key
+    assert CanonicalQueryGraph(one_hop('n0', 'n1', 'e0'), results_limit=10, subclass_depth=1).key != reference.key
+    assert CanonicalQueryGraph(one_hop('n0', 'n1', 'e0', ids=('NCBIGene:3',)),
+                               results_limit=None, subclass_depth=1).key != reference.key
+
+
+def test_canonical_query_graph_malformed():
+    # an edge naming a missing node can't be canonicalized, the lookup reports the error instead of the cache
+    query_graph = one_hop('n0', 'n1', 'e0')
+    query_graph['edges']['e0']['object'] = 'missing'
+    assert CanonicalQueryGraph.create(query_graph, results_limit=None, subclass_depth=1) is None
+    assert CanonicalQueryGraph.create(one_hop('n0', 'n1', 'e0'), results_limit=None, subclass_depth=1).key == \
+        CanonicalQueryGraph(one_hop('n0', 'n1', 'e0'), results_limit=None, subclass_depth=1).key
+
+
+def test_response_cache_renames_bindings(tmp_path):
+    metadata_path = tmp_path / 'metadata.json'
+    metadata_path.write_text(json.dumps({'graph_version': 'v1'}))
+    cache = ResponseCache(max_bytes=10000, ttl=60, metadata_path=str(metadata_path), version_check_interval=0)
+    original = CanonicalQueryGraph(one_hop('n0', 'n1', 'e0'))
+    assert cache.get(original) is None
+    original_answer = answer('n0', 'n1', 'e0')
+    cache.put(original, original_answer)
+    # the answer that was cached is left as it is
+    assert original_answer == answer('n0', 'n1', 'e0')
+    renamed = CanonicalQueryGraph(one_hop('gene', 'disease', 'treats'))
+    cached = cache.get(renamed)
+    expected = answer('gene', 'disease', 'treats')
+    del expected['query_graph']
+    assert cached == expected
+    assert cache.get_stats()['hits'] == 1 and cache.get_stats()['misses'] == 1
+
+
+def test_response_cache_limits(tmp_path):
+    metadata_path = tmp_path / 'metadata.json'
+    metadata_path.write_text(json.dumps({'graph_version': 'v1'}))
+    first, second = CanonicalQueryGraph(one_hop('n0', 'n1', 'e0')), \
+        CanonicalQueryGraph(one_hop('n0', 'n1', 'e0', ids=('NCBIGene:3',)))
+    cache = ResponseCache(max_bytes=10000, ttl=60, metadata_path=str(metadata_path), version_check_interval=0)
+    cache.put(first, answer('n0', 'n1', 'e0'))
+    entry_size = cache.get_stats()['bytes']
+    # only room for one entry, the least recently used one is evicted
+    cache = ResponseCache(max_bytes=int(entry_size * 1.5), ttl=60, metadata_path=str(metadata_path),
+                          version_check_interval=0)
+    cache.put(first, answer('n0', 'n1', 'e0'))
+    cache.put(second, answer('n0', 'n1', 'e0'))
+    assert cache.get(first) is None
+    assert cache.get(second) is not None
+    assert cache.get_stats()['bytes'] <= cache.max_bytes
+    # expired entries are dropped
+    cache.ttl = -1
+    cache.put(first, answer('n0', 'n1', 'e0'))
+    assert cache.get(first) is None
+    # a new graph version clears the cache
+    cache.ttl = 60
+    cache.put(first, answer('n0', 'n1', 'e0'))
+    assert cache.get(first) is not None
+    metadata_path.write_text(json.dumps({'graph_version': 'v2'}))
+    cache._metadata_mtime = None
+    assert cache.get(first) is None
+    assert cache.graph_version == 'v2'